@@ -3,12 +3,21 @@ Nextstrain command-line tool
 """
 
 
+# Import our tracing module first so that its clock starts before the time
+# spent importing everything else.
+from . import trace
+
+import os
 import sys
 import argparse
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, RawDescriptionHelpFormatter
+from pathlib  import Path
+from time     import perf_counter
 from types    import SimpleNamespace
 
-from .command     import build, view, deploy, shell, update, check_setup, version
+from .            import metrics
+from .command     import build, view, deploy, fetch, shard, daemon, shell, update, check_setup, completion, version
+from .util        import warn
 from .__version__ import __version__
 
 
@@ -21,6 +30,52 @@ def run(args):
     Command-line entrypoint to the nextstrain-cli package, called by the
     `nextstrain` program.
     """
+    run_start = perf_counter()
+
+    parser = make_parser()
+    opts   = parser.parse_args(args)
+
+    if not (opts.trace or opts.metrics):
+        return opts.__command__.run(opts)
+
+    if opts.trace:
+        trace.enable()
+        trace.complete("import", trace.IMPORT_START, run_start)
+        trace.complete("parse arguments", run_start, perf_counter())
+
+    if opts.metrics:
+        metrics.enable()
+
+    # An uncaught exception exits 1.
+    status = 1
+
+    try:
+        with trace.span("nextstrain %s" % command_name(opts.__command__)):
+            status = opts.__command__.run(opts)
+            return status
+    finally:
+        # Failing to write the trace or metrics is reported but doesn't
+        # change the command's status or hide its exception.
+        if opts.trace:
+            try:
+                trace.write(opts.trace)
+            except OSError as error:
+                warn("Error writing trace to %s: %s" % (opts.trace, error))
+            else:
+                warn("Trace written to %s" % opts.trace)
+
+        if opts.metrics:
+            try:
+                metrics.write(opts.metrics, command_name(opts.__command__), status, perf_counter() - run_start)
+            except (OSError, ValueError) as error:
+                warn("Error writing metrics to %s: %s" % (opts.metrics, error))
+
+
+def make_parser() -> ArgumentParser:
+    """
+    Assembles the argument parser for the `nextstrain` program and all of its
+    commands.
+    """
     parser = ArgumentParser(
         prog            = "nextstrain",
         description     = __doc__,
@@ -36,18 +91,30 @@ def run(args):
         build,
         view,
         deploy,
+        fetch,
+        shard,
+        daemon,
         shell,
         update,
         check_setup,
+        completion,
         version,
     ]
 
     register_default_command(parser)
     register_commands(parser, commands)
     register_version_alias(parser)
+    register_trace_option(parser)
+    register_metrics_option(parser)
 
-    opts = parser.parse_args(args)
-    return opts.__command__.run(opts)
+    return parser
+
+
+def command_name(command):
+    """
+    Returns the short name of a command module, e.g. "build".
+    """
+    return getattr(command, "__name__", "(none)").split(".")[-1]
 
 
 def register_default_command(parser):
@@ -94,3 +161,34 @@ def register_version_alias(parser):
         nargs  = 0,
         help   = argparse.SUPPRESS,
         action = run_version_command)
+
+
+def register_trace_option(parser):
+    """
+    Add the global --trace option (and its --profile alias) for recording
+    where time is spent.
+    """
+    parser.add_argument(
+        "--trace", "--profile",
+        help    = "Record where time is spent and write it to <file> as a "
+                  "Chrome trace-event JSON file, viewable with Perfetto.  "
+                  "May also be set with the NEXTSTRAIN_TRACE environment variable.",
+        metavar = "<file>",
+        type    = Path,
+        default = os.environ.get("NEXTSTRAIN_TRACE") or None)
+
+
+def register_metrics_option(parser):
+    """
+    Add the global --metrics option for recording metrics about each run.
+    """
+    parser.add_argument(
+        "--metrics",
+        help    = "Write metrics about this run, such as its duration, exit code, "
+                  "and amount deployed, to <file> on exit.  A <file> ending in .prom "
+                  "is updated in the Prometheus node exporter textfile format; "
+                  "otherwise a JSON line is appended.  May also be set with the "
+                  "NEXTSTRAIN_METRICS environment variable.",
+        metavar = "<file>",
+        type    = Path,
+        default = os.environ.get("NEXTSTRAIN_METRICS") or None)
@@ -0,0 +1,223 @@
+"""
+Python API for running builds, deploys, and the viewer in-process, for
+programs which drive many of them and don't want to start a new `nextstrain`
+process (and parse its output) for each.
+
+Each function takes an options object, a named tuple whose fields mirror the
+command's options (with the same defaults, including those set by
+environment variables), and returns a named tuple of results:
+
+    from pathlib import Path
+    from nextstrain.cli import api
+
+    result = api.deploy(api.DeployOptions(
+        destinations = ["s3://my-bucket/zika/"],
+        files        = [Path("auspice/zika_tree.json"), Path("auspice/zika_meta.json")]))
+
+    for file in result.files:
+        print(file.action, file.key, file.size, file.seconds)
+
+Commands still print their usual output.  Invalid options raise ValueError
+instead of exiting.
+
+S3 and CloudFront connections are reused across calls with the same boto3
+*session* (the default session if none is given), so only the first call
+pays for setting them up.  There's no Docker client to reuse, as builds run
+the `docker` program directly.
+
+Calls must be made one at a time, as some settings (e.g. the S3 endpoint) are
+kept for the whole process.
+"""
+
+import io
+from contextlib import redirect_stderr
+from pathlib import Path
+from time import perf_counter
+from typing import List, NamedTuple, Optional
+from . import make_parser
+from .deploy import s3
+
+
+BuildOptions = NamedTuple("BuildOptions", [
+    ("directory",       Path),
+    ("runner",          Optional[str]),     # "docker" or "native"; None for the default
+    ("image",           Optional[str]),
+    ("docker_args",     List[str]),
+    ("cache",           bool),
+    ("cache_remote",    Optional[str]),
+    ("rule_containers", bool),
+    ("deploy",          List[str]),
+    ("deploy_from",     Optional[Path]),
+    ("s3_endpoint",     Optional[str]),
+    ("s3_path_style",   bool),
+    ("cloudfront",      Optional[bool]),
+    ("exec_args",       List[str]),         # Passed to snakemake
+])
+
+BuildOptions.__new__.__defaults__ = (None, None, [], False, None, False, [], None, None, False, None, []) # type: ignore
+
+# The *files* are those deployed by BuildOptions.deploy, if any.
+BuildResult = NamedTuple("BuildResult", [
+    ("status",  int),
+    ("seconds", float),
+    ("files",   List[s3.DeployedFile]),
+    ("invalidations", List[s3.Invalidation]),
+])
+
+DeployOptions = NamedTuple("DeployOptions", [
+    ("destinations",    List[str]),
+    ("files",           List[Path]),
+    ("sync",            Optional[Path]),
+    ("include",         List[str]),
+    ("exclude",         List[str]),
+    ("header_policy",   Optional[Path]),
+    ("immutable",       bool),
+    ("shard",           bool),
+    ("s3_endpoint",     Optional[str]),
+    ("s3_path_style",   bool),
+    ("cloudfront",      Optional[bool]),
+])
+
+DeployOptions.__new__.__defaults__ = ([], None, [], [], None, False, False, None, False, None) # type: ignore
+
+DeployResult = NamedTuple("DeployResult", [
+    ("status",  int),
+    ("seconds", float),
+    ("files",   List[s3.DeployedFile]),
+    ("invalidations", List[s3.Invalidation]),
+])
+
+ViewOptions = NamedTuple("ViewOptions", [
+    ("directory",           Path),
+    ("runner",              Optional[str]),
+    ("image",               Optional[str]),
+    ("allow_remote_access", bool),
+])
+
+ViewOptions.__new__.__defaults__ = (None, None, False) # type: ignore
+
+ViewResult = NamedTuple("ViewResult", [
+    ("status",  int),
+    ("seconds", float),
+])
+
+
+def build(options: BuildOptions, session = None) -> BuildResult:
+    """
+    Run a build, as by `nextstrain build`, returning when it's done.
+    """
+    argv = [
+        "build",
+        *runner_args(options.runner, options.image),
+        *["--docker-arg=%s" % arg for arg in options.docker_args],
+        *(["--cache"] if options.cache else []),
+        *(["--cache-remote=%s" % options.cache_remote] if options.cache_remote else []),
+        *(["--rule-containers"] if options.rule_containers else []),
+        *["--deploy=%s" % url for url in options.deploy],
+        *(["--deploy-from=%s" % options.deploy_from] if options.deploy_from else []),
+        *s3_args(options),
+        "--",
+        str(options.directory),
+        *options.exec_args,
+    ]
+
+    return BuildResult(*run(argv, session))
+
+
+def deploy(options: DeployOptions, session = None) -> DeployResult:
+    """
+    Deploy files to one or more destinations, as by `nextstrain deploy`.
+    """
+    if not options.destinations:
+        raise ValueError("No destinations given")
+
+    argv = [
+        "deploy",
+        *(["--sync=%s" % options.sync] if options.sync else []),
+        *["--include=%s" % pattern for pattern in options.include],
+        *["--exclude=%s" % pattern for pattern in options.exclude],
+        *(["--header-policy=%s" % options.header_policy] if options.header_policy else []),
+        *(["--immutable"] if options.immutable else []),
+        *(["--shard"] if options.shard else []),
+        *s3_args(options),
+        "--",
+        options.destinations[0],
+        *[str(file) for file in options.files],
+    ]
+
+    # Given separately, so files aren't mistaken for destinations.
+    return DeployResult(*run(argv, session, destinations = list(options.destinations)))
+
+
+def view(options: ViewOptions) -> ViewResult:
+    """
+    Run the viewer, as by `nextstrain view`, returning when it stops.
+    """
+    argv = [
+        "view",
+        *runner_args(options.runner, options.image),
+        *(["--allow-remote-access"] if options.allow_remote_access else []),
+        "--",
+        str(options.directory),
+    ]
+
+    status, seconds, _, _ = run(argv)
+
+    return ViewResult(status, seconds)
+
+
+def run(argv: List[str], session = None, **overrides) -> tuple:
+    """
+    Run the command line *argv* in-process, returning its exit status, its
+    duration in seconds, and the files and CloudFront invalidations it
+    deployed.
+
+    Options are given as --name=value and positional arguments after "--", so
+    values which start with "-" aren't taken for options.  Any *overrides*
+    are set on the parsed options.
+    """
+    errors = io.StringIO()
+
+    try:
+        with redirect_stderr(errors):
+            opts = make_parser().parse_args(argv)
+    except SystemExit:
+        # The last line of argparse's output is the error, after the usage.
+        raise ValueError("Invalid options: %s" % errors.getvalue().strip().split("\n")[-1])
+
+    for name, value in overrides.items():
+        setattr(opts, name, value)
+
+    previous_session = s3.SESSION
+    s3.SESSION       = session
+
+    try:
+        with s3.recording() as recorded:
+            start  = perf_counter()
+            status = opts.__command__.run(opts)
+
+        return status, perf_counter() - start, recorded.files, recorded.invalidations
+    finally:
+        s3.SESSION = previous_session
+
+
+def runner_args(runner: Optional[str], image: Optional[str]) -> List[str]:
+    if runner not in {None, "docker", "native"}:
+        raise ValueError("Unknown runner %r" % runner)
+
+    return [
+        *(["--" + runner] if runner else []),
+        *(["--image=%s" % image] if image else []),
+    ]
+
+
+def s3_args(options) -> List[str]:
+    if options.cloudfront not in {None, True, False}:
+        raise ValueError("cloudfront must be True, False, or None, not %r" % (options.cloudfront,))
+
+    return [
+        *(["--s3-endpoint=%s" % options.s3_endpoint] if options.s3_endpoint else []),
+        *(["--s3-path-style"] if options.s3_path_style else []),
+        *(["--cloudfront"]    if options.cloudfront is True else []),
+        *(["--no-cloudfront"] if options.cloudfront is False else []),
+    ]
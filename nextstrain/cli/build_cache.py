@@ -0,0 +1,254 @@
+"""
+Content-addressed cache of build outputs, shared between builds and computers.
+
+Builds use snakemake's between-workflow output caching.  For each rule marked
+`cache: True` in the Snakefile, snakemake hashes the rule's inputs,
+parameters, code, and software environment and, before running the rule,
+looks for outputs stored under that hash in a cache directory.  Outputs of
+rules which do run are stored there afterwards.
+
+The cache directory is kept locally in ~/.nextstrain/build-cache and may be
+shared through an S3 (or S3-compatible) bucket.  Entries are named by their
+hash and never change.  Rather than mirror the whole bucket, each build first
+runs snakemake with --dry-run to find the names of the entries it will look
+for, which snakemake only computes as it goes; just those which are missing
+locally are fetched.  After the build succeeds, those of them which are
+missing from the bucket are stored.
+
+(Snakemake can also keep its cache in S3 itself, but only by making S3 the
+default location of every input and output file of the build.)
+"""
+
+import argparse
+import os
+import shutil
+import urllib.parse
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+from uuid import uuid4
+from . import runner, trace
+from .deploy import walk
+from .deploy.s3 import load_bucket
+from .paths import BUILD_CACHE
+from .util import warn
+from .volume import NamedVolume
+
+
+# Number of cache entries to transfer concurrently.
+TRANSFER_CONCURRENCY = 8
+
+# Where the cache is mounted inside containers.
+CONTAINER_PATH = "/nextstrain/build-cache"
+
+# Runs snakemake, recording the name of each cache entry it looks for to the
+# file named by NEXTSTRAIN_BUILD_CACHE_WANTED in the cache directory.  The
+# names come from the method of snakemake's local cache which --dry-run uses
+# to check for each cached output (at least in snakemake 5.12 through 7).
+WANTED_SCRIPT = """
+import os, sys
+from snakemake.caching.local import OutputFileCache
+
+wanted = os.path.join(os.environ["SNAKEMAKE_OUTPUT_CACHE"], os.environ["NEXTSTRAIN_BUILD_CACHE_WANTED"])
+entries = OutputFileCache.get_outputfiles_and_cachefiles
+
+def recording_entries(self, job, *args):
+    pairs = list(entries(self, job, *args))
+
+    with open(wanted, "a") as file:
+        for outputfile, cachefile in pairs:
+            print(cachefile.name, file = file)
+
+    return iter(pairs)
+
+OutputFileCache.get_outputfiles_and_cachefiles = recording_entries
+
+try:
+    from snakemake.cli import main
+except ImportError:
+    from snakemake import main
+
+sys.argv[0] = "snakemake"
+main()
+"""
+
+
+def configure(opts, docker: bool) -> Dict[str, str]:
+    """
+    Set up the given build options to use the cache, and return the
+    environment variables which point snakemake at it.
+
+    When running in a container (*docker* is true), the local cache is added
+    to the volumes mounted into it.
+    """
+    BUILD_CACHE.mkdir(parents = True, exist_ok = True)
+
+    opts.extra_exec_args = [*opts.extra_exec_args, "--cache"]
+
+    if docker:
+        opts.volumes.append(NamedVolume("build-cache", BUILD_CACHE))
+        return { "SNAKEMAKE_OUTPUT_CACHE": CONTAINER_PATH }
+    else:
+        return { "SNAKEMAKE_OUTPUT_CACHE": str(BUILD_CACHE) }
+
+
+def wanted(opts, env: Dict[str, str]) -> Optional[List[str]]:
+    """
+    Returns the names of the cache entries the build given by *opts* will
+    look for, found by a dry run of it with the environment *env* from
+    configure(), or None if the dry run failed.
+    """
+    name = ".wanted-%s" % uuid4().hex
+    path = BUILD_CACHE / name
+
+    dry_run = argparse.Namespace(**vars(opts))
+    dry_run.exec         = "python3"
+    dry_run.exec_args    = ["-c", WANTED_SCRIPT, *opts.exec_args, "--dry-run"]
+    dry_run.keep_scratch = []
+
+    print("Finding the build cache entries needed by the build")
+
+    try:
+        with trace.span("find build cache entries"):
+            status = runner.run(dry_run, working_volume = opts.build, extra_env = { **env, "NEXTSTRAIN_BUILD_CACHE_WANTED": name })
+
+        if status != 0:
+            warn("Error: Unable to find the build cache entries needed by the build.")
+            return None
+
+        if not path.exists():
+            return []
+
+        with path.open() as file:
+            return sorted({ line.strip() for line in file if line.strip() })
+    finally:
+        if path.exists():
+            path.unlink()
+
+
+def pull(url: urllib.parse.ParseResult, names: List[str]) -> int:
+    """
+    Download the named cache entries which are missing from the local cache
+    from the bucket under the URL's prefix, if they're there.
+    """
+    bucket = load_bucket(url)
+
+    if not bucket:
+        return 1
+
+    prefix  = url.path.lstrip("/")
+    missing = [ name for name in names if not (BUILD_CACHE / name).exists() ]
+    fetched = [] # type: List[str]
+
+    def download(name):
+        with trace.span("download cache entry", key = prefix + name):
+            keys = remote_files(bucket, prefix + name)
+
+            if not keys:
+                return
+
+            # The entry, which may be a directory of many files, is written
+            # to a temporary path which is renamed into place once it's
+            # complete, so an interrupted or failed download never leaves a
+            # partial entry in the cache.
+            path      = BUILD_CACHE / name
+            temporary = BUILD_CACHE / (".fetching-%s-%s" % (name, uuid4().hex))
+
+            try:
+                for key in keys:
+                    file = temporary / key[len(prefix + name):].lstrip("/")
+                    file.parent.mkdir(parents = True, exist_ok = True)
+                    bucket.download_file(key, str(file))
+
+                if not path.exists():
+                    os.replace(str(temporary), str(path))
+            finally:
+                remove(temporary)
+
+            fetched.append(name)
+
+    try:
+        transfer(download, missing)
+    except (BotoCoreError, ClientError) as error:
+        warn("Error fetching build cache: %s" % error)
+        return 1
+
+    print("Fetched %d of %d missing build cache entries from %s" % (len(fetched), len(missing), url.geturl()))
+
+    return 0
+
+
+def push(url: urllib.parse.ParseResult, names: List[str]) -> int:
+    """
+    Upload the named cache entries which are in the local cache but not in
+    the bucket under the URL's prefix.
+    """
+    bucket = load_bucket(url)
+
+    if not bucket:
+        return 1
+
+    prefix = url.path.lstrip("/")
+    local  = [ name for name in names if (BUILD_CACHE / name).exists() ]
+    stored = [] # type: List[str]
+
+    def upload(name):
+        with trace.span("upload cache entry", key = prefix + name):
+            if remote_files(bucket, prefix + name):
+                return
+
+            path = BUILD_CACHE / name
+
+            # Entries for directory outputs are directories.
+            if path.is_dir():
+                files = [ (name + "/" + subname, subpath) for subname, subpath in walk(path) ]
+            else:
+                files = [ (name, path) ]
+
+            for key, file in files:
+                bucket.upload_file(str(file), prefix + key)
+
+            stored.append(name)
+
+    try:
+        transfer(upload, local)
+    except (BotoCoreError, ClientError) as error:
+        warn("Error storing build cache: %s" % error)
+        return 1
+
+    print("Stored %d new build cache entries in %s" % (len(stored), url.geturl()))
+
+    return 0
+
+
+def remove(path: Path) -> None:
+    """
+    Removes the file or directory at *path*, if it exists.
+    """
+    if path.is_dir():
+        shutil.rmtree(str(path))
+    elif path.exists():
+        path.unlink()
+
+
+def remote_files(bucket, key: str) -> List[str]:
+    """
+    Returns the keys of the files for the cache entry at *key*: the entry
+    itself, or, if it's a directory, the files under it.
+    """
+    return [
+        object.key
+            for object in bucket.objects.filter(Prefix = key)
+             if object.key == key or object.key.startswith(key + "/")
+    ]
+
+
+def transfer(function, names) -> None:
+    """
+    Call *function* with each name concurrently, re-raising the first error,
+    if any, after the others finish.
+    """
+    with ThreadPoolExecutor(max_workers = TRANSFER_CONCURRENCY) as executor:
+        for future in [ executor.submit(function, name) for name in names ]:
+            future.result()
@@ -0,0 +1,235 @@
+"""
+Deploys a build's outputs while it runs, so uploading them overlaps with the
+rest of the build instead of following it.
+
+The build's output directory is polled for new or changed *_tree.json and
+*_meta.json files.  Each is compressed and uploaded once it's finished, i.e.
+once its size and modification time are the same in two polls in a row and
+it's complete JSON.  This also works when the build runs in a Docker VM
+(e.g. on macOS), where filesystem events from the container aren't seen by
+us.
+
+Files uploaded while the build runs go to a staging area under each
+destination prefix (see s3.STAGING_PREFIX), not where they're served from,
+as the build may yet fail or rewrite them.  When the build finishes
+successfully, each staged file which is still current is copied into place
+within S3, which is quick, and any outputs not yet uploaded in their final
+form (including those the build didn't need to remake) are uploaded.  Then
+the index under each destination prefix is updated and CloudFront is
+purged, once for everything deployed.  If the build fails, nothing is
+published and the staged files are deleted.
+"""
+
+import json
+import threading
+import urllib.parse
+from botocore.exceptions import BotoCoreError, ClientError
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+from uuid import uuid4
+from .deploy import s3
+from .deploy.policy import DEFAULT_POLICY
+from .util import warn
+
+
+# Output files to deploy, by name.
+PATTERNS = ["*_tree.json", "*_meta.json"]
+
+# Seconds between looks at the output directory.
+POLL_INTERVAL = 1.0
+
+Stamps = Dict[Path, Tuple[float, int]]
+
+
+def load_destinations(urls: List[urllib.parse.ParseResult]):
+    """
+    Returns the destinations for the given URLs, or None (after warning why)
+    if any can't be used.
+    """
+    for url in urls:
+        if url.scheme != "s3":
+            warn("Error: Unsupported deploy destination scheme %s://" % url.scheme)
+            return None
+
+    return s3.load_destinations(urls) or None
+
+
+class streaming:
+    """
+    Context manager which uploads new outputs in *directory* to a staging
+    area under each of the *destinations* as they're written.
+
+    Call finish() when the build is done to publish them (or not) and purge
+    CloudFront.
+    """
+    def __init__(self, directory: Path, destinations: List[s3.Destination]) -> None:
+        staging = s3.STAGING_PREFIX + uuid4().hex + "/"
+
+        self.directory    = directory
+        self.destinations = destinations
+        self.staging      = { d: s3.Destination(d.bucket, d.prefix + staging) for d in destinations }
+        self.staged       = {} # type: Stamps
+        self.attempted    = set() # type: Set[str]
+        self.deployed     = {} # type: Stamps
+        self.index        = {} # type: Dict[str, dict]
+        self.changes      = { destination: [] for destination in destinations } # type: Dict[s3.Destination, List[str]]
+        self.failed       = False
+        self.stopping     = threading.Event()
+        self.thread       = threading.Thread(target = self.poll, name = "deploy outputs", daemon = True)
+
+    def __enter__(self):
+        # Outputs from previous builds aren't deployed until this one
+        # succeeds, in case it remakes them.
+        self.initial = outputs(self.directory)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def stop(self):
+        self.stopping.set()
+
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def poll(self):
+        previous = self.initial
+
+        while not self.stopping.wait(POLL_INTERVAL):
+            current = outputs(self.directory)
+
+            for path, stamp in sorted(current.items()):
+                if stamp == previous.get(path) and stamp != self.staged.get(path, self.initial.get(path)) and is_complete(path):
+                    self.stage(path, stamp)
+
+            previous = current
+
+    def stage(self, path: Path, stamp: Tuple[float, int]):
+        """
+        Upload *path* to the staging area of every destination.
+
+        The *stamp* is taken before reading the file, so if it changes while
+        it's read, it's staged again or uploaded at the end.
+        """
+        self.attempted.add(path.name)
+
+        try:
+            s3.upload([path], list(self.staging.values()), DEFAULT_POLICY, self.index)
+        except (BotoCoreError, ClientError, OSError) as error:
+            # It'll be uploaded directly at the end instead.
+            warn("Warning: Unable to upload %s while the build is running: %s" % (path, error))
+            return
+
+        self.staged[path] = stamp
+
+    def deploy(self, path: Path, stamp: Tuple[float, int]):
+        """
+        Deploy *path* to every destination, by copying its staged copy into
+        place if it's still current or uploading it otherwise.
+        """
+        name = path.name
+
+        try:
+            if self.staged.get(path) == stamp:
+                def publish(destination):
+                    s3.copy_object(destination.bucket, self.staging[destination].prefix + name, destination.prefix + name)
+
+                s3.fan_out(self.destinations, publish)
+            else:
+                s3.upload([path], self.destinations, DEFAULT_POLICY, self.index)
+
+        except (BotoCoreError, ClientError, OSError) as error:
+            warn("Error: Unable to deploy %s: %s" % (path, error))
+            self.failed = True
+            return
+
+        for destination in self.destinations:
+            self.changes[destination].append(destination.prefix + name)
+
+        self.deployed[path] = stamp
+
+    def finish(self, build_succeeded: bool) -> int:
+        """
+        Stop watching, and, if the build succeeded, deploy its outputs as
+        they are now, update the index, and purge CloudFront.  The staging
+        area is emptied either way.
+        """
+        self.stop()
+
+        if build_succeeded:
+            final = outputs(self.directory)
+
+            if not final:
+                warn("Error: No %s files in %s to deploy." % (" or ".join(PATTERNS), self.directory))
+                self.failed = True
+
+            for path, stamp in sorted(final.items()):
+                self.deploy(path, stamp)
+
+            early = len([ path for path, stamp in self.deployed.items() if self.staged.get(path) == stamp ])
+
+            print("Deployed %d file(s), %d uploaded while the build was running." % (len(self.deployed), early))
+
+            index = { path.name: self.index[path.name] for path in self.deployed }
+
+            for destination in self.destinations:
+                if s3.update_index(destination.bucket, destination.prefix, index) != 0:
+                    self.failed = True
+
+            s3.purge_cloudfront(self.changes)
+
+        elif self.staged:
+            print("Not deploying the %d file(s) uploaded while the build was running, as it failed." % len(self.staged))
+
+        self.discard()
+
+        return 1 if self.failed else 0
+
+    def discard(self):
+        """
+        Delete the staged copies of outputs.
+        """
+        for staging in self.staging.values():
+            keys = [ staging.prefix + name for name in sorted(self.attempted) ]
+
+            try:
+                s3.delete_objects(staging.bucket, keys)
+            except (BotoCoreError, ClientError) as error:
+                warn("Warning: Unable to delete staged files under %s: %s" % (s3.s3_url(staging.bucket, staging.prefix), error))
+
+
+def outputs(directory: Path) -> Stamps:
+    """
+    Returns the modification time and size of each output file to deploy in
+    *directory*, which need not exist.
+    """
+    stamps = {} # type: Stamps
+
+    for pattern in PATTERNS:
+        for path in directory.glob(pattern):
+            try:
+                stat = path.stat()
+            except OSError:
+                # Removed since it was listed.
+                continue
+
+            stamps[path] = (stat.st_mtime, stat.st_size)
+
+    return stamps
+
+
+def is_complete(path: Path) -> bool:
+    """
+    Tests if *path* is complete JSON.  A file which hasn't changed for a
+    poll or two may still be partly written, e.g. by a rule which pauses
+    while writing.
+    """
+    try:
+        with path.open(encoding = "utf-8") as file:
+            json.load(file)
+    except (OSError, ValueError):
+        return False
+
+    return True
@@ -4,18 +4,72 @@ Runs a pathogen build in an ephemeral container.
 The build directory should contain a Snakefile, which will be run with
 snakemake inside the container.
 
-Docker is the currently the only supported container system.  It must be
-installed and configured, which you can test by running:
+Docker is the default container system.  It must be installed and configured,
+which you can test by running:
 
     nextstrain check-setup
 
+Alternatively, the --native option runs snakemake directly on this computer,
+without a container, using the programs you've installed yourself.
+
+With --cache, outputs of snakemake rules marked `cache: True` in the
+Snakefile are kept in ~/.nextstrain/build-cache and reused by later builds
+whose rules have the same inputs, parameters, code, and software environment,
+instead of being recomputed.  With --cache-remote, the cache is also shared
+through an S3 bucket: the entries a build needs (found by a dry run) are
+fetched before it if they're missing locally, and new entries are stored
+after it succeeds.  This requires snakemake 5.12
+or newer, and uses the same AWS credentials and S3 options as `nextstrain
+deploy`.
+
+With --rule-containers, snakemake runs each job in its own container instead
+of running them all in the one container it runs in.  Each job's container
+uses the same image and build directory and is limited to the `threads` and
+`resources: mem_mb` of its rule, so one memory-hungry rule can't starve the
+others.  Use snakemake's --jobs option (default: the number of CPUs) to set
+how many jobs run at once, for example:
+
+    nextstrain build --rule-containers zika/ --jobs 16
+
+With --watch, the build is run again each time files in the build directory
+change, for example after you edit its config or input files, until you press
+Control-C.  Snakemake then reruns only the rules affected by what changed.
+Changes made by the build itself, and in the .snakemake directory, are
+ignored.
+
+With --deploy, the build's *_tree.json and *_meta.json outputs are deployed
+to an S3 URL, as by `nextstrain deploy`, while the build is still running.
+Each output is uploaded to a staging area under the URL as soon as it's
+finished (unchanged for a second or two and complete JSON), so uploads
+overlap with the rest of the build.  Nothing is published until the build
+succeeds: then the staged outputs are copied into place, any not yet
+uploaded are deployed, and CloudFront is purged once for all of them.  If
+the build fails, the staged outputs are deleted.  For example:
+
+    nextstrain build zika/ --deploy s3://my-bucket/zika/
+
+Output of each build is also saved to a compressed log in ~/.nextstrain/logs
+(the 20 most recent are kept).  If the build fails, its last lines of output
+are shown again with the log's location.
+
 The `nextstrain build` command is designed to cleanly separate the Nextstrain
 build interface from Docker itself so that we can more seamlessly use other
 container systems in the future as desired or necessary.
 """
 
+from contextlib import ExitStack
+from pathlib import Path
+from typing import List
+from urllib.parse import urlparse
+from .. import build_cache, build_deploy, rule_containers, runner, watch
+from ..deploy import s3
 from ..runner import docker
-from ..util import warn
+from ..util import warn, colored
+from ..volume import store_volume
+
+
+# Number of changed files named when rebuilding.
+MAX_CHANGES_SHOWN = 5
 
 
 def register_parser(subparser):
@@ -27,10 +81,49 @@ def register_parser(subparser):
         "directory",
         help    = "Path to pathogen build directory",
         metavar = "<directory>",
-        action  = docker.store_volume("build"))
+        action  = store_volume("build"))
+
+    parser.add_argument(
+        "--cache",
+        help    = "Reuse outputs of rules marked `cache: True` from earlier builds with the same inputs",
+        action  = "store_true")
+
+    parser.add_argument(
+        "--cache-remote",
+        help    = "Share the build cache through this S3 URL, with optional prefix.  Implies --cache.",
+        metavar = "<s3://bucket/prefix>")
+
+    parser.add_argument(
+        "--rule-containers",
+        help    = "Run each snakemake job in its own container, limited to the CPUs and memory "
+                  "(`threads` and `resources: mem_mb`) its rule asks for.  Requires --docker.",
+        action  = "store_true")
+
+    parser.add_argument(
+        "--watch",
+        help    = "After building, wait for files in the build directory to change and build again, until interrupted",
+        action  = "store_true")
+
+    parser.add_argument(
+        "--deploy",
+        help    = "Upload the build's *_tree.json and *_meta.json outputs to this S3 URL, "
+                  "with optional prefix, as they're written, and publish them if the build succeeds.  "
+                  "May be given multiple times.",
+        metavar = "<s3://bucket/prefix>",
+        action  = "append",
+        default = [])
+
+    parser.add_argument(
+        "--deploy-from",
+        help    = "Directory of outputs to deploy, relative to the build directory (default: %(default)s)",
+        metavar = "<dir>",
+        type    = Path,
+        default = Path("auspice"))
+
+    s3.register_arguments(parser)
 
     # Runner options
-    docker.register_arguments(
+    runner.register_runners(
         parser,
         exec    = ["snakemake", ...],
         volumes = ["sacra", "fauna", "augur"])
@@ -49,4 +142,109 @@ def run(opts):
 
         return 1
 
-    return docker.run(opts)
+    if (opts.cache or opts.cache_remote or opts.rule_containers) and opts.exec != "snakemake":
+        warn("Error: --cache and --rule-containers require snakemake, not %s." % opts.exec)
+        return 1
+
+    if opts.rule_containers:
+        if opts.__runner__ is not docker:
+            warn("Error: --rule-containers requires the Docker runner.")
+            return 1
+
+        if opts.scratch:
+            warn("Error: --rule-containers can't be used with --scratch, as each container has its own scratch space.")
+            return 1
+
+    cache_url = urlparse(opts.cache_remote) if opts.cache_remote else None
+
+    if cache_url and cache_url.scheme != "s3":
+        warn("Error: Unsupported build cache scheme %s://" % cache_url.scheme)
+        return 1
+
+    s3.configure(opts)
+
+    if opts.deploy:
+        destinations = build_deploy.load_destinations([ urlparse(url) for url in opts.deploy ])
+
+        if not destinations:
+            return 1
+    else:
+        destinations = []
+
+    if opts.cache or opts.cache_remote:
+        env = build_cache.configure(opts, docker = opts.__runner__ is docker)
+    else:
+        env = {}
+
+    with ExitStack() as stack:
+        if opts.rule_containers:
+            stack.enter_context(rule_containers.configure(opts, env))
+
+        status = build(opts, env, cache_url, destinations)
+
+        if not opts.watch:
+            return status
+
+        try:
+            print_watching(opts, status)
+
+            for changed in watch.changes(opts.build.src):
+                print(colored("bold", "Rebuilding after changes to %s" % summarize(changed)))
+                print()
+
+                status = build(opts, env, cache_url, destinations)
+                print_watching(opts, status)
+        except KeyboardInterrupt:
+            print()
+
+    return status
+
+
+def build(opts, env, cache_url, destinations) -> int:
+    """
+    Runs the build once, deploying its outputs to any *destinations* as
+    they're written.  If the build cache is shared, the entries the build
+    needs are fetched first and those it made are stored if it succeeds.
+    """
+    entries = [] # type: List[str]
+
+    if cache_url:
+        wanted = build_cache.wanted(opts, env)
+
+        if wanted is None:
+            return 1
+
+        entries = wanted
+        status  = build_cache.pull(cache_url, entries)
+
+        if status != 0:
+            return status
+
+    if destinations:
+        with build_deploy.streaming(opts.build.src / opts.deploy_from, destinations) as deployer:
+            status        = runner.run(opts, working_volume = opts.build, extra_env = env, log = "build")
+            deploy_status = deployer.finish(status == 0)
+    else:
+        status        = runner.run(opts, working_volume = opts.build, extra_env = env, log = "build")
+        deploy_status = 0
+
+    if cache_url and status == 0:
+        status = build_cache.push(cache_url, entries)
+
+    return status or deploy_status
+
+
+def print_watching(opts, status: int):
+    print()
+    print(colored("green" if status == 0 else "red", "Build exited %d; watching %s for changes…" % (status, opts.build.src)))
+    print()
+
+
+def summarize(paths: List[str]) -> str:
+    """
+    Returns a list of paths for display, abbreviated if it's long.
+    """
+    if len(paths) > MAX_CHANGES_SHOWN:
+        return "%s and %d more" % (", ".join(paths[:MAX_CHANGES_SHOWN]), len(paths) - MAX_CHANGES_SHOWN)
+    else:
+        return ", ".join(paths)
@@ -1,16 +1,19 @@
 """
-Checks your local setup to make sure a container runner is installed and works.
+Checks your local setup to see which runners are installed and work.
 
-Docker is the currently the only supported container system.  It must be
-installed and configured, which this command will test by running:
+Docker is the default runner.  It must be installed and configured, which this
+command will test by running:
 
     docker run --rm hello-world
 
+The native runner, used with --native, requires snakemake, augur, and auspice
+to be installed on this computer, either in a managed environment or on your
+PATH.
 """
 
 from functools import partial
 from ..util import colored, check_for_new_version
-from ..runner import all_runners
+from ..runner import all_runners, runner_name
 
 
 def register_parser(subparser):
@@ -34,23 +37,34 @@ def run(opts):
     # Run and collect our runners' self-tests
     print("Testing your setup…")
 
-    tests = [
-        test for runner in all_runners
-             for test in runner.test_setup()
+    runner_tests = [
+        (runner, runner.test_setup())
+            for runner in all_runners
     ]
 
     # Print test results.  The first print() separates results from the
     # previous header or stderr output, making it easier to read.
     print()
 
-    for description, result in tests:
-        print(status.get(result, " "), description)
+    for runner, tests in runner_tests:
+        print(colored("bold", "# %s" % runner_name(runner)))
 
-    # Print overall status
-    all_good = False not in [result for description, result in tests]
+        for description, result in tests:
+            print(status.get(result, " "), description)
 
-    print()
-    print(success("All good!") if all_good else failure("Some setup tests failed"))
+        print()
+
+    # Print overall status.  Only one runner needs to work.
+    supported = [
+        runner_name(runner)
+            for runner, tests in runner_tests
+             if False not in [result for description, result in tests]
+    ]
+
+    if supported:
+        print(success("All good!  Supported runners: %s" % ", ".join(supported)))
+    else:
+        print(failure("No runners are supported; some setup tests failed"))
 
     # Return a 1 or 0 exit code
-    return int(not all_good)
+    return int(not supported)
@@ -0,0 +1,263 @@
+"""
+Generates a tab completion script for bash or zsh.
+
+The script is static: it completes commands, options, and their values
+without running `nextstrain` itself, so completion is instant.  Print it to
+load it yourself, e.g. in your ~/.bashrc:
+
+    source <(nextstrain completion bash)
+
+or install it with --install, which writes it where bash finds it
+automatically or, for zsh, to a file to source from your ~/.zshrc.  Installed
+scripts are regenerated by `nextstrain update`, so they keep up with new
+versions of this program.
+"""
+
+import argparse
+from pathlib import Path
+from typing import Dict, List
+from ..__version__ import __version__
+from ..paths import COMPLETION_SCRIPTS
+from ..util import colored, warn
+
+
+def register_parser(subparser):
+    parser = subparser.add_parser("completion", help = "Generate a shell completion script")
+    parser.description = __doc__
+
+    parser.add_argument(
+        "shell",
+        help    = "Shell to generate a completion script for",
+        choices = sorted(COMPLETION_SCRIPTS))
+
+    parser.add_argument(
+        "--install",
+        help    = "Install the script instead of printing it",
+        action  = "store_true")
+
+    return parser
+
+
+def run(opts):
+    if not opts.install:
+        print(script(opts.shell), end = "")
+        return 0
+
+    path = install(opts.shell)
+
+    if not path:
+        return 1
+
+    print(colored("green", "Installed %s completion to %s" % (opts.shell, path)))
+
+    if opts.shell == "zsh":
+        print()
+        print("Add the following line to your ~/.zshrc to enable it:")
+        print()
+        print("    source %s" % path)
+
+    return 0
+
+
+def install(shell: str):
+    """
+    Write the completion script for the given shell to its installed
+    location, returning the path or None (after warning why) on error.
+    """
+    path = COMPLETION_SCRIPTS[shell]
+
+    try:
+        path.parent.mkdir(parents = True, exist_ok = True)
+
+        with path.open("w", encoding = "utf-8") as file:
+            file.write(script(shell))
+    except OSError as error:
+        warn("Error installing %s completion: %s" % (shell, error))
+        return None
+
+    return path
+
+
+def refresh_installed() -> None:
+    """
+    Regenerate any installed completion scripts, e.g. after an upgrade adds
+    new commands or options.
+    """
+    for shell, path in sorted(COMPLETION_SCRIPTS.items()):
+        if path.exists():
+            install(shell)
+
+
+def script(shell: str) -> str:
+    """
+    Returns the completion script for the given shell.
+
+    Zsh uses the bash script via its bash completion compatibility layer.
+    """
+    if shell == "zsh":
+        return ZSH_PREAMBLE + bash_script()
+    else:
+        return bash_script()
+
+
+ZSH_PREAMBLE = """\
+autoload -U +X compinit && compinit
+autoload -U +X bashcompinit && bashcompinit
+
+"""
+
+
+def bash_script() -> str:
+    # Imported here, not at the top, because the top-level package imports
+    # this module while it's being initialized.
+    from .. import make_parser
+
+    parser   = make_parser()
+    commands = subcommands(parser)
+
+    cases = [
+        command_case("", parser, sorted(commands)),
+        *[ command_case(name, subparser) for name, subparser in sorted(commands.items()) ],
+    ]
+
+    return BASH_TEMPLATE % {
+        "version":         __version__,
+        "global_options":  "|".join(options_with_values(parser)),
+        "cases":           "".join(cases),
+    }
+
+
+BASH_TEMPLATE = """\
+# Tab completion for the nextstrain program (nextstrain-cli %(version)s).
+# Generated by `nextstrain completion`; regenerate it instead of editing.
+
+_nextstrain() {
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+    local prev="${COMP_WORDS[COMP_CWORD-1]}"
+    local command="" i
+
+    # Find the command, skipping global options and their values.
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        case "${COMP_WORDS[i]}" in
+            %(global_options)s) ((i++)) ;;
+            -*) ;;
+            *) command="${COMP_WORDS[i]}"; break ;;
+        esac
+    done
+
+    COMPREPLY=()
+
+    case "$command" in
+%(cases)s    esac
+}
+
+complete -o filenames -F _nextstrain nextstrain
+"""
+
+
+def command_case(name: str, parser: argparse.ArgumentParser, words: List[str] = []) -> str:
+    """
+    Returns the case branch of the bash script completing the options and
+    arguments of the given (sub)parser.
+
+    When *words* are given, they're completed as the positional argument
+    instead of file names.
+    """
+    option_values = {} # type: Dict[str, List[str]]
+    options       = [] # type: List[str]
+
+    for action in parser._actions:
+        if action.help == argparse.SUPPRESS:
+            continue
+
+        options.extend(action.option_strings)
+
+        if action.option_strings and action.nargs != 0:
+            option_values.setdefault(value_completion(action), []).extend(action.option_strings)
+
+    lines = ["        %s)" % (bash_quote(name) if name else '""')]
+
+    if option_values:
+        lines.append('            case "$prev" in')
+
+        for completion, option_strings in sorted(option_values.items()):
+            lines.append("                %s) %sreturn 0 ;;" % ("|".join(option_strings), completion + "; " if completion else ""))
+
+        lines.append("            esac")
+
+    lines.append('            if [[ $cur == -* ]]; then')
+    lines.append('                COMPREPLY=($(compgen -W %s -- "$cur"))' % bash_quote(" ".join(options)))
+    lines.append("            else")
+    lines.append("                %s" % (compgen_words(words) if words else positional_completion(parser)))
+    lines.append("            fi")
+    lines.append("            ;;")
+
+    return "\n".join(lines) + "\n"
+
+
+def value_completion(action: argparse.Action) -> str:
+    """
+    Returns bash code completing the value of the given option.
+    """
+    metavar = str(action.metavar or "")
+
+    if action.choices:
+        return compgen_words(list(action.choices))
+    elif action.dest == "exec":
+        return 'COMPREPLY=($(compgen -c -- "$cur"))'
+    elif "dir" in metavar:
+        return 'COMPREPLY=($(compgen -d -- "$cur"))'
+    elif action.type is Path or "file" in metavar or metavar.endswith(".json>"):
+        return 'COMPREPLY=($(compgen -f -- "$cur"))'
+    else:
+        # Free-form values, like image names or sizes.
+        return ""
+
+
+def positional_completion(parser: argparse.ArgumentParser) -> str:
+    """
+    Returns bash code completing the positional arguments of the given
+    parser, which are directories or otherwise files.
+    """
+    positionals = [ action for action in parser._actions if not action.option_strings ]
+
+    for action in positionals:
+        if action.choices:
+            return compgen_words(list(action.choices))
+
+    if any("dir" in str(action.metavar or "") for action in positionals):
+        return 'COMPREPLY=($(compgen -d -- "$cur"))'
+
+    return 'COMPREPLY=($(compgen -f -- "$cur"))'
+
+
+def compgen_words(words: List[str]) -> str:
+    return 'COMPREPLY=($(compgen -W %s -- "$cur"))' % bash_quote(" ".join(words))
+
+
+def bash_quote(string: str) -> str:
+    return "'%s'" % string.replace("'", "'\\''")
+
+
+def options_with_values(parser: argparse.ArgumentParser) -> List[str]:
+    """
+    Returns the option strings of the given parser which take a value.
+    """
+    return [
+        option
+            for action in parser._actions
+             if action.nargs != 0
+            for option in action.option_strings
+    ]
+
+
+def subcommands(parser: argparse.ArgumentParser) -> Dict[str, argparse.ArgumentParser]:
+    """
+    Returns a dict of the given parser's subcommand names to their parsers.
+    """
+    return {
+        name: subparser
+            for action in parser._actions
+             if isinstance(action, argparse._SubParsersAction)
+            for name, subparser in action.choices.items()
+    }
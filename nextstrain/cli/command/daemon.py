@@ -0,0 +1,601 @@
+"""
+Runs your builds on this computer from a shared queue.
+
+When several builds (e.g. from cron jobs or different terminals) are started
+on the same machine, running them all at once oversubscribes it, and
+identical builds started at about the same time do the same work twice.
+Instead, start a daemon once:
+
+    nextstrain daemon start --jobs 2 --cpus 16
+
+and submit builds to it, with the same arguments as `nextstrain build`:
+
+    nextstrain daemon build zika/
+
+The daemon runs at most --jobs builds at a time in Docker, each limited to
+an equal share of --cpus.  A build submitted while an identical one (same
+arguments and AWS_* and NEXTSTRAIN_* environment variables, submitted from
+the same working directory) is queued or running is merged into it rather
+than run again.  Every client attached to a build, including those merged
+into it, sees its full output as it's produced and exits with its status.
+A client which is slow to read its output holds up only itself, not the
+build.  Interrupting a client detaches it; the build keeps running for the
+others.
+
+Builds get the AWS_* and NEXTSTRAIN_* environment variables of the client
+which submitted them, such as AWS credentials and NEXTSTRAIN_METRICS, in
+place of the daemon's own.  Other environment variables are the daemon's.
+
+Queued and running builds are saved in ~/.nextstrain/daemon, along with
+those environment variables, and are run again when the daemon is next
+started if it's stopped before they finish.  Each build's output is also
+kept there in logs/<id>.log.
+
+The daemon listens on ~/.nextstrain/daemon.sock by default, or the path
+given by --socket or the NEXTSTRAIN_DAEMON_SOCKET environment variable.
+Builds run as the user who started the daemon, so only that user may use it:
+the socket is only accessible to them and, where the platform allows it, the
+user of each client is checked too.
+"""
+
+import codecs
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+from argparse import REMAINDER
+from pathlib import Path
+from queue import Queue
+from typing import Dict, List, Optional, Tuple
+from ..paths import DAEMON_SOCKET, DAEMON_STATE
+from ..util import warn, colored
+
+
+# Environment variables passed from clients to the builds they submit, by
+# name prefix.
+FORWARDED_ENV = ("AWS_", "NEXTSTRAIN_")
+
+# Most output sent to a client in one message, in bytes.
+CHUNK_SIZE = 64 * 1024
+
+
+def register_parser(subparser):
+    parser = subparser.add_parser("daemon", help = "Run builds from a shared local queue")
+    parser.description = __doc__
+
+    parser.add_argument(
+        "--socket",
+        help    = "Path of the daemon's socket",
+        metavar = "<path>",
+        type    = Path,
+        default = DAEMON_SOCKET)
+
+    actions = parser.add_subparsers(title = "actions", dest = "action")
+
+    start = actions.add_parser("start", help = "Start the daemon and run queued builds")
+
+    start.add_argument(
+        "--jobs",
+        help    = "Run at most this many builds at once",
+        metavar = "<n>",
+        type    = int,
+        default = 1)
+
+    start.add_argument(
+        "--cpus",
+        help    = "Total number of CPUs shared by running builds",
+        metavar = "<n>",
+        type    = float,
+        default = os.cpu_count() or 1)
+
+    build = actions.add_parser("build", help = "Submit a build and follow its output")
+
+    build.add_argument(
+        "build_args",
+        help    = "Arguments for `nextstrain build`",
+        metavar = "...",
+        nargs   = REMAINDER)
+
+    actions.add_parser("status", help = "List queued and running builds")
+
+    return parser
+
+
+def run(opts):
+    if not hasattr(socket, "AF_UNIX"):
+        warn("Error: The daemon requires Unix domain sockets, which aren't supported on this platform.")
+        return 1
+
+    if opts.action == "start":
+        return start(opts.socket, opts.jobs, opts.cpus)
+    elif opts.action == "build":
+        return submit(opts.socket, opts.build_args)
+    elif opts.action == "status":
+        return status(opts.socket)
+    else:
+        warn("Error: An action is required: start, build, or status.")
+        return 1
+
+
+def start(socket_path: Path, jobs: int, cpus: float) -> int:
+    if jobs < 1 or cpus <= 0:
+        warn("Error: --jobs and --cpus must be greater than zero.")
+        return 1
+
+    if socket_path.exists():
+        try:
+            connect(socket_path).close()
+        except OSError:
+            # Left behind by a daemon which didn't exit cleanly.
+            socket_path.unlink()
+        else:
+            warn("Error: A daemon is already listening on %s." % socket_path)
+            return 1
+
+    (DAEMON_STATE / "logs").mkdir(parents = True, exist_ok = True)
+
+    scheduler = Scheduler(jobs, cpus / jobs)
+
+    # Create the socket accessible only to us, as builds run as us.
+    umask = os.umask(0o077)
+
+    try:
+        server = Server(str(socket_path), Handler)
+    finally:
+        os.umask(umask)
+
+    server.scheduler = scheduler
+
+    resumed = scheduler.resume()
+
+    print(colored("bold", "Listening on %s" % socket_path))
+    print("Running %d build(s) at a time with %g CPUs each" % (jobs, scheduler.cpus_per_job))
+
+    if resumed:
+        print("Resuming %d unfinished build(s)" % resumed)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+        print("Stopping; unfinished builds will resume when the daemon next starts.")
+    finally:
+        server.server_close()
+        socket_path.unlink()
+
+    return 0
+
+
+def submit(socket_path: Path, build_args: List[str]) -> int:
+    # Catch bad arguments here instead of in the daemon, and make the build
+    # directory absolute for the daemon's status listing.  Other arguments
+    # (e.g. snakemake's --configfile) may also be relative paths, so the
+    # working directory is part of what makes builds identical.
+    from .. import make_parser
+
+    opts = make_parser().parse_args(["build", *build_args])
+
+    if "--native" in build_args:
+        warn("Error: The daemon runs builds in Docker; --native isn't supported.")
+        return 1
+
+    if not opts.build.src.is_dir():
+        warn("Error: Build path \"%s\" does not exist or is not a directory." % opts.build.src)
+        return 1
+
+    directory = opts.build.src
+    args = [ str(directory.resolve()) if arg != "--" and Path(arg) == directory else arg for arg in build_args ]
+
+    try:
+        conn = connect(socket_path)
+    except OSError as error:
+        warn("Error: Unable to connect to the daemon at %s: %s" % (socket_path, error))
+        warn()
+        warn("Is it running?  Start it with `nextstrain daemon start`.")
+        return 1
+
+    with conn:
+        send(conn, { "action": "build", "args": args, "cwd": os.getcwd(), "env": forwarded_env(os.environ) })
+
+        for message in receive(conn):
+            if "error" in message:
+                warn("Error: %s" % message["error"])
+                return 1
+
+            elif "job" in message:
+                if message["merged"]:
+                    warn(colored("bold", "Following identical build %d already in progress" % message["job"]))
+                else:
+                    warn(colored("bold", "Queued build %d" % message["job"]))
+
+            elif "output" in message:
+                sys.stdout.write(message["output"])
+                sys.stdout.flush()
+
+            elif "status" in message:
+                return message["status"]
+
+    warn("Error: Lost connection to the daemon before the build finished.")
+    return 1
+
+
+def status(socket_path: Path) -> int:
+    try:
+        conn = connect(socket_path)
+    except OSError as error:
+        warn("Error: Unable to connect to the daemon at %s: %s" % (socket_path, error))
+        return 1
+
+    with conn:
+        send(conn, { "action": "status" })
+
+        for message in receive(conn):
+            if "error" in message:
+                warn("Error: %s" % message["error"])
+                return 1
+
+            if not message["jobs"]:
+                print("No builds queued or running.")
+
+            for job in message["jobs"]:
+                print("%5d  %-8s %2d client(s)  %s" % (job["id"], job["state"], job["clients"], " ".join(job["args"])))
+
+            return 0
+
+    warn("Error: Lost connection to the daemon.")
+    return 1
+
+
+def connect(socket_path: Path) -> socket.socket:
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        conn.connect(str(socket_path))
+    except OSError:
+        conn.close()
+        raise
+
+    return conn
+
+
+def forwarded_env(env) -> Dict[str, str]:
+    """
+    Returns the variables in *env* which are passed from clients to builds.
+    """
+    return { name: value for name, value in env.items() if name.startswith(FORWARDED_ENV) }
+
+
+def peer_uid(conn: socket.socket) -> Optional[int]:
+    """
+    Returns the user id of the process at the other end of *conn*, or None if
+    it can't be found on this platform.
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+
+    credentials = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")) # type: ignore
+    pid, uid, gid = struct.unpack("3i", credentials)
+
+    return uid
+
+
+def send(conn: socket.socket, message: dict):
+    """
+    Sends a message as one line of JSON.
+    """
+    conn.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+
+def receive(conn: socket.socket):
+    """
+    Yields each message received until the connection is closed.
+    """
+    with conn.makefile("rb") as lines:
+        for line in lines:
+            yield json.loads(line.decode("utf-8"))
+
+
+class Job:
+    """
+    A build run by the daemon, with the clients following its output.
+
+    Output is written to the job's log, which each client reads from as it's
+    able to, so a client that's slow to read (or stopped) holds up only
+    itself, not the build or other clients.
+    """
+    def __init__(self, id: int, args: List[str], cwd: str, env: Dict[str, str]) -> None:
+        self.id       = id
+        self.args     = args
+        self.cwd      = cwd
+        self.env      = env
+        self.state    = "queued"
+        self.status   = None # type: Optional[int]
+        self.clients  = 0
+        self.written  = 0
+        self.log      = DAEMON_STATE / "logs" / ("%d.log" % id)
+        self.lock     = threading.Lock()
+        self.changed  = threading.Condition(self.lock)
+
+    @property
+    def key(self) -> Tuple[str, ...]:
+        return job_key(self.args, self.cwd, self.env)
+
+    def follow(self, conn: socket.socket):
+        """
+        Sends the output so far to a client, follows along as more is
+        written, and then sends the job's status.
+        """
+        with self.lock:
+            self.clients += 1
+
+            while self.state == "queued":
+                self.changed.wait()
+
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        sent    = 0
+
+        try:
+            with self.log.open("rb") as log:
+                while True:
+                    with self.lock:
+                        while sent == self.written and self.state != "finished":
+                            self.changed.wait()
+
+                        available = self.written - sent
+                        status    = self.status
+
+                    if not available:
+                        break
+
+                    chunk = log.read(min(available, CHUNK_SIZE))
+                    sent += len(chunk)
+
+                    send(conn, { "output": decoder.decode(chunk) })
+
+            rest = decoder.decode(b"", final = True)
+
+            if rest:
+                send(conn, { "output": rest })
+
+            send(conn, { "status": status })
+
+        except OSError:
+            # Client went away; the build carries on regardless.
+            pass
+
+        finally:
+            with self.lock:
+                self.clients -= 1
+
+    def run(self, cpus: float):
+        argv = [
+            sys.executable, "-m", "nextstrain.cli",
+            "build",
+            "--docker",
+            "--docker-arg=--cpus=%g" % cpus,
+            *self.args,
+        ]
+
+        # The client's variables replace, rather than add to, the daemon's.
+        env = {
+            **{ name: value for name, value in os.environ.items() if not name.startswith(FORWARDED_ENV) },
+            **self.env,
+        }
+
+        with self.lock:
+            log = self.log.open("wb")
+            self.state = "running"
+            self.changed.notify_all()
+
+        with log:
+            try:
+                process = subprocess.Popen(
+                    argv,
+                    cwd    = self.cwd,
+                    env    = env,
+                    stdin  = subprocess.DEVNULL,
+                    stdout = subprocess.PIPE,
+                    stderr = subprocess.STDOUT)
+            except OSError as error:
+                self.output(log, ("Error starting build: %s\n" % error).encode("utf-8"))
+                status = 1
+            else:
+                for line in process.stdout: # type: ignore
+                    self.output(log, line)
+
+                status = process.wait()
+
+        with self.lock:
+            self.state  = "finished"
+            self.status = status
+            self.changed.notify_all()
+
+    def output(self, log, line: bytes):
+        with self.lock:
+            log.write(line)
+            log.flush()
+
+            self.written += len(line)
+            self.changed.notify_all()
+
+
+def job_key(args: List[str], cwd: str, env: Dict[str, str]) -> Tuple[str, ...]:
+    """
+    Returns the key identifying identical builds, which are merged.
+
+    The working directory is included because relative paths in *args* are
+    relative to it, and the forwarded environment variables because they
+    can change what the build does or where it deploys.
+    """
+    return (cwd, json.dumps(env, sort_keys = True), *args)
+
+
+class Scheduler:
+    """
+    Runs jobs from a queue with a fixed number of workers, merging duplicate
+    submissions and saving unfinished jobs so they survive a restart.
+    """
+    def __init__(self, jobs: int, cpus_per_job: float) -> None:
+        self.cpus_per_job = cpus_per_job
+        self.lock         = threading.Lock()
+        self.jobs         = {} # type: Dict[Tuple[str, ...], Job]
+        self.queue        = Queue() # type: Queue
+        self.next_id      = 1
+
+        for _ in range(jobs):
+            threading.Thread(target = self.work, daemon = True).start()
+
+    def submit(self, args: List[str], cwd: str, env: Dict[str, str]) -> Tuple[Job, bool]:
+        """
+        Returns the job for the given build and whether it was already queued
+        or running.
+        """
+        with self.lock:
+            key = job_key(args, cwd, env)
+
+            if key in self.jobs:
+                return self.jobs[key], True
+
+            job = self.enqueue(self.next_id, args, cwd, env)
+            self.save()
+
+        return job, False
+
+    def enqueue(self, id: int, args: List[str], cwd: str, env: Dict[str, str]) -> Job:
+        job = Job(id, args, cwd, env)
+        self.jobs[job.key] = job
+        self.next_id = max(self.next_id, id + 1)
+        self.queue.put(job)
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            job.run(self.cpus_per_job)
+
+            with self.lock:
+                del self.jobs[job.key]
+                self.save()
+
+    def list(self) -> List[dict]:
+        with self.lock:
+            return [
+                { "id": job.id, "state": job.state, "clients": job.clients, "args": job.args }
+                    for job in sorted(self.jobs.values(), key = lambda job: job.id)
+            ]
+
+    def save(self):
+        """
+        Saves unfinished jobs.  Must be called with the lock held.
+
+        The file is only readable by us, as the jobs' environment variables
+        may include credentials.
+        """
+        path = DAEMON_STATE / "jobs.json"
+        partial = path.with_name(path.name + ".partial")
+
+        with open(os.open(str(partial), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+            json.dump(
+                [ { "id": job.id, "args": job.args, "cwd": job.cwd, "env": job.env } for job in self.jobs.values() ],
+                file,
+                indent = 2)
+
+        os.replace(str(partial), str(path))
+
+    def resume(self) -> int:
+        """
+        Queues the jobs left unfinished by a previous daemon and returns how
+        many there were.
+        """
+        path = DAEMON_STATE / "jobs.json"
+
+        if not path.exists():
+            return 0
+
+        with path.open() as file:
+            saved = json.load(file)
+
+        with self.lock:
+            for job in sorted(saved, key = lambda job: job["id"]):
+                self.enqueue(job["id"], job["args"], job["cwd"], job.get("env", {}))
+
+        return len(saved)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    scheduler      = None # type: Optional[Scheduler]
+
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        scheduler = self.server.scheduler
+        conn = self.request
+
+        if peer_uid(conn) not in {None, os.getuid()}:
+            send(conn, { "error": "The daemon only accepts requests from the user running it." })
+            return
+
+        try:
+            request = next(receive(conn))
+        except (StopIteration, ValueError):
+            return
+
+        error = invalid_request(request)
+
+        if error:
+            send(conn, { "error": error })
+            return
+
+        if request["action"] == "status":
+            send(conn, { "jobs": scheduler.list() })
+            return
+
+        job, merged = scheduler.submit(request["args"], request["cwd"], request.get("env", {}))
+
+        try:
+            send(conn, { "job": job.id, "merged": merged })
+        except OSError:
+            return
+
+        job.follow(conn)
+
+
+def invalid_request(request) -> Optional[str]:
+    """
+    Returns why *request* is invalid, or None if it's valid.
+    """
+    if not isinstance(request, dict):
+        return "Malformed request"
+
+    if request.get("action") == "status":
+        return None
+
+    if request.get("action") != "build":
+        return "Unknown request"
+
+    args = request.get("args")
+    cwd  = request.get("cwd")
+
+    if not isinstance(args, list) or not all(isinstance(arg, str) for arg in args):
+        return "Build arguments must be a list of strings"
+
+    if "--native" in args:
+        return "The daemon runs builds in Docker; --native isn't supported."
+
+    if not isinstance(cwd, str) or not os.path.isabs(cwd) or not os.path.isdir(cwd):
+        return "Working directory must be an absolute path to an existing directory"
+
+    env = request.get("env", {})
+
+    if not isinstance(env, dict) or not all(isinstance(value, str) for value in env.values()):
+        return "Environment must be an object with string values"
+
+    if forwarded_env(env) != env:
+        return "Only %s* environment variables may be given" % "* and ".join(FORWARDED_ENV)
+
+    return None
@@ -17,6 +17,143 @@ filenames to be prefixed on the remote destination.  For example:
     nextstrain deploy s3://my-bucket/some/prefix/ auspice/zika*.json
 
 will upload files named "some/prefix/zika*.json".
+
+More than one destination may be given, in which case the same files are
+deployed to each of them:
+
+    nextstrain deploy s3://staging-bucket/ s3://production-bucket/ auspice/zika*.json
+
+Each file is read and compressed only once and uploaded to all destinations
+concurrently.  CloudFront distributions shared by several destinations are
+purged once.
+ 
+ 
+Syncing a directory
+-------------------
+
+Instead of a list of files, the --sync option mirrors a whole local directory
+to the destination:
+
+    nextstrain deploy s3://my-bucket/some/prefix/ --sync auspice/
+
+New and changed files are uploaded, unchanged files are skipped, and remote
+files under the prefix which no longer exist locally are deleted.  Paths
+within the directory are kept, e.g. auspice/flu/h3n2_tree.json is uploaded as
+"some/prefix/flu/h3n2_tree.json".
+
+The --include and --exclude options limit which files are considered, both
+locally and remotely, using glob patterns matched against paths relative to
+the directory (and prefix).  Remote files which aren't selected are never
+deleted, nor are the index.json, the manifest.json of immutable deploys (see
+below), or the hashed files it names.
+ 
+ 
+Immutable deploys
+-----------------
+
+Normally, deployed files replace the previous copies and any CloudFront caches
+are invalidated, which can take several minutes.  With --immutable, each file
+is instead uploaded under a new name including a hash of its content, e.g.
+"zika_tree.json" is uploaded as "zika_tree.<hash>.json", which is marked as
+cacheable forever.  A small manifest.json under the prefix maps each file name
+to its current hashed name, and is the only object which changes.  It's
+marked to always be revalidated by caches, so no invalidation is needed.
+Files already deployed with the same content aren't uploaded again.  Like the
+index (below), the manifest is updated so that concurrent deploys to the same
+prefix don't lose each other's entries.
+ 
+ 
+Index
+-----
+
+Each deploy also updates an index.json under the destination prefix, listing
+every file deployed there with its key (relative to the prefix), size, and
+SHA-256 hash before compression, its encoding, and when its content last
+changed, as an ISO 8601 time in UTC:
+
+    {
+        "updated": "2021-03-04T18:02:51.245120+00:00",
+        "files": {
+            "zika_tree.json": {
+                "key": "zika_tree.json",
+                "size": 1234567,
+                "sha256": "3fa9…",
+                "encoding": "gzip",
+                "updated": "2021-03-04T18:02:50.112807+00:00"
+            }
+        }
+    }
+
+Clients can fetch it to find what's deployed instead of listing the bucket.
+It may be cached, but must be revalidated before each use.  Entries for
+files deployed again are updated, and those for files deleted by --sync are
+removed.  Concurrent deploys to the same prefix don't lose each other's
+updates, as long as botocore is from late 2024 or later.
+ 
+ 
+Headers
+-------
+
+Deployed files are given HTTP headers which tell browsers and caches like
+CloudFront how long they may keep copies.  By default, *_tree.json and
+*_meta.json files may be cached by browsers for 5 minutes and by CloudFront
+(which is purged on each deploy) for a day.  The --header-policy option adds
+rules from a JSON file, which can set the CacheControl, Expires, ContentType,
+ContentDisposition, ContentLanguage, and Metadata (custom x-amz-meta-*)
+headers by file name pattern:
+
+    [
+        {
+            "match": ["*_tree.json", "*_meta.json"],
+            "CacheControl": "public, max-age=60"
+        },
+        {
+            "match": "flu_*",
+            "Metadata": { "pathogen": "flu" }
+        }
+    ]
+
+All matching rules apply in order, so later rules override earlier ones.
+ 
+ 
+Interrupted deploys
+-------------------
+
+Large files are uploaded in parts, and progress is recorded locally in
+~/.nextstrain/deploy-journal/.  If a deploy is interrupted, running it again
+resumes any partially uploaded files which haven't changed since, instead of
+starting over.
+
+Parts of uploads which are never finished are kept (and billed) by S3 until
+they're aborted.  The --abort-stale-uploads option aborts all incomplete
+uploads under the destination prefix which were started more than a day ago:
+
+    nextstrain deploy s3://my-bucket/some/prefix/ --abort-stale-uploads
+ 
+ 
+Sharded trees
+-------------
+
+With --shard, each *_tree.json file deployed is also split into chunks which
+can be loaded progressively, as by the `nextstrain shard` command, and the
+chunks are deployed alongside it.
+ 
+ 
+S3-compatible services
+----------------------
+
+Destinations may be on an S3-compatible service other than AWS, such as a
+MinIO server, given by --s3-endpoint (or the NEXTSTRAIN_S3_ENDPOINT
+environment variable):
+
+    nextstrain deploy --s3-endpoint http://minio.example.org:9000 --s3-path-style s3://my-bucket/ auspice/zika*.json
+
+Many such servers need --s3-path-style (or NEXTSTRAIN_S3_PATH_STYLE=1),
+which puts bucket names in the URL path instead of the hostname.
+
+CloudFront is only looked for when deploying to AWS, unless --cloudfront is
+given.  Use --no-cloudfront to skip it for AWS buckets which aren't behind
+CloudFront, which also avoids needing permission to list distributions.
  
  
 Authentication
@@ -42,15 +179,26 @@ A persistent credentials file, ~/.aws/credentials, is also supported:
 """
 
 from pathlib import Path
-from urllib.parse import urlparse
+from tempfile import TemporaryDirectory
+from typing import Dict, List
+from urllib.parse import urlparse, ParseResult
 from ..util import warn
-from ..deploy import s3
+from .. import metrics, sharding
+from ..deploy import s3, policy
 
 
 SUPPORTED_SCHEMES = {
     "s3": s3,
 }
 
+DEPLOY_METRICS = [
+    "deploy_files_uploaded",
+    "deploy_files_skipped",
+    "deploy_files_deleted",
+    "deploy_bytes_uploaded",
+    "deploy_bytes_skipped",
+]
+
 
 def register_parser(subparser):
     parser = subparser.add_parser("deploy", help = "Deploy pathogen build")
@@ -59,7 +207,8 @@ def register_parser(subparser):
     # Destination
     parser.add_argument(
         "destination",
-        help    = "Deploy destination as a URL, with optional key/path prefix",
+        help    = "Deploy destination as a URL, with optional key/path prefix.  "
+                  "Additional destination URLs may follow it, before any files.",
         metavar = "<s3://bucket-name>")
 
     # Files to deploy
@@ -67,21 +216,154 @@ def register_parser(subparser):
         "files",
         help    = "JSON data files to deploy",
         metavar = "<file.json>",
-        nargs   = "+")
+        nargs   = "*")
+
+    parser.add_argument(
+        "--sync",
+        help    = "Mirror this directory to the destination instead of deploying a list of files",
+        metavar = "<dir>",
+        type    = Path)
+
+    parser.add_argument(
+        "--include",
+        help    = "Only sync files matching this glob pattern.  May be given multiple times.",
+        metavar = "<pattern>",
+        action  = "append",
+        default = [])
+
+    parser.add_argument(
+        "--exclude",
+        help    = "Don't sync files matching this glob pattern.  May be given multiple times.",
+        metavar = "<pattern>",
+        action  = "append",
+        default = [])
+
+    parser.add_argument(
+        "--header-policy",
+        help    = "JSON file of rules for setting headers, like Cache-Control, on deployed files",
+        metavar = "<file.json>",
+        type    = Path)
+
+    parser.add_argument(
+        "--immutable",
+        help    = "Upload files under content-addressed names and update a manifest pointing to them, instead of replacing files in place",
+        action  = "store_true")
+
+    parser.add_argument(
+        "--shard",
+        help    = "Also deploy chunks of each *_tree.json file for progressive loading, as made by `nextstrain shard`",
+        action  = "store_true")
+
+    parser.add_argument(
+        "--abort-stale-uploads",
+        help    = "Abort incomplete uploads under the destination which were started more than a day ago, instead of deploying",
+        action  = "store_true")
+
+    s3.register_arguments(parser)
+
+    # Set by nextstrain.cli.api, which knows which arguments are destinations.
+    parser.set_defaults(destinations = None)
 
     return parser
 
 
 def run(opts):
-    url = urlparse(opts.destination)
+    # Report zeros, rather than nothing, for whatever this deploy doesn't do.
+    for name in DEPLOY_METRICS:
+        metrics.add(name, 0)
+
+    files = list(opts.files)
+
+    # Leading arguments which look like URLs are additional destinations,
+    # unless the destinations were given separately by the Python API.
+    if opts.destinations:
+        destinations = list(opts.destinations)
+    else:
+        destinations = [opts.destination]
+
+        while files and "://" in files[0]:
+            destinations.append(files.pop(0))
+
+    if opts.abort_stale_uploads and (opts.sync or files):
+        warn("Error: Files to deploy may not be given with --abort-stale-uploads.")
+        return 1
+
+    if opts.sync and files:
+        warn("Error: Files to deploy may not be given with --sync.")
+        return 1
 
-    if url.scheme not in SUPPORTED_SCHEMES:
-        warn("Error: Unsupported destination scheme %s://" % url.scheme)
-        warn("")
-        warn("Supported schemes are: %s" % ", ".join(SUPPORTED_SCHEMES))
+    if not opts.sync and not files and not opts.abort_stale_uploads:
+        warn("Error: No files to deploy.")
         return 1
 
-    deploy = SUPPORTED_SCHEMES[url.scheme]
-    files  = [Path(f) for f in opts.files]
+    if opts.sync and opts.immutable:
+        warn("Error: --immutable may not be used with --sync.")
+        return 1
+
+    if opts.shard and (opts.sync or opts.immutable or opts.abort_stale_uploads):
+        warn("Error: --shard may only be used when deploying a list of files.")
+        return 1
+
+    if opts.sync and not opts.sync.is_dir():
+        warn("Error: Sync path \"%s\" does not exist or is not a directory." % opts.sync)
+        return 1
+
+    # Group destination URLs by backend, keeping the order given and dropping
+    # duplicates.
+    urls_by_scheme = {} # type: Dict[str, List[ParseResult]]
+
+    for destination in destinations:
+        url = urlparse(destination)
+
+        if url.scheme not in SUPPORTED_SCHEMES:
+            warn("Error: Unsupported destination scheme %s://" % url.scheme)
+            warn("")
+            warn("Supported schemes are: %s" % ", ".join(SUPPORTED_SCHEMES))
+            return 1
+
+        urls = urls_by_scheme.setdefault(url.scheme, [])
+
+        if url not in urls:
+            urls.append(url)
+
+    s3.configure(opts)
+
+    try:
+        header_policy = policy.load(opts.header_policy) if opts.header_policy else policy.DEFAULT_POLICY
+    except (OSError, ValueError) as error:
+        warn("Error: Unable to load header policy: %s" % error)
+        return 1
+
+    with TemporaryDirectory(prefix = "nextstrain-shards-") as shard_dir:
+        local_files = [Path(f) for f in files]
+
+        if opts.shard:
+            for tree in [ f for f in local_files if f.name.endswith("_tree.json") ]:
+                try:
+                    local_files += sharding.shard(tree, Path(shard_dir))
+                except (OSError, ValueError) as error:
+                    warn("Error: Unable to shard %s: %s" % (tree, error))
+                    return 1
+
+        return deploy_to(urls_by_scheme, opts, local_files, header_policy)
+
+
+def deploy_to(urls_by_scheme: Dict[str, List[ParseResult]], opts, local_files: List[Path], header_policy: List[dict]) -> int:
+    """
+    Deploy to the destination URLs of each scheme in turn, stopping at the
+    first failure.
+    """
+    for scheme, urls in urls_by_scheme.items():
+        deploy = SUPPORTED_SCHEMES[scheme]
+
+        if opts.abort_stale_uploads:
+            status = max(deploy.abort_stale_uploads(url) for url in urls)
+        elif opts.sync:
+            status = deploy.sync(urls, opts.sync, opts.include, opts.exclude, header_policy)
+        else:
+            status = deploy.run(urls, local_files, immutable = opts.immutable, policy = header_policy)
+
+        if status != 0:
+            return status
 
-    return deploy.run(url, files)
+    return 0
@@ -0,0 +1,83 @@
+"""
+Downloads a deployed pathogen build to a local directory.
+
+This is the reverse of `nextstrain deploy`.  Every file under the remote URL
+(an S3 bucket with an optional prefix) is downloaded into the directory,
+which can then be viewed with `nextstrain view`, for example:
+
+    nextstrain fetch s3://nextstrain-data/zika/ zika-data/
+    nextstrain view zika-data/
+
+Downloads run concurrently, with large files downloaded in concurrent ranges.
+Files deployed compressed are decompressed.  What was fetched is recorded in
+a .nextstrain-fetch.json file in the directory, so fetching again only
+downloads files which changed remotely (by ETag) or were changed locally.
+
+The index.json kept by `nextstrain deploy` isn't fetched, nor are the
+manifest.json and hashed files of immutable deploys.
+
+Use --include and --exclude to fetch only some files, with patterns matched
+against names relative to the remote prefix.
+
+The same AWS credentials and S3 options as `nextstrain deploy` are used.
+"""
+
+from pathlib import Path
+from urllib.parse import urlparse
+from ..util import warn
+from ..deploy import s3
+from .deploy import SUPPORTED_SCHEMES
+
+
+def register_parser(subparser):
+    parser = subparser.add_parser("fetch", help = "Download a deployed pathogen build")
+    parser.description = __doc__
+
+    parser.add_argument(
+        "source",
+        help    = "Remote URL to fetch from, e.g. s3://bucket/prefix/",
+        metavar = "<s3://bucket>")
+
+    parser.add_argument(
+        "directory",
+        help    = "Local directory to fetch into, created if necessary",
+        metavar = "<directory>",
+        type    = Path)
+
+    parser.add_argument(
+        "--include",
+        help    = "Only fetch files matching this glob pattern.  May be given multiple times.",
+        metavar = "<pattern>",
+        action  = "append",
+        default = [])
+
+    parser.add_argument(
+        "--exclude",
+        help    = "Don't fetch files matching this glob pattern.  May be given multiple times.",
+        metavar = "<pattern>",
+        action  = "append",
+        default = [])
+
+    s3.register_arguments(parser, cloudfront = False)
+
+    return parser
+
+
+def run(opts):
+    url = urlparse(opts.source)
+
+    if url.scheme not in SUPPORTED_SCHEMES:
+        warn("Error: Unsupported source scheme %s://" % url.scheme)
+        warn("")
+        warn("Supported schemes are: %s" % ", ".join(SUPPORTED_SCHEMES))
+        return 1
+
+    if opts.directory.exists() and not opts.directory.is_dir():
+        warn("Error: Path \"%s\" is not a directory." % opts.directory)
+        return 1
+
+    s3.configure(opts)
+
+    backend = SUPPORTED_SCHEMES[url.scheme]
+
+    return backend.fetch(url, opts.directory, opts.include, opts.exclude)
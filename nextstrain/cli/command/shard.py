@@ -0,0 +1,80 @@
+"""
+Splits tree JSON files into chunks for progressive loading.
+
+Very large trees (e.g. tens of thousands of tips) take a long time for a
+browser to download and parse before anything is shown.  This command splits
+each given <prefix>_tree.json into a skeleton of the top of the tree plus
+shards of subtrees, with node attributes stored in separate chunks, and an
+index describing them all:
+
+    <prefix>_tree.index.json
+    <prefix>_tree.skeleton.json
+    <prefix>_tree.skeleton.attr.json
+    <prefix>_tree.shard-<id>.json
+    <prefix>_tree.shard-<id>.attr.json
+
+A client which supports progressive loading can fetch the index and skeleton
+first and the rest as needed.  The original tree file is left in place for
+clients which don't.
+
+Each shard's <id> is a hash of its content, so sharding a new version of a
+tree gives the same files for subtrees which didn't change, which clients can
+keep using from their caches.  Shards left over from sharding the previous
+version are removed.
+
+By default, chunks are written alongside each tree, so they're served by
+`nextstrain view` from the same data directory.  Use `nextstrain deploy
+--shard` to shard trees as they're deployed.
+"""
+
+from pathlib import Path
+from ..util import warn
+from .. import sharding
+
+
+def register_parser(subparser):
+    parser = subparser.add_parser("shard", help = "Split tree JSON for progressive loading")
+    parser.description = __doc__
+
+    parser.add_argument(
+        "trees",
+        help    = "Tree JSON files to split",
+        metavar = "<prefix_tree.json>",
+        nargs   = "+",
+        type    = Path)
+
+    parser.add_argument(
+        "--max-tips",
+        help    = "Split off subtrees with at most this many tips",
+        metavar = "<n>",
+        type    = int,
+        default = sharding.MAX_TIPS)
+
+    parser.add_argument(
+        "--output-dir",
+        help    = "Write chunks to this directory instead of alongside each tree",
+        metavar = "<dir>",
+        type    = Path)
+
+    return parser
+
+
+def run(opts):
+    if opts.max_tips < 1:
+        warn("Error: --max-tips must be at least 1.")
+        return 1
+
+    if opts.output_dir and not opts.output_dir.is_dir():
+        warn("Error: Output path \"%s\" does not exist or is not a directory." % opts.output_dir)
+        return 1
+
+    for tree in opts.trees:
+        try:
+            paths = sharding.shard(tree, opts.output_dir, opts.max_tips)
+        except (OSError, ValueError) as error:
+            warn("Error: Unable to shard %s: %s" % (tree, error))
+            return 1
+
+        print("Split %s into %d chunks indexed by %s" % (tree, len(paths) - 1, paths[0]))
+
+    return 0
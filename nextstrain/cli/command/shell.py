@@ -3,10 +3,12 @@ Start a new shell inside the Nextstrain containerized build environment to
 run ad-hoc commands and perform debugging.
 
 The shell runs inside a container, which requires Docker.  Run `nextstrain
-check-setup` to check if Docker is installed and works.
+check-setup` to check if Docker is installed and works.  With the --native
+option, the shell instead runs directly on this computer.
 """
 
-from ..runner import docker
+from .. import runner
+from ..volume import store_volume
 
 
 def register_parser(subparser):
@@ -18,10 +20,10 @@ def register_parser(subparser):
         "directory",
         help    = "Path to pathogen build directory",
         metavar = "<directory>",
-        action  = docker.store_volume("build"))
+        action  = store_volume("build"))
 
     # Runner options
-    docker.register_arguments(
+    runner.register_runners(
         parser,
         exec    = ["bash", "--login", ...],
         volumes = ["sacra", "fauna", "augur", "auspice"])
@@ -30,4 +32,4 @@ def register_parser(subparser):
 
 
 def run(opts):
-    return docker.run(opts)
+    return runner.run(opts, working_volume = opts.build)
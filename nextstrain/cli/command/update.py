@@ -2,31 +2,68 @@
 Updates your local copy of the default container image.
 
 This may take several minutes as the layers of the image are downloaded.
+
+To avoid every computer in a fleet downloading the image separately, or to
+update computers without network access, export the image from one computer
+to a compressed archive with --export and then update the others from it with
+--from-archive:
+
+    nextstrain update --export nextstrain-base.tar.zst
+    nextstrain update --from-archive nextstrain-base.tar.zst
+
+Loading is skipped if the local image already matches the archive.  Both
+options require zstd to be installed.
 """
 
 from functools import partial
+from pathlib import Path
 from ..util import colored, check_for_new_version
-from ..runner import all_runners
+from ..runner import all_runners, docker
+from . import completion
 
 
 def register_parser(subparser):
     parser = subparser.add_parser("update", help = "Update your local image copy")
     parser.description = __doc__
+
+    archive = parser.add_mutually_exclusive_group()
+
+    archive.add_argument(
+        "--export",
+        help    = "Save your local Docker image to a compressed archive <file> instead of updating",
+        metavar = "<file>",
+        type    = Path)
+
+    archive.add_argument(
+        "--from-archive",
+        help    = "Update the Docker image from an archive <file> made by --export instead of downloading it",
+        metavar = "<file>",
+        type    = Path)
+
     return parser
 
 
 def run(opts):
-    # Check our own version for updates
-    newer_version = check_for_new_version()
+    if opts.export:
+        return int(not docker.export_image(opts.export))
+
+    # Check our own version for updates, unless we might be offline
+    newer_version = check_for_new_version() if not opts.from_archive else None
 
     success = partial(colored, "green")
     failure = partial(colored, "red")
     notice  = partial(colored, "yellow")
 
-    statuses = [
-        runner.update()
-            for runner in all_runners
-    ]
+    if opts.from_archive:
+        statuses = [ docker.update_from_archive(opts.from_archive) ]
+    else:
+        statuses = [
+            runner.update()
+                for runner in all_runners
+        ]
+
+    # Keep any installed shell completion up to date with this version
+    completion.refresh_installed()
 
     # Print overall status
     all_good = False not in statuses
@@ -7,13 +7,16 @@ The data directory should contain sets of files with at least two files:
     <prefix>_meta.json
 
 The viewer runs inside a container, which requires Docker.  Run `nextstrain
-check-setup` to check if Docker is installed and works.
+check-setup` to check if Docker is installed and works.  With the --native
+option, the viewer instead runs directly on this computer.
 """
 
 import re
 import netifaces as net
-from ..runner import docker
+from .. import runner
+from ..runner import docker, native
 from ..util import colored, warn
+from ..volume import store_volume
 
 
 def register_parser(subparser):
@@ -30,10 +33,10 @@ def register_parser(subparser):
         "directory",
         help    = "Path to pathogen build data directory",
         metavar = "<directory>",
-        action  = docker.store_volume("auspice/data"))
+        action  = store_volume("auspice/data"))
 
     # Runner options
-    docker.register_arguments(
+    runner.register_runners(
         parser,
         exec    = ["auspice"],
         volumes = ["auspice"])
@@ -60,29 +63,40 @@ def run(opts):
             for path in data_dir.glob("*_tree.json")
     ]
 
-    # Setup the published port.  Default to localhost for security reasons
-    # unless explicitly told otherwise.
-    #
-    # There are docker-specific implementation details here that should be
-    # refactored once we have more than one nextstrain.cli.runner module in
-    # play.  Doing that work now would be premature; we'll get a better
-    # interface for ports/environment when we have concrete requirements.
-    #   -trs, 27 June 2018
+    # Setup the listening address and port.  Default to localhost for
+    # security reasons unless explicitly told otherwise.
     host = "0.0.0.0" if opts.allow_remote_access else "127.0.0.1"
     port = 4000
 
-    if opts.docker_args is None:
-        opts.docker_args = []
+    # HOST and PORT are respected by auspice's server.  Inside a container,
+    # auspice must listen on all interfaces and access is instead restricted
+    # by where the port is published.
+    env = {
+        "HOST": host,
+        "PORT": str(port),
+    }
 
-    opts.docker_args = [
-        *opts.docker_args,
+    if opts.__runner__ is docker:
+        env["HOST"] = "0.0.0.0"
 
-        # PORT is respected by auspice's server.js
-        "--env=PORT=%d" % port,
+        if opts.docker_args is None:
+            opts.docker_args = []
 
-        # Publish the port
-        "--publish=%s:%d:%d" % (host, port, port),
-    ]
+        opts.docker_args = [
+            *opts.docker_args,
+
+            # Publish the port
+            "--publish=%s:%d:%d" % (host, port, port),
+        ]
+
+    # The image's auspice serves the data volume mounted into the container.
+    # Natively, there's no such volume, so point auspice at the data directory.
+    if opts.__runner__ is native:
+        opts.exec_args = [
+            *opts.exec_args,
+            "view",
+            "--datasetDir", str(data_dir.resolve()),
+        ]
 
     # Find the best remote address if we're allowing remote access.  While we
     # listen on all interfaces (0.0.0.0), only the local host can connect to
@@ -100,7 +114,7 @@ def run(opts):
     # Show a helpful message about where to connect
     print_url(host, port, datasets)
 
-    return docker.run(opts)
+    return runner.run(opts, working_volume = opts.auspice_data, extra_env = env)
 
 
 def print_url(host, port, datasets):
@@ -0,0 +1,45 @@
+"""
+Deploy backends and the helpers shared between them.
+
+Each backend module provides:
+
+    run(urls, local_files, immutable, policy) -> int
+    sync(urls, local_dir, include, exclude, policy) -> int
+    abort_stale_uploads(url) -> int
+    fetch(url, local_dir, include, exclude) -> int
+
+and is registered by URL scheme in nextstrain.cli.command.deploy.  The run()
+and sync() functions are given all destination URLs with the backend's scheme
+at once, so that each file need only be read and encoded once.  The fetch()
+function is the reverse, used by the fetch command to download what was
+deployed.
+"""
+
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+
+def walk(directory: Path) -> Iterable[Tuple[str, Path]]:
+    """
+    Yields (name, path) tuples for all files under the given directory,
+    recursively, where name is the path relative to the directory using
+    forward slashes regardless of platform.
+    """
+    for path in sorted(directory.rglob("*")):
+        if path.is_file():
+            yield path.relative_to(directory).as_posix(), path
+
+
+def selected(name: str, include: List[str], exclude: List[str]) -> bool:
+    """
+    Test if the given relative name is selected by the include and exclude
+    glob patterns.
+
+    A name is selected if it matches any of the include patterns (or there are
+    none) and doesn't match any of the exclude patterns.  Note that * in the
+    patterns also matches /, so "*.json" matches JSON files in subdirectories
+    too.
+    """
+    return (not include or any(fnmatchcase(name, pattern) for pattern in include)) \
+       and not any(fnmatchcase(name, pattern) for pattern in exclude)
@@ -0,0 +1,62 @@
+"""
+Local journal of in-progress multipart uploads, so interrupted deploys can be
+resumed.
+
+Each entry is a small JSON file under paths.DEPLOY_JOURNAL, named for the
+destination it describes, recording the upload id, the hash of the source
+file, and the parts completed so far.
+"""
+
+import json
+import os
+from hashlib import sha1
+from pathlib import Path
+from typing import Optional
+from ..paths import DEPLOY_JOURNAL
+
+
+def entry_path(bucket: str, key: str) -> Path:
+    """
+    Returns the path of the journal entry for the given bucket and key.
+    """
+    return DEPLOY_JOURNAL / ("%s.json" % sha1(("%s/%s" % (bucket, key)).encode("utf-8")).hexdigest())
+
+
+def read(bucket: str, key: str) -> Optional[dict]:
+    """
+    Returns the journal entry for the given bucket and key, or None if there
+    isn't one (or it's unreadable).
+    """
+    try:
+        with entry_path(bucket, key).open() as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write(bucket: str, key: str, entry: dict) -> None:
+    """
+    Record the journal entry for the given bucket and key.
+
+    The entry is written to a temporary file first and then moved into
+    place, so a crash mid-write never leaves a truncated entry behind.
+    """
+    path = entry_path(bucket, key)
+    path.parent.mkdir(parents = True, exist_ok = True)
+
+    tmp = path.with_suffix(".tmp")
+
+    with tmp.open("w") as file:
+        json.dump({ **entry, "bucket": bucket, "key": key }, file)
+
+    os.replace(str(tmp), str(path))
+
+
+def remove(bucket: str, key: str) -> None:
+    """
+    Remove the journal entry, if any, for the given bucket and key.
+    """
+    try:
+        entry_path(bucket, key).unlink()
+    except FileNotFoundError:
+        pass
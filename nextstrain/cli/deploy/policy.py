@@ -0,0 +1,101 @@
+"""
+Per-file HTTP header policy for deployed files.
+
+A policy is a list of rules, each of which is a dict with a "match" glob
+pattern (or list of patterns) and the headers to set on matching files, for
+example:
+
+    [
+        {
+            "match": ["*_tree.json", "*_meta.json"],
+            "CacheControl": "public, max-age=300, s-maxage=86400"
+        },
+        {
+            "match": "flu/*",
+            "Metadata": { "pathogen": "flu" }
+        }
+    ]
+
+Patterns are matched against the file's name relative to the destination
+prefix.  All matching rules apply in order, so later rules override earlier
+ones.  Metadata (custom x-amz-meta-* headers) is merged rather than replaced.
+"""
+
+import json
+import mimetypes
+from fnmatch import fnmatchcase
+from pathlib import Path
+from typing import Dict, List
+
+
+# Headers which may be set by a rule, named as in S3's API.
+HEADERS = {
+    "CacheControl",
+    "ContentDisposition",
+    "ContentLanguage",
+    "ContentType",
+    "Expires",
+    "Metadata",
+}
+
+# Browsers should check back for new data every few minutes.  Since the deploy
+# command invalidates CloudFront's caches after uploading, CloudFront itself
+# can keep copies much longer.
+DEFAULT_POLICY = [
+    {
+        "match": ["*_tree.json", "*_tree.*.json", "*_meta.json"],
+        "CacheControl": "public, max-age=300, s-maxage=86400",
+    },
+]
+
+
+def load(path: Path) -> List[dict]:
+    """
+    Returns the default policy extended by the rules in the given JSON file.
+
+    Raises a ValueError if the file doesn't contain a valid policy.
+    """
+    with path.open() as file:
+        rules = json.load(file)
+
+    if not isinstance(rules, list):
+        raise ValueError("%s: policy must be a list of rules" % path)
+
+    for rule in rules:
+        if not isinstance(rule, dict) or "match" not in rule:
+            raise ValueError("%s: each rule must be an object with a \"match\" pattern" % path)
+
+        unknown = set(rule) - HEADERS - {"match"}
+
+        if unknown:
+            raise ValueError("%s: unknown header(s) in rule: %s" % (path, ", ".join(sorted(unknown))))
+
+    return [*DEFAULT_POLICY, *rules]
+
+
+def headers_for(policy: List[dict], name: str) -> Dict:
+    """
+    Returns the S3 object headers for the given file name according to the
+    given policy.
+
+    ContentType defaults to a guess based on the file extension.
+    """
+    headers = {
+        "ContentType": mimetypes.guess_type(name)[0] or "application/octet-stream",
+        "Metadata": {},
+    } # type: Dict
+
+    for rule in policy:
+        patterns = [rule["match"]] if isinstance(rule["match"], str) else rule["match"]
+
+        if any(fnmatchcase(name, pattern) for pattern in patterns):
+            for header, value in rule.items():
+                if header == "Metadata":
+                    headers["Metadata"].update(value)
+                elif header != "match":
+                    headers[header] = value
+
+    if not headers["Metadata"]:
+        del headers["Metadata"]
+
+    return headers
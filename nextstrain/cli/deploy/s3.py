@@ -1,126 +1,1385 @@
 """
-Deploy to S3 with automatic CloudFront invalidation.
+Deploy to S3 (or an S3-compatible service) with automatic CloudFront
+invalidation.
 
 Backend module for the deploy command.
 """
 
 import boto3
+import json
+import os
+import random
 import re
-import shutil
+import threading
 import urllib.parse
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError, WaiterError
-from gzip import GzipFile
+import weakref
+from base64 import b64encode
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError, NoCredentialsError, PartialCredentialsError, WaiterError
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from gzip import GzipFile, decompress
+from hashlib import md5, sha256
 from io import BytesIO
 from os.path import commonprefix
 from pathlib import Path
-from time import time
-from typing import List
+from time import perf_counter, sleep, time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from .. import metrics, trace
 from ..util import warn, remove_prefix
+from . import journal, walk, selected
+from .policy import DEFAULT_POLICY, headers_for
 
 
-def run(url: urllib.parse.ParseResult, local_files: List[Path]) -> int:
-    # Require a bucket name
-    if not url.netloc:
-        warn("No bucket name specified in url (%s)" % url.geturl())
+# Objects of this size or larger are uploaded in parts of this size.  This
+# determines the ETag S3 assigns, which we compare to detect changes.
+PART_SIZE = 8 * 1024 * 1024
+
+# Local files are read in chunks of this size, which are hashed and
+# compressed as they're read.
+READ_SIZE = 1024 * 1024
+
+# Number of parts of a multipart upload to send concurrently.
+PART_CONCURRENCY = 8
+
+# Incomplete multipart uploads older than this are considered abandoned.
+STALE_UPLOAD_AGE = timedelta(days = 1)
+
+# DeleteObjects accepts at most this many keys per request.
+DELETE_BATCH_SIZE = 1000
+
+# Content-addressed objects never change, so may be cached forever.  The
+# manifest pointing to them must always be revalidated, and is updated like
+# the index below.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MANIFEST_CACHE_CONTROL  = "no-cache"
+MANIFEST_NAME           = "manifest.json"
+
+# Every deploy updates an index of the files deployed under the prefix, so
+# clients can find what's there without listing the bucket.  It may be
+# cached, but must be revalidated (cheaply, by ETag) so it's never stale.
+INDEX_NAME          = "index.json"
+INDEX_CACHE_CONTROL = "public, no-cache"
+
+# Writes to the index and manifest are conditional on them not having changed
+# since they were read, and retried this many times if another deploy changed
+# them first.
+WRITE_ATTEMPTS = 5
+WRITE_BACKOFF  = 0.1   # seconds, doubled for each attempt
+
+# Where `build --deploy` uploads outputs under each destination prefix while
+# the build runs, until they're copied into place if it succeeds.  Ignored by
+# sync and fetch.
+STAGING_PREFIX = ".staging/"
+
+# Number of objects fetched concurrently, and the name of the file in the
+# local directory which records what was fetched.
+FETCH_CONCURRENCY = 8
+FETCH_CACHE_NAME  = ".nextstrain-fetch.json"
+
+# S3-compatible endpoint (e.g. a MinIO server) used instead of AWS's, whether
+# to address buckets by path instead of by hostname, and whether to purge
+# CloudFront (None for automatically, i.e. only when using AWS's endpoint).
+# Set from command-line options by configure().
+ENDPOINT_URL = None  # type: Optional[str]
+PATH_STYLE   = False
+CLOUDFRONT   = None  # type: Optional[bool]
+
+# boto3 session to connect with, or None for the default session.  Set by
+# the Python API (nextstrain.cli.api), which may reuse one across calls.
+SESSION = None  # type: Optional[boto3.session.Session]
+
+# Connections made by resource() and cloudfront_client() with each session,
+# reused by later calls with the same session and endpoint settings.  They're
+# dropped along with the session once nothing else refers to it.
+_connections      = weakref.WeakKeyDictionary() # type: weakref.WeakKeyDictionary
+_connections_lock = threading.Lock()
+
+
+# A bucket and key prefix to deploy to.  S3 is a key-value store, not a
+# filesystem, so remote names are formed by pure string prefixing instead of
+# path-based prefixing (which assumes directory structure semantics).
+Destination = namedtuple("Destination", ("bucket", "prefix"))
+
+
+# A file uploaded, skipped as unchanged, copied into place, or deleted, as
+# recorded while recording.  The *action* is one of "uploaded", "skipped",
+# "copied", or "deleted", the *size* is that of the compressed object, and
+# *seconds* is the time taken to upload or copy it (zero for other actions).
+# Files staged by `build --deploy` are uploaded, copied, and deleted under
+# STAGING_PREFIX.
+DeployedFile = namedtuple("DeployedFile", ("action", "bucket", "key", "size", "seconds"))
+
+# A CloudFront invalidation created while recording, and whether it had
+# completed when we stopped waiting for it.
+Invalidation = namedtuple("Invalidation", ("distribution_id", "invalidation_id", "path", "completed"))
+
+
+# The result of encode(): the gzip-compressed *data*, the SHA-256 hex digest
+# of the original content as *source_hash*, and the binary MD5 digests of the
+# compressed data as a whole (*md5*) and of each PART_SIZE part (*part_md5s*).
+Encoded = namedtuple("Encoded", ("data", "source_hash", "md5", "part_md5s"))
+
+
+def run(urls: List[urllib.parse.ParseResult], local_files: List[Path], immutable: bool = False, policy: List[dict] = DEFAULT_POLICY) -> int:
+    """
+    Deploy the local files to each of the destination URLs.
+
+    Each file is read and compressed once, and then uploaded to all
+    destinations concurrently.
+    """
+    destinations = load_destinations(urls)
+
+    if not destinations:
+        return 1
+
+    if immutable:
+        return deploy_immutable(local_files, destinations, policy)
+
+    # Upload files
+    index        = {} # type: Dict[str, dict]
+    remote_files = upload(local_files, destinations, policy, index)
+
+    status = 0
+
+    for destination in destinations:
+        status = update_index(destination.bucket, destination.prefix, index) or status
+
+    # Purge any CloudFront caches for these buckets
+    purge_cloudfront(remote_files)
+
+    return status
+
+
+def sync(urls: List[urllib.parse.ParseResult], local_dir: Path, include: List[str], exclude: List[str], policy: List[dict] = DEFAULT_POLICY) -> int:
+    """
+    Make the objects under each URL's prefix mirror the files in *local_dir*.
+
+    New and changed files are uploaded, unchanged files are skipped, and
+    objects which no longer have a corresponding local file are deleted.
+    Only files and objects selected by the *include* and *exclude* patterns,
+    matched against names relative to the directory and prefix, are
+    considered.  Each file is compressed once, no matter how many
+    destinations it's uploaded to.
+    """
+    local_files = {
+        name: path
+            for name, path in walk(local_dir)
+             if selected(name, include, exclude)
+    }
+
+    # Refuse to proceed, since it would delete everything under the prefix.
+    # This is almost certainly a mistake in the directory or patterns given.
+    if not local_files:
+        warn("Error: No files selected in %s; refusing to delete everything remote." % local_dir)
+        return 1
+
+    destinations = load_destinations(urls)
+
+    if not destinations:
+        return 1
+
+    # List everything under each prefix at once, so we don't need a request
+    # per file.
+    def list_selected(destination):
+        return {
+            name: object
+                for name, object in list_files(destination).items()
+                 if selected(name, include, exclude)
+        }
+
+    remote_objects = dict(zip(destinations, fan_out(destinations, list_selected)))
+
+    uploaded = { destination: [] for destination in destinations } # type: Dict[Destination, List[str]]
+    skipped  = { destination: [] for destination in destinations } # type: Dict[Destination, List[str]]
+    indexed  = { destination: {} for destination in destinations } # type: Dict[Destination, Dict[str, dict]]
+
+    for name, local_file in sorted(local_files.items()):
+        with local_file.open("rb") as data:
+            encoded = encode(data)
+
+        encoded_etag = etag(encoded)
+        changed      = []
+        size         = local_file.stat().st_size
+
+        for destination in destinations:
+            remote_object = remote_objects[destination].get(name)
+
+            if remote_object and is_unchanged(remote_object, len(encoded.data), encoded_etag):
+                skipped[destination].append(destination.prefix + name)
+                metrics.add("deploy_files_skipped")
+                metrics.add("deploy_bytes_skipped", remote_object.size)
+                record_file("skipped", destination.bucket, destination.prefix + name, remote_object.size)
+                indexed[destination][name] = index_entry(name, encoded.source_hash, size, remote_object.last_modified)
+            else:
+                changed.append(destination)
+                indexed[destination][name] = index_entry(name, encoded.source_hash, size)
+
+        for destination in changed:
+            print("Deploying", local_file, "as", s3_url(destination.bucket, destination.prefix + name))
+
+        def upload_to(destination):
+            remote_file = destination.prefix + name
+            upload_object(destination.bucket, remote_file, encoded, headers_for(policy, name))
+            uploaded[destination].append(remote_file)
+
+        fan_out(changed, upload_to)
+
+    # Delete objects which no longer exist locally
+    stale = {
+        destination: [ destination.prefix + name for name in sorted(set(remote_objects[destination]) - set(local_files)) ]
+            for destination in destinations
+    }
+
+    for destination in destinations:
+        for remote_file in stale[destination]:
+            print("Deleting", s3_url(destination.bucket, remote_file))
+
+        delete_objects(destination.bucket, stale[destination])
+
+    status = 0
+
+    for destination in destinations:
+        status = update_index(destination.bucket, destination.prefix, indexed[destination],
+            removed = [ remove_prefix(destination.prefix, key) for key in stale[destination] ]) or status
+
+    for destination in destinations:
+        print("%s: uploaded %d, skipped %d unchanged, and deleted %d file(s)." % (
+            s3_url(destination.bucket, destination.prefix),
+            len(uploaded[destination]),
+            len(skipped[destination]),
+            len(stale[destination])))
+
+    # Purge any CloudFront caches for these buckets, where anything changed
+    purge_cloudfront({
+        destination: uploaded[destination] + stale[destination]
+            for destination in destinations
+    })
+
+    return status
+
+
+def fetch(url: urllib.parse.ParseResult, local_dir: Path, include: List[str], exclude: List[str]) -> int:
+    """
+    Download the objects under the URL's prefix into *local_dir*, mirroring
+    what sync() would have deployed from it.
+
+    Objects are downloaded concurrently, large ones in concurrent ranges, and
+    gzip-encoded content is decompressed.  The ETag and local size and
+    modification time of each downloaded file are kept in a cache file in
+    *local_dir*, so files which haven't changed on either side are skipped
+    the next time.
+    """
+    bucket = load_bucket(url)
+
+    if not bucket:
         return 1
 
-    # Remove leading slashes from any destination path in order to use it as a
-    # prefix for uploaded files.  Internal and trailing slashes are untouched.
     prefix = url.path.lstrip("/")
 
+    objects = {
+        name: object
+            for name, object in list_files(Destination(bucket, prefix)).items()
+             if selected(name, include, exclude)
+    }
+
+    if not objects:
+        warn("Error: No objects selected under %s" % url.geturl())
+        return 1
+
+    local_dir.mkdir(parents = True, exist_ok = True)
+
+    cache_file = local_dir / FETCH_CACHE_NAME
+    cache      = read_fetch_cache(cache_file)
+    fetched    = {} # type: Dict[str, dict]
+    skipped    = {} # type: Dict[str, dict]
+    failed     = [] # type: List[str]
+    lock       = threading.Lock()
+
+    for name, object in sorted(objects.items()):
+        path = local_path(local_dir, name)
+
+        if not path:
+            warn("Skipping %s, which would be outside of %s" % (s3_url(bucket, object.key), local_dir))
+            continue
+
+        if is_cached(cache.get(name), path, object.e_tag):
+            skipped[name] = cache[name]
+
+    def fetch_one(name):
+        object = objects[name]
+        path   = local_path(local_dir, name)
+
+        try:
+            download_object(bucket.meta.client, bucket.name, object.key, object.size, object.e_tag, path)
+        except (ClientError, OSError) as error:
+            warn("Error fetching %s: %s" % (s3_url(bucket, object.key), error))
+
+            with lock:
+                failed.append(name)
+        else:
+            stat = path.stat()
+
+            with lock:
+                fetched[name] = { "etag": object.e_tag, "size": stat.st_size, "mtime": stat.st_mtime }
+
+    pending = [ name for name in sorted(objects) if name not in skipped and local_path(local_dir, name) ]
+
+    for name in pending:
+        print("Fetching", s3_url(bucket, objects[name].key), "as", local_path(local_dir, name))
+
+    with ThreadPoolExecutor(max_workers = FETCH_CONCURRENCY) as executor:
+        list(executor.map(fetch_one, pending))
+
+    # Entries for files not selected this time are kept for next time.
+    unselected = { name: entry for name, entry in cache.items() if name not in objects }
+
+    write_fetch_cache(cache_file, { **unselected, **skipped, **fetched })
+
+    print("%s: fetched %d, skipped %d unchanged, and failed %d file(s)." % (
+        url.geturl(), len(fetched), len(skipped), len(failed)))
+
+    return 1 if failed else 0
+
+
+def local_path(local_dir: Path, name: str):
+    """
+    Returns the local path for the given remote name under *local_dir*, or
+    None if the name would escape it (e.g. with "..").
+    """
+    parts = name.split("/")
+
+    if not name or name.startswith("/") or any(part in {"", ".", ".."} for part in parts):
+        return None
+
+    return local_dir.joinpath(*parts)
+
+
+def is_cached(entry, path: Path, etag: str) -> bool:
+    """
+    Test if the given fetch cache entry shows the local file at *path* was
+    downloaded from an object with the given ETag and hasn't changed since.
+    """
+    if not entry or entry["etag"] != etag:
+        return False
+
+    try:
+        stat = path.stat()
+    except OSError:
+        return False
+
+    return stat.st_size == entry["size"] and stat.st_mtime == entry["mtime"]
+
+
+def read_fetch_cache(path: Path) -> Dict[str, dict]:
+    try:
+        with path.open() as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_fetch_cache(path: Path, entries: Dict[str, dict]) -> None:
+    partial = path.with_name(path.name + ".partial")
+
+    with partial.open("w") as file:
+        json.dump(entries, file, indent = 2, sort_keys = True)
+
+    partial.replace(path)
+
+
+def download_object(client, bucket_name: str, key: str, size: int, etag: str, path: Path) -> None:
+    """
+    Download an object to *path*, decompressing it if it's gzip-encoded.
+
+    Objects of PART_SIZE or larger are downloaded in ranges of that size
+    concurrently.  Every request is conditional on the object's ETag, so a
+    change to the object midway fails the download rather than mixing
+    versions.  The file is written alongside *path* and moved into place
+    once complete.
+    """
+    path.parent.mkdir(parents = True, exist_ok = True)
+
+    download = path.with_name("." + path.name + ".download")
+    partial  = path.with_name("." + path.name + ".partial")
+    request  = { "Bucket": bucket_name, "Key": key, "IfMatch": etag }
+
+    try:
+        with trace.span("download from S3", key = key):
+            if size < PART_SIZE:
+                response = client.get_object(**request)
+
+                with download.open("wb") as file:
+                    for chunk in iter(lambda: response["Body"].read(READ_SIZE), b""):
+                        file.write(chunk)
+            else:
+                response = client.head_object(**request)
+
+                with download.open("wb") as file:
+                    file.truncate(size)
+
+                def download_range(start):
+                    with trace.span("download range from S3", key = key, start = start):
+                        part = client.get_object(**request, Range = "bytes=%d-%d" % (start, min(start + PART_SIZE, size) - 1))
+                        data = part["Body"].read()
+
+                    # Each range has its own handle so writes don't contend
+                    # over a shared file position.
+                    with download.open("r+b") as file:
+                        file.seek(start)
+                        file.write(data)
+
+                with ThreadPoolExecutor(max_workers = PART_CONCURRENCY) as executor:
+                    list(executor.map(download_range, range(0, size, PART_SIZE)))
+
+        if response.get("ContentEncoding") == "gzip":
+            with GzipFile(str(download), "rb") as compressed, partial.open("wb") as file:
+                for chunk in iter(lambda: compressed.read(READ_SIZE), b""):
+                    file.write(chunk)
+
+            download.unlink()
+            partial.replace(path)
+        else:
+            download.replace(path)
+    finally:
+        for leftover in [download, partial]:
+            if leftover.exists():
+                leftover.unlink()
+
+
+def deploy_immutable(local_files: List[Path], destinations: List[Destination], policy: List[dict]) -> int:
+    """
+    Upload each local file under a key containing a hash of its content,
+    which is cached forever, and then update the manifest under each
+    destination's prefix to point to the new keys.
+
+    Since existing keys never change content, no CloudFront invalidation is
+    needed.  The manifest itself is served with a Cache-Control which requires
+    revalidation, so clients see the new keys as soon as it's replaced.
+    Objects already present under their content-addressed key are skipped.
+    Objects which are no longer referenced are left in place, as clients may
+    still be using an older manifest.
+    """
+    def list_sizes(destination):
+        return { object.key: object.size for object in list_objects(destination) }
+
+    existing = dict(zip(destinations, fan_out(destinations, list_sizes)))
+    entries  = {} # type: Dict[str, dict]
+
+    for local_file in local_files:
+        source_hash = file_hash(local_file)
+        name        = content_addressed_name(local_file.name, source_hash)
+
+        entries[local_file.name] = {
+            "key":    name,
+            "sha256": source_hash,
+            "size":   local_file.stat().st_size,
+        }
+
+        missing = []
+
+        for destination in destinations:
+            remote_file = destination.prefix + name
+
+            if remote_file in existing[destination]:
+                print("Skipping", local_file, "already deployed as", s3_url(destination.bucket, remote_file))
+                metrics.add("deploy_files_skipped")
+                record_file("skipped", destination.bucket, remote_file, existing[destination][remote_file])
+            else:
+                missing.append(destination)
+
+        if not missing:
+            continue
+
+        with local_file.open("rb") as data:
+            encoded = encode(data)
+
+        headers = {
+            **headers_for(policy, local_file.name),
+            "CacheControl": IMMUTABLE_CACHE_CONTROL,
+        }
+
+        for destination in missing:
+            print("Deploying", local_file, "as", s3_url(destination.bucket, destination.prefix + name))
+
+        def upload_to(destination):
+            upload_object(destination.bucket, destination.prefix + name, encoded, headers)
+
+        fan_out(missing, upload_to)
+
+    index = {
+        name: index_entry(entry["key"], entry["sha256"], entry["size"])
+            for name, entry in entries.items()
+    }
+
+    status = 0
+
+    for destination in destinations:
+        status = update_manifest(destination.bucket, destination.prefix, entries) or status
+        status = update_index(destination.bucket, destination.prefix, index) or status
+
+    return status
+
+
+def content_addressed_name(name: str, content_hash: str) -> str:
+    """
+    Returns the given file name with a content hash inserted before its
+    extension, e.g. "zika_tree.json" becomes "zika_tree.3fa9….json".
+    """
+    path = Path(name)
+    return "%s.%s%s" % (path.stem, content_hash, path.suffix)
+
+
+def update_manifest(bucket, prefix: str, entries: Dict[str, dict]) -> int:
+    """
+    Merge the given entries into the manifest under the prefix.
+
+    The manifest maps each deployed file name to its current
+    content-addressed key, relative to the prefix.  It's replaced with
+    replace_json_object(), so concurrent deploys to the same prefix don't
+    lose each other's entries.
+    """
+    def merge(manifest):
+        manifest = manifest or {}
+
+        return {
+            **manifest,
+            "updated": datetime.now(timezone.utc).isoformat(),
+            "files":   { **manifest.get("files", {}), **entries },
+        }
+
+    return replace_json_object(bucket, prefix + MANIFEST_NAME, merge, MANIFEST_CACHE_CONTROL)
+
+
+def index_entry(key: str, source_hash: str, size: int, updated: Optional[datetime] = None) -> dict:
+    """
+    Returns the index entry for a file deployed as *key* (relative to the
+    prefix), with the SHA-256 hex digest and size of its uncompressed
+    content.  It was *updated* now unless given.
+    """
+    return {
+        "key":      key,
+        "sha256":   source_hash,
+        "size":     size,
+        "encoding": "gzip",
+        "updated":  (updated or datetime.now(timezone.utc)).isoformat(),
+    }
+
+
+def update_index(bucket, prefix: str, entries: Dict[str, dict], removed: List[str] = []) -> int:
+    """
+    Merge the given entries, by file name relative to the prefix, into the
+    index under the prefix and remove the *removed* names from it.
+
+    Entries for files whose key and content haven't changed keep the update
+    time already in the index.  The index is replaced with
+    replace_json_object(), so concurrent deploys to the same prefix don't
+    lose each other's entries.
+    """
+    if not entries and not removed:
+        return 0
+
+    def merge(index):
+        files = dict((index or {}).get("files", {}))
+
+        for name, entry in entries.items():
+            previous = files.get(name, {})
+
+            if previous.get("key") == entry["key"] and previous.get("sha256") == entry["sha256"]:
+                entry = { **entry, "updated": previous.get("updated", entry["updated"]) }
+
+            files[name] = entry
+
+        for name in removed:
+            files.pop(name, None)
+
+        return {
+            **(index or {}),
+            "updated": datetime.now(timezone.utc).isoformat(),
+            "files":   files,
+        }
+
+    return replace_json_object(bucket, prefix + INDEX_NAME, merge, INDEX_CACHE_CONTROL)
+
+
+def replace_json_object(bucket, key: str, update: Callable[[Any], dict], cache_control: str) -> int:
+    """
+    Replace the JSON content of the given key with the result of calling
+    *update* with its current content (or None if it doesn't exist).
+
+    It's replaced only if no other deploy has replaced it since it was read,
+    calling *update* again with the other deploy's content if one has, up to
+    WRITE_ATTEMPTS times.  Older versions of botocore can't make such
+    conditional writes, so with them it's replaced regardless, after a
+    warning.
+
+    Errors, including running out of attempts, are reported and returned as a
+    non-zero status, instead of raised, so callers still purge CloudFront for
+    what they deployed.
+    """
+    print("Updating", s3_url(bucket, key))
+
+    conditional = supports_conditional_writes(bucket)
+
+    if not conditional:
+        warn("Warning: The installed version of boto3 can't make conditional writes to S3,")
+        warn("so changes to %s by other deploys at the same time may be lost." % s3_url(bucket, key))
+        warn("Upgrade boto3 (and botocore) to a release from December 2024 or later to avoid this.")
+
+    try:
+        for attempt in range(WRITE_ATTEMPTS):
+            if attempt:
+                # Wait a random, growing time before trying again, so
+                # deploys racing each other are unlikely to collide again.
+                sleep(random.uniform(0, WRITE_BACKOFF * 2 ** attempt))
+
+            content, content_etag = read_json_object_and_etag(bucket, key)
+
+            encoded = encode(BytesIO(json.dumps(update(content), indent = 2, sort_keys = True).encode("utf-8")))
+
+            # Replace only the version we read, or create it only if it still
+            # doesn't exist.
+            if conditional:
+                condition = { "IfMatch": content_etag } if content_etag else { "IfNoneMatch": "*" }
+            else:
+                condition = {}
+
+            try:
+                with trace.span("upload to S3", key = key):
+                    bucket.put_object(
+                        Key             = key,
+                        Body            = encoded.data,
+                        ContentMD5      = content_md5(encoded.md5),
+                        ContentType     = "application/json",
+                        ContentEncoding = "gzip",
+                        CacheControl    = cache_control,
+                        **condition)
+            except ClientError as error:
+                if error.response["Error"]["Code"] not in {"PreconditionFailed", "ConditionalRequestConflict"}:
+                    raise
+            else:
+                return 0
+    except (BotoCoreError, ClientError) as error:
+        warn("Error: Unable to update %s: %s" % (s3_url(bucket, key), error))
+        return 1
+
+    warn("Error: Unable to update %s, as other deploys changed it %d times in a row."
+        % (s3_url(bucket, key), WRITE_ATTEMPTS))
+
+    return 1
+
+
+def supports_conditional_writes(bucket) -> bool:
+    """
+    Test if the installed botocore can make conditional writes with
+    PutObject's IfMatch and IfNoneMatch parameters, which older versions
+    refuse to send.
+    """
+    parameters = bucket.meta.client.meta.service_model.operation_model("PutObject").input_shape.members
+
+    return "IfMatch" in parameters and "IfNoneMatch" in parameters
+
+
+def read_json_object(bucket, key: str):
+    """
+    Returns the parsed JSON content of the given key, or None if it doesn't
+    exist.  Gzip-encoded content is decompressed.
+    """
+    content, _ = read_json_object_and_etag(bucket, key)
+    return content
+
+
+def read_json_object_and_etag(bucket, key: str) -> Tuple[Any, Optional[str]]:
+    """
+    Returns the parsed JSON content of the given key and its ETag, or (None,
+    None) if it doesn't exist.  Gzip-encoded content is decompressed.
+    """
+    try:
+        with trace.span("download from S3", key = key):
+            response = bucket.Object(key).get()
+            body     = response["Body"].read()
+    except ClientError as error:
+        if error.response["Error"]["Code"] == "NoSuchKey":
+            return None, None
+        raise
+
+    if response.get("ContentEncoding") == "gzip":
+        body = decompress(body)
+
+    return json.loads(body.decode("utf-8")), response["ETag"]
+
+
+def load_destinations(urls: List[urllib.parse.ParseResult]) -> List[Destination]:
+    """
+    Returns a Destination for each of the given URLs, or an empty list (after
+    warning why) if any of their buckets can't be loaded.
+    """
+    destinations = []
+
+    for url in urls:
+        bucket = load_bucket(url)
+
+        if not bucket:
+            return []
+
+        # Remove leading slashes from any destination path in order to use it
+        # as a prefix for uploaded files.  Internal and trailing slashes are
+        # untouched.
+        destinations.append(Destination(bucket, url.path.lstrip("/")))
+
+    return destinations
+
+
+def register_arguments(parser, cloudfront: bool = True) -> None:
+    """
+    Add options for using an S3-compatible endpoint other than AWS's, and, if
+    *cloudfront* is true, for controlling CloudFront invalidation.
+    """
+    group = parser.add_argument_group(
+        "S3 options",
+        "Options for S3-compatible services other than AWS, such as MinIO.")
+
+    group.add_argument(
+        "--s3-endpoint",
+        help    = "URL of the S3-compatible endpoint to use instead of AWS's, "
+                  "e.g. http://minio.example.org:9000.  May also be set with "
+                  "the NEXTSTRAIN_S3_ENDPOINT environment variable.",
+        metavar = "<url>",
+        default = os.environ.get("NEXTSTRAIN_S3_ENDPOINT") or None)
+
+    group.add_argument(
+        "--s3-path-style",
+        help    = "Address buckets by path (http://host/bucket/key) instead of by "
+                  "hostname (http://bucket.host/key), as many S3-compatible "
+                  "servers require.  May also be set with the "
+                  "NEXTSTRAIN_S3_PATH_STYLE environment variable.",
+        action  = "store_true",
+        default = bool(os.environ.get("NEXTSTRAIN_S3_PATH_STYLE")))
+
+    if cloudfront:
+        group.add_argument(
+            "--cloudfront",
+            help    = "Invalidate CloudFront distributions serving the destination.  "
+                      "The default, unless --s3-endpoint is given.",
+            dest    = "cloudfront",
+            action  = "store_const",
+            const   = True)
+
+        group.add_argument(
+            "--no-cloudfront",
+            help    = "Don't look for CloudFront distributions to invalidate, "
+                      "e.g. when the destination isn't behind CloudFront",
+            dest    = "cloudfront",
+            action  = "store_const",
+            const   = False)
+
+        parser.set_defaults(cloudfront = None)
+
+
+def configure(opts) -> None:
+    """
+    Use the endpoint and CloudFront settings from the options added by
+    register_arguments().
+    """
+    global ENDPOINT_URL, PATH_STYLE, CLOUDFRONT
+
+    ENDPOINT_URL = opts.s3_endpoint
+    PATH_STYLE   = opts.s3_path_style
+    CLOUDFRONT   = getattr(opts, "cloudfront", None)
+
+
+def resource():
+    """
+    Returns an S3 resource for the configured session and endpoint.
+    """
+    def connect(session):
+        return session.resource("s3",
+            endpoint_url = ENDPOINT_URL,
+            config       = Config(s3 = { "addressing_style": "path" if PATH_STYLE else "auto" }))
+
+    return connection(("s3", ENDPOINT_URL, PATH_STYLE), connect)
+
+
+def cloudfront_client():
+    """
+    Returns a CloudFront client for the configured session.
+    """
+    return connection(("cloudfront",), lambda session: session.client("cloudfront"))
+
+
+def connection(key: tuple, connect):
+    """
+    Returns the connection made by *connect* with the configured session for
+    *key*, reusing the one made by an earlier call if any.  Creating a boto3
+    resource or client loads its service model, which takes much longer than
+    a small request.
+    """
+    if not SESSION and not boto3.DEFAULT_SESSION:
+        boto3.setup_default_session()
+
+    session = SESSION or boto3.DEFAULT_SESSION
+
+    with _connections_lock:
+        connections = _connections.setdefault(session, {})
+
+        if key not in connections:
+            connections[key] = connect(session)
+
+        return connections[key]
+
+
+class recording:
+    """
+    Context manager which records each file uploaded, skipped, copied, or
+    deleted and each CloudFront invalidation made within it, in its *files*
+    and *invalidations* lists.  Only one recording may be active at once.
+    """
+    def __init__(self) -> None:
+        self.files         = [] # type: List[DeployedFile]
+        self.invalidations = [] # type: List[Invalidation]
+
+    def __enter__(self):
+        global _recording
+        _recording = self
+        return self
+
+    def __exit__(self, *exc):
+        global _recording
+        _recording = None
+        return False
+
+
+_recording      = None # type: Optional[recording]
+_recording_lock = threading.Lock()
+
+
+def record_file(action: str, bucket, key: str, size: int, seconds: float = 0.0) -> None:
+    """
+    Record a file deployed, if recording.  May be called from multiple
+    threads.
+    """
+    if _recording is None:
+        return
+
+    with _recording_lock:
+        _recording.files.append(DeployedFile(action, bucket.name, key, size, seconds))
+
+
+def cloudfront_enabled() -> bool:
+    """
+    Test if CloudFront distributions should be invalidated after changes.
+
+    CloudFront is assumed not to be in front of custom endpoints unless
+    explicitly requested, since looking for distributions needs AWS
+    credentials which such deploys often don't have.
+    """
+    if CLOUDFRONT is None:
+        return ENDPOINT_URL is None
+
+    return CLOUDFRONT
+
+
+def load_bucket(url: urllib.parse.ParseResult):
+    """
+    Returns the existing S3 bucket named by the given URL, or None (after
+    warning why) if it doesn't exist or can't be accessed.
+    """
+    # Require a bucket name
+    if not url.netloc:
+        warn("No bucket name specified in url (%s)" % url.geturl())
+        return None
+
     # Find the bucket and ensure it already exists so we don't automagically
     # create new buckets.
     try:
-        bucket = boto3.resource("s3").Bucket(url.netloc)
-        bucket.load()
+        with trace.span("load S3 bucket", bucket = url.netloc):
+            bucket = resource().Bucket(url.netloc)
+            bucket.load()
     except (NoCredentialsError, PartialCredentialsError) as error:
         warn("Error:", error)
-        return 1
+        return None
 
     if not bucket.creation_date:
         warn('No bucket exists with the name "%s".' % bucket.name)
         warn()
         warn("Buckets are not automatically created for safety reasons.")
+        return None
+
+    return bucket
+
+
+def upload(local_files: List[Path], destinations: List[Destination], policy: List[dict] = DEFAULT_POLICY, index: Optional[Dict[str, dict]] = None) -> Dict[Destination, List[str]]:
+    """
+    Upload a set of local file paths to each destination, with headers set
+    according to the given policy.
+
+    Each file is read and compressed once, and the compressed data uploaded
+    to all destinations concurrently.  Files are handled one at a time, so
+    only one file's compressed data is held in memory.  If an *index* dict is
+    given, each file's index entry is added to it, for update_index().
+
+    Returns a dict mapping each destination to a list of remote file names.
+    """
+    remote_files = { destination: [] for destination in destinations } # type: Dict[Destination, List[str]]
+
+    for local_file in local_files:
+        with local_file.open("rb") as data:
+            encoded = encode(data)
+
+        for destination in destinations:
+            print("Deploying", local_file, "as", s3_url(destination.bucket, destination.prefix + local_file.name))
+
+        def upload_to(destination):
+            remote_file = destination.prefix + local_file.name
+            upload_object(destination.bucket, remote_file, encoded, headers_for(policy, local_file.name))
+            remote_files[destination].append(remote_file)
+
+        fan_out(destinations, upload_to)
+
+        if index is not None:
+            index[local_file.name] = index_entry(local_file.name, encoded.source_hash, local_file.stat().st_size)
+
+    return remote_files
+
+
+def fan_out(destinations: List[Destination], function) -> List:
+    """
+    Call *function* with each destination concurrently, returning the results
+    in the same order.  If any call raises an exception, the first is
+    re-raised after the others finish.
+    """
+    if len(destinations) <= 1:
+        return [ function(destination) for destination in destinations ]
+
+    with ThreadPoolExecutor(max_workers = len(destinations)) as executor:
+        futures = [ executor.submit(function, destination) for destination in destinations ]
+
+        return [ future.result() for future in futures ]
+
+
+def list_files(destination: Destination) -> Dict[str, Any]:
+    """
+    Returns the objects under the destination's prefix which sync() manages,
+    by name relative to the prefix.
+
+    Directory markers, the index, files staged by `build --deploy`, and the
+    manifest and content-addressed objects deployed by `deploy --immutable`
+    are left out, so syncing to a prefix doesn't delete them.
+    """
+    prefix   = destination.prefix
+    manifest = read_json_object(destination.bucket, prefix + MANIFEST_NAME) or {}
+
+    unmanaged = {
+        prefix + INDEX_NAME,
+        prefix + MANIFEST_NAME,
+        *(prefix + entry["key"] for entry in manifest.get("files", {}).values()),
+    }
+
+    return {
+        remove_prefix(prefix, object.key): object
+            for object in list_objects(destination)
+             if not object.key.endswith("/")
+            and object.key not in unmanaged
+            and not object.key.startswith(prefix + STAGING_PREFIX)
+    }
+
+
+def list_objects(destination: Destination) -> List:
+    """
+    Returns summaries of all objects under the destination's prefix.
+    """
+    bucket, prefix = destination
+
+    with trace.span("list S3 objects", bucket = bucket.name, prefix = prefix):
+        return list(bucket.objects.filter(Prefix = prefix))
+
+
+def s3_url(bucket, key: str) -> str:
+    return "s3://%s/%s" % (bucket.name, key)
+
+
+def upload_object(bucket, key: str, encoded: Encoded, headers: dict) -> None:
+    """
+    Upload data encoded by encode() to the given key.  The *headers* (e.g.
+    ContentType, CacheControl) are passed along to S3, as from
+    policy.headers_for().
+
+    Each request includes a Content-MD5 header, so S3 verifies the integrity
+    of the data it receives and rejects it if it was corrupted in transit.
+
+    Data of PART_SIZE or larger is uploaded in parts which are journaled
+    locally, so that an interrupted upload of the same source content can be
+    resumed by a later call instead of starting over.
+    """
+    metadata = { **headers, "ContentEncoding": "gzip" }
+    start    = perf_counter()
+
+    with trace.span("upload to S3", bucket = bucket.name, key = key):
+        if len(encoded.data) < PART_SIZE:
+            bucket.put_object(Key = key, Body = encoded.data, ContentMD5 = content_md5(encoded.md5), **metadata)
+        else:
+            upload_multipart(bucket, key, encoded, metadata)
+
+    metrics.add("deploy_files_uploaded")
+    metrics.add("deploy_bytes_uploaded", len(encoded.data))
+    record_file("uploaded", bucket, key, len(encoded.data), perf_counter() - start)
+
+
+def upload_multipart(bucket, key: str, encoded: Encoded, metadata: dict) -> None:
+    """
+    Upload data in parts, resuming a previous journaled upload of the same
+    source (identified by its source hash) if there is one.
+    """
+    client = bucket.meta.client
+    upload = { "Bucket": bucket.name, "Key": key }
+
+    source_hash = encoded.source_hash
+
+    parts = [
+        encoded.data[i:i + PART_SIZE]
+            for i in range(0, len(encoded.data), PART_SIZE)
+    ]
+
+    completed = {} # type: Dict[int, str]
+    previous  = journal.read(bucket.name, key)
+
+    if previous and previous["source_hash"] == source_hash:
+        upload_id = previous["upload_id"]
+        completed = uploaded_parts(client, upload, upload_id, encoded.part_md5s)
+
+        if completed is not None:
+            print("Resuming upload of %s with %d of %d parts already uploaded" % (key, len(completed), len(parts)))
+        else:
+            upload_id = None
+    else:
+        # A previous upload of different data can't be resumed, so don't let
+        # it linger.
+        if previous:
+            abort_upload(client, upload, previous["upload_id"])
+
+        upload_id = None
+
+    if not upload_id:
+        completed = {}
+        upload_id = client.create_multipart_upload(**upload, **metadata)["UploadId"]
+
+    lock = threading.Lock()
+
+    def record_progress():
+        journal.write(bucket.name, key, {
+            "upload_id":   upload_id,
+            "source_hash": source_hash,
+            "parts":       [ { "PartNumber": n, "ETag": etag } for n, etag in sorted(completed.items()) ],
+        })
+
+    def upload_part(number, part):
+        with trace.span("upload part to S3", key = key, part = number):
+            response = client.upload_part(
+                **upload,
+                UploadId   = upload_id,
+                PartNumber = number,
+                Body       = part,
+                ContentMD5 = content_md5(encoded.part_md5s[number - 1]))
+
+        with lock:
+            completed[number] = response["ETag"]
+            record_progress()
+
+    record_progress()
+
+    with ThreadPoolExecutor(max_workers = PART_CONCURRENCY) as executor:
+        pending = [
+            executor.submit(upload_part, number, part)
+                for number, part in enumerate(parts, 1)
+                 if number not in completed
+        ]
+
+        # Re-raise the first error, if any, after the others finish.
+        for future in pending:
+            future.result()
+
+    client.complete_multipart_upload(
+        **upload,
+        UploadId        = upload_id,
+        MultipartUpload = {
+            "Parts": [ { "PartNumber": n, "ETag": etag } for n, etag in sorted(completed.items()) ],
+        })
+
+    journal.remove(bucket.name, key)
+
+
+def uploaded_parts(client, upload: dict, upload_id: str, part_md5s: List[bytes]):
+    """
+    Returns a dict of part number to ETag for the parts of the given upload
+    which S3 already has and which match our local data.  Returns None if the
+    upload no longer exists.
+    """
+    try:
+        listed = [
+            part
+                for page in client.get_paginator("list_parts").paginate(**upload, UploadId = upload_id)
+                for part in page.get("Parts", [])
+        ]
+    except ClientError as error:
+        if error.response["Error"]["Code"] == "NoSuchUpload":
+            return None
+        raise
+
+    return {
+        part["PartNumber"]: part["ETag"]
+            for part in listed
+             if part["PartNumber"] <= len(part_md5s)
+            and part["ETag"].strip('"') == part_md5s[part["PartNumber"] - 1].hex()
+    }
+
+
+def abort_upload(client, upload: dict, upload_id: str) -> None:
+    """
+    Abort the given multipart upload, ignoring it if it's already gone.
+    """
+    try:
+        client.abort_multipart_upload(**upload, UploadId = upload_id)
+    except ClientError as error:
+        if error.response["Error"]["Code"] != "NoSuchUpload":
+            raise
+
+    entry = journal.read(upload["Bucket"], upload["Key"])
+
+    if entry and entry["upload_id"] == upload_id:
+        journal.remove(upload["Bucket"], upload["Key"])
+
+
+def abort_stale_uploads(url: urllib.parse.ParseResult) -> int:
+    """
+    Abort incomplete multipart uploads under the URL's prefix which were
+    started more than STALE_UPLOAD_AGE ago.
+
+    S3 keeps (and charges for) the parts of incomplete uploads until they're
+    completed or aborted.
+    """
+    bucket = load_bucket(url)
+
+    if not bucket:
         return 1
 
-    # Upload files
-    remote_files = upload(local_files, bucket, prefix)
+    prefix = url.path.lstrip("/")
+    cutoff = datetime.now(timezone.utc) - STALE_UPLOAD_AGE
+    client = bucket.meta.client
+
+    with trace.span("list S3 multipart uploads", bucket = bucket.name, prefix = prefix):
+        uploads = [
+            upload
+                for page in client.get_paginator("list_multipart_uploads").paginate(Bucket = bucket.name, Prefix = prefix)
+                for upload in page.get("Uploads", [])
+                 if upload["Initiated"] < cutoff
+        ]
 
-    # Purge any CloudFront caches for this bucket
-    purge_cloudfront(bucket, remote_files)
+    for upload in uploads:
+        print("Aborting incomplete upload of %s started %s" % (upload["Key"], upload["Initiated"]))
+        abort_upload(client, { "Bucket": bucket.name, "Key": upload["Key"] }, upload["UploadId"])
+
+    print("Aborted %d incomplete upload(s)." % len(uploads))
 
     return 0
 
 
-def upload(local_files: List[Path], bucket, prefix: str) -> List[str]:
+def copy_object(bucket, source_key: str, key: str) -> None:
+    """
+    Copy the object *source_key* to *key* within the bucket, with the same
+    headers.  The data isn't transferred through us.
     """
-    Upload a set of local file paths to the given bucket under a specified
-    prefix.
+    start = perf_counter()
+
+    with trace.span("copy S3 object", key = key):
+        bucket.meta.client.copy_object(
+            Bucket            = bucket.name,
+            Key               = key,
+            CopySource        = { "Bucket": bucket.name, "Key": source_key },
+            MetadataDirective = "COPY")
+
+        size = bucket.Object(key).content_length
+
+    record_file("copied", bucket, key, size, perf_counter() - start)
+
+
+def delete_objects(bucket, keys: List[str]) -> None:
+    """
+    Delete the given keys from the bucket, in as few requests as possible.
+    """
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[i:i + DELETE_BATCH_SIZE]
+
+        with trace.span("delete S3 objects", count = len(batch)):
+            response = bucket.delete_objects(
+                Delete = {
+                    "Objects": [ { "Key": key } for key in batch ],
+                    "Quiet": True,
+                })
+
+        failed = { error["Key"] for error in response.get("Errors", []) }
 
-    Returns a list of remote file names.
+        for error in response.get("Errors", []):
+            warn("Error deleting %s: %s" % (error["Key"], error["Message"]))
+
+        metrics.add("deploy_files_deleted", len(batch) - len(failed))
+
+        for key in batch:
+            if key not in failed:
+                record_file("deleted", bucket, key, 0)
+
+
+def is_unchanged(remote_object, size: int, etag: str) -> bool:
     """
+    Test if the given S3 object summary has the same content as the
+    compressed data we would upload for it, given that data's size and ETag.
+    """
+    return remote_object.size == size \
+       and remote_object.e_tag.strip('"') == etag
 
-    # Create a set of (local name, remote name) tuples.  S3 is a key-value
-    # store, not a filesystem, so this remote name prefixing is intentionally a
-    # pure string prefix instead of a path-based prefix (which assumes
-    # directory structure semantics).
-    files = list(zip(local_files, [ prefix + f.name for f in local_files ]))
 
-    for local_file, remote_file in files:
-        print("Deploying", local_file, "as", remote_file)
+def etag(encoded: Encoded) -> str:
+    """
+    Returns the ETag S3 assigns to the given encoded data when uploaded by
+    upload_object().
 
-        # Upload compressed data
-        with local_file.open("rb") as data, gzip_stream(data) as gzdata:
-            bucket.upload_fileobj(
-                gzdata,
-                remote_file,
-                { "ContentType": "application/json", "ContentEncoding": "gzip" })
+    For data uploaded in a single part, the ETag is the MD5 digest of the
+    data.  For data uploaded in multiple parts, it is the MD5 digest of the
+    concatenated binary digests of each part, followed by a dash and the
+    number of parts.
+    """
+    if len(encoded.data) < PART_SIZE:
+        return encoded.md5.hex()
 
-    return [ remote for local, remote in files ]
+    return "%s-%d" % (md5(b"".join(encoded.part_md5s)).hexdigest(), len(encoded.part_md5s))
 
 
-def gzip_stream(stream):
+def content_md5(digest: bytes) -> str:
     """
-    Takes an IO stream and compresses it in-memory with gzip.  Returns a
-    BytesIO stream of compressed data.
+    Returns the given binary MD5 digest in the base64 form expected by S3's
+    Content-MD5 header.
     """
-    gzstream = BytesIO()
+    return b64encode(digest).decode("ascii")
 
-    # Pass the original contents through gzip into memory
-    with GzipFile(fileobj = gzstream, mode = "wb") as gzfile:
-        shutil.copyfileobj(stream, gzfile)
 
-    # Re-seek the compressed data to the start
-    gzstream.seek(0)
+def file_hash(path: Path) -> str:
+    """
+    Returns the SHA-256 hex digest of the contents of the given file.
+    """
+    digest = sha256()
+
+    with path.open("rb") as file:
+        for chunk in iter(lambda: file.read(READ_SIZE), b""):
+            digest.update(chunk)
 
-    return gzstream
+    return digest.hexdigest()
 
 
-def purge_cloudfront(bucket, paths: List[str]) -> None:
+def encode(stream) -> Encoded:
     """
-    Invalidate any CloudFront distribution paths which match the given list of
-    file paths originating in the given S3 bucket.
+    Takes an IO stream and compresses it in-memory with gzip, reading it only
+    once.  The content hash and the compressed data's checksums are computed
+    in the same pass, as chunks flow through.
+
+    The compressed data is reproducible: the same input always produces the
+    same output, which lets us detect unchanged files by their ETag.
     """
-    cloudfront = boto3.client("cloudfront")
+    source = sha256()
+    output = digesting_buffer()
 
-    # Find the common prefix of this fileset, if any.
-    prefix = commonprefix(paths)
+    with trace.span("encode"):
+        # A fixed modification time is recorded in the gzip header, instead of
+        # the current time, for reproducibility.
+        with GzipFile(fileobj = output, mode = "wb", mtime = 0) as gzfile:
+            for chunk in iter(lambda: stream.read(READ_SIZE), b""):
+                source.update(chunk)
+                gzfile.write(chunk)
 
-    # For each CloudFront distribution origin serving from this bucket (with a
-    # matching or broader prefix), if any, purge the prefix path.
-    for distribution, origin in distribution_origins_for_bucket(cloudfront, bucket.name, prefix):
-        purge_prefix(cloudfront, distribution, origin, prefix)
+    return Encoded(output.getvalue(), source.hexdigest(), output.md5.digest(), output.part_md5s())
 
 
-def purge_prefix(cloudfront, distribution: dict, origin: dict, prefix: str) -> None:
+class digesting_buffer(BytesIO):
+    """
+    An in-memory binary stream which computes MD5 digests of the data written
+    to it, both in total and for each PART_SIZE part, as it's written.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.md5   = md5()
+        self.parts = [md5()]
+        self.room  = PART_SIZE
+
+    def write(self, data) -> int:
+        view = memoryview(data).cast("B")
+
+        self.md5.update(view)
+
+        while view:
+            chunk = view[:self.room]
+            self.parts[-1].update(chunk)
+            self.room -= len(chunk)
+            view = view[len(chunk):]
+
+            if not self.room:
+                self.parts.append(md5())
+                self.room = PART_SIZE
+
+        return super().write(data)
+
+    def part_md5s(self) -> List[bytes]:
+        count = -(-self.tell() // PART_SIZE)
+        return [ part.digest() for part in self.parts[:count] ]
+
+
+def purge_cloudfront(changes: Dict[Destination, List[str]]) -> None:
+    """
+    Invalidate any CloudFront distribution paths which match the lists of
+    changed file paths for each destination bucket.
+
+    Each distribution is purged at most once per prefix, even when several
+    destinations share it (e.g. as multiple origins), and prefixes already
+    covered by a broader purge of the same distribution are skipped.
+    """
+    changes = { destination: paths for destination, paths in changes.items() if paths }
+
+    if not changes or not cloudfront_enabled():
+        return
+
+    cloudfront = cloudfront_client()
+
+    with trace.span("list CloudFront distributions"):
+        all_distributions = distributions(cloudfront)
+
+    # Collect the purge paths for each distribution, keyed by distribution id.
+    purges = {} # type: Dict[str, Tuple[dict, Set[str]]]
+
+    for destination, paths in changes.items():
+        # Find the common prefix of this fileset, if any.
+        prefix = commonprefix(paths)
+
+        # For each CloudFront distribution origin serving from this bucket
+        # (with a matching or broader prefix), if any, purge the prefix path.
+        for distribution, origin in distribution_origins_for_bucket(all_distributions, destination.bucket.name, prefix):
+            _, prefixes = purges.setdefault(distribution["Id"], (distribution, set()))
+            prefixes.add(remove_origin_path(origin, prefix))
+
+    for distribution, prefixes in purges.values():
+        for prefix in sorted(prefixes):
+            if any(prefix.startswith(other) and prefix != other for other in prefixes):
+                continue
+
+            purge_prefix(cloudfront, distribution, prefix)
+
+
+def purge_prefix(cloudfront, distribution: dict, prefix: str) -> None:
     distribution_id     = distribution["Id"]
     distribution_domain = domain_names(distribution)[0]
 
-    # Purge everything starting with the prefix, after removing any implicit
-    # origin path from the prefix.  If there is no prefix (e.g. the empty
+    # Purge everything starting with the prefix, which has already had any
+    # implicit origin path removed.  If there is no prefix (e.g. the empty
     # string), we'll purge everything in the distribution.  Top-level keys
     # require a leading slash for proper invalidation.
-    purge_prefix = "/%s*" % remove_origin_path(origin, prefix)
+    purge_prefix = "/%s*" % prefix
 
     print("Purging %s from CloudFront distribution %s (%s)… " % (purge_prefix, distribution_domain, distribution_id),
         end = "", flush = True)
@@ -129,15 +1388,16 @@ def purge_prefix(cloudfront, distribution: dict, origin: dict, prefix: str) -> N
     #
     # This is purposely a single path invalidation due to how AWS charges:
     #    https://docs.aws.amazon.com/AmazonCloudFront/latest/DeveloperGuide/Invalidation.html
-    invalidation = cloudfront.create_invalidation(
-        DistributionId    = distribution_id,
-        InvalidationBatch = {
-            "Paths": {
-                "Quantity": 1,
-                "Items": [ purge_prefix ]
-            },
-            "CallerReference": str(time())
-        })
+    with trace.span("create CloudFront invalidation", distribution = distribution_id):
+        invalidation = cloudfront.create_invalidation(
+            DistributionId    = distribution_id,
+            InvalidationBatch = {
+                "Paths": {
+                    "Quantity": 1,
+                    "Items": [ purge_prefix ]
+                },
+                "CallerReference": str(time())
+            })
 
     # Wait up to 2 minutes for the invalidation to complete so we know it happened.
     invalidation_id = invalidation["Invalidation"]["Id"]
@@ -149,26 +1409,34 @@ def purge_prefix(cloudfront, distribution: dict, origin: dict, prefix: str) -> N
     start = time()
 
     try:
-        cloudfront.get_waiter('invalidation_completed').wait(
-            Id             = invalidation_id,
-            DistributionId = distribution_id,
-            WaiterConfig   = waiter_config)
+        with trace.span("wait for CloudFront invalidation", distribution = distribution_id, invalidation = invalidation_id), \
+             metrics.timer("cloudfront_invalidation_wait_seconds"):
+            cloudfront.get_waiter('invalidation_completed').wait(
+                Id             = invalidation_id,
+                DistributionId = distribution_id,
+                WaiterConfig   = waiter_config)
     except WaiterError as e:
         print("not yet complete")
         warn("Warning: Invalidation %s did not complete within %ds, but it will probably do so soon."
             % (invalidation_id, waiter_config["Delay"] * waiter_config["MaxAttempts"]))
+        completed = False
     else:
         print("done (in %.0fs)" % (time() - start))
+        completed = True
 
+    if _recording is not None:
+        _recording.invalidations.append(Invalidation(distribution_id, invalidation_id, purge_prefix, completed))
 
-def distribution_origins_for_bucket(cloudfront, bucket_name, prefix):
+
+def distribution_origins_for_bucket(distributions, bucket_name, prefix):
     """
-    Return a list of (distribution, origin) tuples from CloudFront where the
-    origin points at the given S3 bucket name and path (key) prefix.
+    Return a list of (distribution, origin) tuples from the given CloudFront
+    distributions where the origin points at the given S3 bucket name and
+    path (key) prefix.
     """
     return [
         (distribution, origin)
-            for distribution in distributions(cloudfront)
+            for distribution in distributions
             for origin       in origins(distribution)
                  if origin_is_s3_bucket(origin, bucket_name)
                 and origin_path_includes(origin, prefix)
@@ -182,7 +1450,7 @@ def distributions(cloudfront):
     return [
         distribution
             for resultset in cloudfront.get_paginator("list_distributions").paginate()
-            for distribution in resultset["DistributionList"]["Items"]
+            for distribution in resultset["DistributionList"].get("Items", [])
     ]
 
 
@@ -194,7 +1462,7 @@ def domain_names(distribution):
     shortest first.
     """
     return [
-        *sorted([ alias for alias in distribution["Aliases"]["Items"] ], key = len),
+        *sorted([ alias for alias in distribution["Aliases"].get("Items", []) ], key = len),
         distribution["DomainName"],
     ]
 
@@ -217,9 +1485,17 @@ def origin_is_s3_bucket(origin: dict, bucket_name: str) -> bool:
 
     We are a little looser than that code because we have a slightly different
     purpose.  We want to know if the origin is _any_ S3 bucket, not just if the
-    CloudFront backend will fetch via the S3 API or not.
+    CloudFront backend will fetch via the S3 API or not.  This includes
+    regional, dual-stack, and website endpoints, e.g.
+    bucket.s3.us-west-2.amazonaws.com, and, when a custom endpoint is used,
+    the bucket's hostname on it.
     """
-    pattern = '^' + re.escape(bucket_name) + r'\.s3[^.]*\.amazonaws\.com$'
+    if ENDPOINT_URL:
+        endpoint = re.escape(urllib.parse.urlparse(ENDPOINT_URL).hostname or "")
+    else:
+        endpoint = r's3[^.]*(\.[a-z0-9-]+){0,2}\.amazonaws\.com(\.cn)?'
+
+    pattern = '^' + re.escape(bucket_name) + r'\.' + endpoint + '$'
     return re.search(pattern, origin["DomainName"]) is not None
 
 
@@ -0,0 +1,139 @@
+"""
+Streams the output of programs we run to the terminal, keeping standard
+output and error apart, and to a compressed log file, keeping only the last
+lines in memory to show if the program fails.
+
+Each invocation gets its own log in ~/.nextstrain/logs, named by the command
+and the time it started.  Only the most recent KEEP_LOGS logs of each command
+are kept.  Memory use is the same no matter how much output there is.
+"""
+
+import gzip
+import os
+import subprocess
+import sys
+import threading
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from .paths import LOGS
+from .util import warn, colored
+
+
+# Number of logs kept for each command, newest first.
+KEEP_LOGS = 20
+
+# Number of lines of output shown again if the program fails, and the length
+# in bytes after which each is cut off (and marked with "…").
+TAIL_LINES  = 40
+LINE_LENGTH = 1024
+
+# Output is read in chunks of up to this size as soon as it's available.
+CHUNK_SIZE = 64 * 1024
+
+
+def run(argv, name: str, **kwargs) -> int:
+    """
+    Run *argv* with its standard output and error streamed to ours and both
+    written to a new log for the command *name*, and return its exit status.
+
+    If it fails, the last TAIL_LINES lines of output and the log's path are
+    shown.  Other keyword arguments are passed to subprocess.Popen.
+    """
+    log_path = new_log(name)
+    tail     = deque(maxlen = TAIL_LINES) # type: deque
+    lock     = threading.Lock()
+
+    process = subprocess.Popen(argv, stdout = subprocess.PIPE, stderr = subprocess.PIPE, **kwargs)
+
+    with gzip.open(str(log_path), "wb") as log:
+        def tee(stream, terminal):
+            partial = b""
+
+            try:
+                for chunk in iter(lambda: os.read(stream.fileno(), CHUNK_SIZE), b""):
+                    # Whole chunks go to the log in the order they're read, so
+                    # it interleaves the two streams like a terminal would.
+                    with lock:
+                        terminal.write(chunk)
+                        terminal.flush()
+                        log.write(chunk)
+
+                        # Only the start of the unfinished last line is
+                        # needed, plus a byte to tell whether it's too long.
+                        lines   = (partial + chunk).split(b"\n")
+                        partial = lines.pop()[:LINE_LENGTH + 1]
+
+                        tail.extend(truncate(line) for line in lines)
+            finally:
+                stream.close()
+
+            if partial:
+                with lock:
+                    tail.append(truncate(partial))
+
+        # Standard error is read by a thread of its own, so neither stream
+        # can fill up and block the program while we wait on the other.
+        errors = threading.Thread(target = tee, args = (process.stderr, sys.stderr.buffer), daemon = True)
+        errors.start()
+
+        try:
+            tee(process.stdout, sys.stdout.buffer)
+        except KeyboardInterrupt:
+            # The program was interrupted too; let it finish up first.
+            process.wait()
+            errors.join()
+            raise
+
+        errors.join()
+
+    status = process.wait()
+
+    if status != 0:
+        warn()
+        warn(colored("red", "Last %d lines of output:" % len(tail)))
+        warn()
+        for line in tail:
+            warn("    " + line.decode("utf-8", "replace").rstrip("\r"))
+        warn()
+        warn("Error running %s, exited %d.  The full output is in %s" % (name, status, log_path))
+
+    prune(name)
+
+    return status
+
+
+def truncate(line: bytes) -> bytes:
+    """
+    Returns the first LINE_LENGTH bytes of *line*, followed by "…" if there
+    were more.
+    """
+    if len(line) > LINE_LENGTH:
+        return line[:LINE_LENGTH] + "…".encode("utf-8")
+    else:
+        return line
+
+
+def new_log(name: str) -> Path:
+    """
+    Returns the path of a new log for the command *name*.
+    """
+    LOGS.mkdir(parents = True, exist_ok = True)
+
+    started = datetime.now().strftime("%Y%m%dT%H%M%S")
+
+    return LOGS / ("%s-%s-%d.log.gz" % (name, started, os.getpid()))
+
+
+def prune(name: str):
+    """
+    Removes all but the newest KEEP_LOGS logs for the command *name*.
+    """
+    # Names sort by the time they were started.
+    logs = sorted(LOGS.glob("%s-*.log.gz" % name), reverse = True)
+
+    for path in logs[KEEP_LOGS:]:
+        try:
+            path.unlink()
+        except OSError:
+            pass
@@ -0,0 +1,237 @@
+"""
+Metrics about each run of a command, for monitoring unattended builds and
+deploys (e.g. from cron) across many computers.
+
+Metrics are enabled by the global --metrics option (or the NEXTSTRAIN_METRICS
+environment variable), which names a file to write them to when the command
+exits.  While enabled, instrumented code adds to named values in memory.
+
+If the file name ends in .prom, it's written in the text format read by the
+Prometheus node exporter's textfile collector, with each metric labeled by
+command.  The file is updated in place: values for other commands are kept,
+and run counts accumulate across runs, so one file can be shared by all
+commands on a computer.  Otherwise, a JSON object of the run's metrics is
+appended to the file as a single line.
+
+While disabled, recording is a function call and a global lookup.
+"""
+
+import json
+import os
+import re
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter, time
+from typing import Dict, List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows.
+    fcntl = None # type: ignore
+
+
+# Known metrics by name, with their Prometheus type and help text.  Metrics
+# from each run are gauges, except for the accumulated run counts.
+METRICS = {
+    "command_duration_seconds":             ("gauge",   "Duration of the last run of the command"),
+    "command_exit_code":                    ("gauge",   "Exit code of the last run of the command"),
+    "command_last_run_timestamp_seconds":   ("gauge",   "Time the last run of the command finished, in seconds since the epoch"),
+    "command_runs_total":                   ("counter", "Runs of the command, by result"),
+    "deploy_files_uploaded":                ("gauge",   "Files uploaded by the last deploy"),
+    "deploy_files_skipped":                 ("gauge",   "Unchanged files skipped by the last deploy"),
+    "deploy_files_deleted":                 ("gauge",   "Files deleted by the last deploy"),
+    "deploy_bytes_uploaded":                ("gauge",   "Compressed bytes uploaded by the last deploy"),
+    "deploy_bytes_skipped":                 ("gauge",   "Compressed bytes of unchanged files skipped by the last deploy"),
+    "cloudfront_invalidation_wait_seconds": ("gauge",   "Time spent waiting for CloudFront invalidations by the last deploy"),
+    "image_pull_seconds":                   ("gauge",   "Time spent pulling the Docker image by the last update"),
+}
+
+PREFIX = "nextstrain_"
+
+_values = None  # type: Optional[Dict[str, float]]
+_lock   = threading.Lock()
+
+
+class timer:
+    """
+    Context manager which adds the time spent within it to a metric.
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add(self.name, perf_counter() - self.start)
+        return False
+
+
+def enable() -> None:
+    """
+    Start recording metrics, from zero.
+    """
+    global _values
+    _values = {}
+
+
+def enabled() -> bool:
+    return _values is not None
+
+
+def add(name: str, value: float = 1) -> None:
+    """
+    Add *value* to the named metric, which starts at zero.  May be called
+    from multiple threads.
+    """
+    if _values is None:
+        return
+
+    with _lock:
+        _values[name] = _values.get(name, 0) + value
+
+
+def write(path: Path, command: str, exit_code: int, duration: float) -> None:
+    """
+    Write the metrics recorded for a run of *command* to the given path, in
+    the format chosen by its name.
+    """
+    values = {
+        **(_values or {}),
+        "command_duration_seconds": duration,
+        "command_exit_code": exit_code,
+        "command_last_run_timestamp_seconds": time(),
+    }
+
+    if path.suffix == ".prom":
+        write_textfile(path, command, values)
+    else:
+        write_json_line(path, command, values)
+
+
+def write_json_line(path: Path, command: str, values: Dict[str, float]) -> None:
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "host": socket.gethostname(),
+        "command": command,
+        **values,
+    }
+
+    with path.open("a") as file:
+        file.write(json.dumps(record, sort_keys = True) + "\n")
+
+
+def write_textfile(path: Path, command: str, values: Dict[str, float]) -> None:
+    """
+    Update the Prometheus textfile at *path* with this run's values,
+    replacing the previous run's values for *command*.
+
+    The file is replaced atomically, as the node exporter may read it at any
+    time, and other commands writing to it at the same time wait their turn
+    so none of their updates are lost.
+    """
+    with locked(path):
+        update_textfile(path, command, values)
+
+
+def update_textfile(path: Path, command: str, values: Dict[str, float]) -> None:
+    samples = read_textfile(path)
+
+    # Keep other commands' samples, and this command's run counts so they
+    # accumulate.
+    runs_total = PREFIX + "command_runs_total"
+    result     = "success" if values["command_exit_code"] == 0 else "failure"
+
+    runs = {
+        labels: value
+            for (name, labels), value in samples.items()
+             if name == runs_total and label_value(labels, "command") == command
+    }
+
+    samples = {
+        (name, labels): value
+            for (name, labels), value in samples.items()
+             if label_value(labels, "command") != command
+    }
+
+    for outcome in ["success", "failure"]:
+        labels = 'command="%s",result="%s"' % (command, outcome)
+        samples[(runs_total, labels)] = runs.get(labels, 0) + (1 if outcome == result else 0)
+
+    for name, value in values.items():
+        samples[(PREFIX + name, 'command="%s"' % command)] = value
+
+    lines = [] # type: List[str]
+
+    for name in sorted({ name for name, labels in samples }):
+        type_, help = METRICS.get(name[len(PREFIX):], ("gauge", ""))
+
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, type_))
+
+        for (name_, labels), value in sorted(samples.items()):
+            if name_ == name:
+                lines.append("%s{%s} %s" % (name, labels, format_value(value)))
+
+    partial = path.with_name("." + path.name + ".partial")
+    partial.write_text("\n".join(lines) + "\n")
+    os.replace(str(partial), str(path))
+
+
+@contextmanager
+def locked(path: Path):
+    """
+    Context manager which holds an exclusive lock for updating *path*.
+
+    The lock is taken on a separate lock file, as *path* itself is replaced
+    by each update.  Where locking isn't supported (Windows), no lock is
+    taken.
+    """
+    if fcntl is None:
+        yield
+        return
+
+    with path.with_name("." + path.name + ".lock").open("a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+SAMPLE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)\{(?P<labels>[^}]*)\} (?P<value>\S+)$')
+
+
+def read_textfile(path: Path) -> Dict[tuple, float]:
+    """
+    Returns the samples in a textfile written by write_textfile(), keyed by
+    (name, labels).  Lines which aren't samples are ignored.
+    """
+    samples = {}
+
+    try:
+        with path.open() as file:
+            for line in file:
+                match = SAMPLE.match(line.strip())
+
+                if match:
+                    samples[(match.group("name"), match.group("labels"))] = float(match.group("value"))
+    except OSError:
+        pass
+
+    return samples
+
+
+def label_value(labels: str, label: str) -> Optional[str]:
+    match = re.search(r'(?:^|,)%s="([^"]*)"' % re.escape(label), labels)
+    return match.group(1) if match else None
+
+
+def format_value(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
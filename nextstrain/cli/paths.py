@@ -0,0 +1,34 @@
+"""
+Paths to local state kept by this package.
+"""
+
+import os
+from pathlib import Path
+
+
+# Our home directory for local state, e.g. ~/.nextstrain
+HOME = Path(os.environ.get("NEXTSTRAIN_HOME") or Path.home() / ".nextstrain")
+
+# Managed environment for the native runner
+NATIVE_ENV = Path(os.environ.get("NEXTSTRAIN_NATIVE_ENV") or HOME / "native-env")
+
+# In-progress multipart uploads made by the deploy command
+DEPLOY_JOURNAL = HOME / "deploy-journal"
+
+# Shell completion scripts installed by the completion command, by shell.
+# Bash loads completions from this directory on demand.  Zsh users source the
+# script from their ~/.zshrc.
+COMPLETION_SCRIPTS = {
+    "bash": Path(os.environ.get("XDG_DATA_HOME") or Path.home() / ".local" / "share") / "bash-completion" / "completions" / "nextstrain",
+    "zsh":  HOME / "completion.zsh",
+}
+
+# Compressed logs of the output of builds
+LOGS = HOME / "logs"
+
+# Local copy of the build output cache
+BUILD_CACHE = HOME / "build-cache"
+
+# Socket on which `nextstrain daemon` accepts builds, and its saved state
+DAEMON_SOCKET = Path(os.environ.get("NEXTSTRAIN_DAEMON_SOCKET") or HOME / "daemon.sock")
+DAEMON_STATE  = HOME / "daemon"
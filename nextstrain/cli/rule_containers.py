@@ -0,0 +1,255 @@
+"""
+Runs each job of a snakemake build in its own container.
+
+Snakemake itself runs in one container as usual, but as a "cluster" whose
+submit command hands each job's script to us through a small queue directory
+mounted into that container.  We run each job in a new container from the
+same image with the same volumes and environment, limited to the CPUs and
+memory the job's rule asks for with `threads` and `resources: mem_mb`.
+
+Snakemake notices when jobs finish by the marker files their scripts write to
+the shared build directory, so nothing needs to be passed back.  If a job's
+container exits unsuccessfully before its script can write a marker (e.g. it
+was killed for running out of memory, or Docker couldn't start it), we write
+the job's failure marker ourselves so snakemake doesn't wait for it forever.
+"""
+
+import json
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from pathlib import Path, PurePosixPath
+from typing import List, Optional
+from .runner import docker
+from .util import warn
+from .volume import NamedVolume
+
+
+# Where the queue directory is mounted inside the snakemake container.
+CONTAINER_PATH = "/nextstrain/rule-queue"
+
+# How often, in seconds, to check the queue for new jobs.
+POLL_INTERVAL = 0.2
+
+# Snakemake calls this with the path of each job's script appended.  It
+# writes the path followed by the script's contents to a new file in the
+# queue.  Snakemake formats the command with str.format(), so it must not
+# contain braces.
+SUBMIT = """sh -c '(echo "$0"; cat "$0") > %(queue)s/.$$ && mv %(queue)s/.$$ %(queue)s/$(basename "$0") && basename "$0"'""" % { "queue": CONTAINER_PATH }
+
+# Matches the failure marker a job script writes, as in snakemake's:
+#     … && touch "{jobfinished}" || (touch "{jobfailed}"; exit 1)
+FAILED_MARKER = re.compile(r'touch "([^"]+\.jobfailed)"')
+
+# Options which set the number of jobs snakemake runs at once.
+JOBS_OPTIONS = ["-j", "--jobs", "--cores"]
+
+
+def configure(opts, extra_env = {}) -> "dispatcher":
+    """
+    Set up the given build options to run snakemake as a cluster of
+    containers, and return a dispatcher which runs its jobs while in use as a
+    context manager.
+    """
+    queue = Path(tempfile.mkdtemp(prefix = "nextstrain-rule-queue-"))
+
+    # Jobs launched by the dispatcher get the same volumes, so this is set up
+    # before it copies the options.
+    opts.volumes.append(NamedVolume("rule-queue", queue))
+
+    dispatch = dispatcher(opts, queue, extra_env)
+
+    # Snakemake requires a limit on concurrent jobs with --cluster.
+    if not any(arg.split("=")[0] in JOBS_OPTIONS or re.match(r"^-j\d", arg) for arg in opts.extra_exec_args):
+        opts.extra_exec_args = [*opts.extra_exec_args, "--jobs", str(os.cpu_count() or 1)]
+
+    opts.extra_exec_args = [*opts.extra_exec_args, "--cluster", SUBMIT]
+
+    return dispatch
+
+
+class dispatcher:
+    """
+    Watches the queue directory for jobs submitted by snakemake and runs each
+    in its own container.
+    """
+    def __init__(self, opts, queue: Path, extra_env = {}) -> None:
+        self.queue   = queue
+        self.stopped = threading.Event()
+        self.running = [] # type: List[subprocess.Popen]
+
+        synced_volume = docker.sync_volume_name(opts.build) if opts.sync_volume else None
+
+        self.image = opts.image
+        self.args  = docker.container_args(opts, opts.build, extra_env, synced_volume)
+
+        # Volumes bind-mounted from this computer, whose files we can reach
+        # directly.
+        self.volumes = [
+            volume for volume in opts.volumes
+                    if volume.src is not None
+                   and not (synced_volume and volume == opts.build)
+        ]
+
+    def __enter__(self):
+        self.thread = threading.Thread(target = self.watch, daemon = True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+        # Anything still running was abandoned by snakemake, e.g. because
+        # it was interrupted.
+        for process in self.running:
+            if process.poll() is None:
+                process.terminate()
+
+        for process in self.running:
+            process.wait()
+
+        shutil.rmtree(str(self.queue), ignore_errors = True)
+
+    def watch(self):
+        while not self.stopped.wait(POLL_INTERVAL):
+            for entry in sorted(self.queue.iterdir()):
+                # Hidden files are still being written.
+                if not entry.name.startswith("."):
+                    self.start(entry)
+
+            self.running = [ p for p in self.running if not self.reaped(p) ]
+
+    def start(self, entry: Path):
+        script_path = ""
+        properties  = {} # type: dict
+        failed      = None
+
+        try:
+            with entry.open() as file:
+                script_path = file.readline().strip()
+                script      = file.read()
+
+            failed     = failed_marker(script)
+            properties = job_properties(script)
+        except (OSError, ValueError) as error:
+            warn("Error reading job %s: %s" % (entry.name, error))
+        finally:
+            entry.unlink()
+
+        argv = [
+            "docker", "run", "--rm",
+            *self.args,
+            *limits(properties),
+            self.image,
+            "sh", script_path,
+        ]
+
+        try:
+            process = subprocess.Popen(argv, stdin = subprocess.DEVNULL)
+        except OSError as error:
+            warn("Error starting container for job %s: %s" % (entry.name, error))
+            self.mark_failed(entry.name, failed)
+        else:
+            process.job    = entry.name # type: ignore
+            process.failed = failed     # type: ignore
+            self.running.append(process)
+
+    def reaped(self, process: subprocess.Popen) -> bool:
+        status = process.poll()
+
+        if status is None:
+            return False
+
+        # The job script may not have run to the end to tell snakemake how
+        # it went, e.g. if the container was killed for using too much
+        # memory (137) or Docker itself failed (125–127).
+        if status != 0:
+            warn("Container for job %s exited %d" % (process.job, status)) # type: ignore
+            self.mark_failed(process.job, process.failed) # type: ignore
+
+        return True
+
+    def mark_failed(self, job: str, marker: Optional[str]):
+        """
+        Write the failure marker snakemake is waiting for, unless the job
+        already wrote its success or failure marker.
+        """
+        if not marker:
+            warn("Error: Unable to tell snakemake that job %s failed, as its script has no failure marker." % job)
+            return
+
+        finished = str(PurePosixPath(marker).with_suffix(".jobfinished"))
+        local    = self.local_path(marker)
+
+        if local:
+            if not local.with_suffix(".jobfinished").exists():
+                local.touch()
+            return
+
+        # The marker is only reachable from a container, e.g. in a synced
+        # Docker volume.
+        status = subprocess.call([
+            "docker", "run", "--rm",
+            *self.args,
+            self.image,
+            "sh", "-c", '[ -e "$1" ] || touch "$2"', "sh", finished, marker,
+        ], stdin = subprocess.DEVNULL)
+
+        if status != 0:
+            warn("Error: Unable to tell snakemake that job %s failed; exited %d writing %s" % (job, status, marker))
+
+    def local_path(self, container_path: str) -> Optional[Path]:
+        """
+        Returns the path on this computer of a path within a bind-mounted
+        volume in the container, or None if it isn't in one.
+        """
+        for volume in self.volumes:
+            mount = PurePosixPath("/nextstrain", volume.name)
+            path  = PurePosixPath(container_path)
+
+            if mount in path.parents:
+                return volume.src.resolve() / str(path.relative_to(mount))
+
+        return None
+
+
+def failed_marker(script: str) -> Optional[str]:
+    """
+    Returns the container path of the marker file a job script writes when
+    the job fails, if it has one.
+    """
+    match = FAILED_MARKER.search(script)
+
+    return match.group(1) if match else None
+
+
+def job_properties(script: str) -> dict:
+    """
+    Returns the properties snakemake embeds in a job script, such as the
+    rule's threads and resources.
+    """
+    match = re.search(r"^# properties = (.+)$", script, re.MULTILINE)
+
+    return json.loads(match.group(1)) if match else {}
+
+
+def limits(properties: dict) -> List[str]:
+    """
+    Returns the `docker run` options limiting a container to the CPUs and
+    memory requested by a job.
+    """
+    threads = properties.get("threads")
+    mem_mb  = properties.get("resources", {}).get("mem_mb")
+
+    # Docker refuses to allow more CPUs than the computer has.
+    if threads:
+        threads = min(threads, os.cpu_count() or threads)
+
+    return [
+        *(["--cpus=%s" % threads] if threads else []),
+        *(["--memory=%dm" % mem_mb] if isinstance(mem_mb, (int, float)) and mem_mb > 0 else []),
+    ]
@@ -1,5 +1,102 @@
-from . import docker
+"""
+Runners execute a program (snakemake, bash, auspice, etc.) for the build,
+shell, and view commands in a particular computing environment.
+
+Each runner module provides the same interface:
+
+    register_arguments(parser, volumes)
+    run(opts, working_volume, extra_env, log) -> int
+    test_setup() -> [(description, result), …]
+    update() -> bool
+    print_version()
+
+The runner used by a command is selected with the --docker or --native
+options registered by register_runners().
+"""
+
+import argparse
+from . import docker, native
+
 
 all_runners = [
     docker,
+    native,
 ]
+
+default_runner = docker
+
+
+def register_runners(parser, exec, volumes = [], runners = all_runners, default = default_runner):
+    """
+    Register runner selection options and each runner's own arguments on the
+    given command parser.
+
+    The *exec* list is the default program and arguments to run.  An Ellipsis
+    (...) in the list is replaced by any additional arguments given on the
+    command line.  The *volumes* list names the components which may be
+    replaced with a local copy, for runners which support doing so.
+    """
+    # Unpack exec parameter into the command and everything else
+    (exec_cmd, *exec_args) = exec
+
+    selection = parser.add_argument_group(
+        "runner selection options",
+        "Select the environment in which to run %s.  The default is --%s." % (exec_cmd, runner_name(default)))
+
+    parser.set_defaults(__runner__ = default)
+
+    for runner in runners:
+        selection.add_argument(
+            "--" + runner_name(runner),
+            help    = runner.__doc__.strip().splitlines()[0],
+            dest    = "__runner__",
+            action  = "store_const",
+            const   = runner,
+            default = argparse.SUPPRESS)
+
+    # Development options
+    development = parser.add_argument_group(
+        "development options",
+        "These should generally be unnecessary unless you're developing build images.")
+
+    development.add_argument(
+        "--exec",
+        help    = "Program to exec inside the build environment",
+        metavar = "<prog>",
+        default = exec_cmd)
+
+    development.set_defaults(volumes = [])
+
+    for runner in runners:
+        runner.register_arguments(development, volumes = volumes)
+
+    # Optional exec arguments
+    parser.set_defaults(exec_args = exec_args)
+    parser.set_defaults(extra_exec_args = [])
+
+    if ... in exec_args:
+        parser.add_argument(
+            "extra_exec_args",
+            help    = "Additional arguments to pass to the executed build program",
+            metavar = "...",
+            nargs   = argparse.REMAINDER)
+
+
+def run(opts, working_volume = None, extra_env = {}, log = None) -> int:
+    """
+    Run the program given by *opts* using the selected runner.
+
+    The optional *working_volume* is the named volume the program works in.
+    Natively, it's the program's working directory; in a container, the
+    image's default working directory is used.  The optional *extra_env* dict is passed into the
+    program's environment.  If a *log* name is given, the program's output is
+    also written to a log of that name (see nextstrain.cli.logs).
+    """
+    return opts.__runner__.run(opts, working_volume = working_volume, extra_env = extra_env, log = log)
+
+
+def runner_name(runner) -> str:
+    """
+    Returns the short name of a runner module, e.g. "docker".
+    """
+    return runner.__name__.split(".")[-1]
@@ -2,100 +2,110 @@
 Run commands inside a container image using Docker.
 """
 
+import hashlib
+import inspect
+import json
 import os
 import shutil
-import argparse
+import struct
 import subprocess
-from collections import namedtuple
+import sys
 from pathlib import Path
-from ..util import warn, colored, capture_output
+from typing import List
+from .. import logs, metrics, sync, trace
+from ..util import warn, colored, capture_output, replace_ellipsis
+from ..volume import store_volume
 
 
 DEFAULT_IMAGE = "nextstrain/base"
 COMPONENTS    = ["sacra", "fauna", "augur", "auspice"]
+SCRATCH       = "/nextstrain/scratch"
+
+# Image archives start with a manifest in a zstd skippable frame, which is
+# identified by a magic number in the range 0x184D2A50 to 0x184D2A5F.
+ARCHIVE_MANIFEST_MAGIC = 0x184D2A5E
+ARCHIVE_VERSION        = 1
+
+# Runs a program (given in "$@" after the destination and patterns) and, if it
+# succeeds, copies files in the scratch space matching the patterns to the
+# destination, preserving their relative paths.
+KEEP_SCRATCH = """
+    destination="$1"; count="$2"; shift 2
+    patterns=("${@:1:$count}"); shift "$count"
+
+    "$@"
+    status=$?
+
+    if [[ $status -eq 0 ]]; then
+        cd "$NEXTSTRAIN_SCRATCH" || exit 1
+        shopt -s globstar nullglob
+        IFS=$'\\n'
+
+        for pattern in "${patterns[@]}"; do
+            for path in $pattern; do
+                echo "Keeping $path from scratch space"
+                cp -a --parents "$path" "$destination"/ || exit 1
+            done
+        done
+    fi
 
+    exit $status
+"""
 
-def store_volume(volume_name):
-    """
-    Generates and returns an argparse.Action subclass for storing named volume
-    tuples.
-
-    Multiple argparse arguments can use this to cooperatively accept source
-    path definitions for named volumes.
-
-    Each named volume is stored as a namedtuple (name, src).  The tuple is
-    stored on the options object under the volume's name (modified to replace
-    slashes with underscores), as well as added to a shared list of volumes,
-    accessible via the "volumes" attribute on the options object.
 
-    For convenient path manipulation and testing, the "src" value is stored as
-    a Path object.
+def register_arguments(parser, volumes = []):
     """
-    volume = namedtuple("volume", ("name", "src"))
-
-    class store(argparse.Action):
-        def __call__(self, parser, namespace, values, option_strings = None):
-            # Add the new volume to the list of volumes
-            volumes    = getattr(namespace, "volumes", [])
-            new_volume = volume(volume_name, Path(values))
-            setattr(namespace, "volumes", [*volumes, new_volume])
-
-            # Allow the new volume to be found by name on the opts object
-            setattr(namespace, volume_name.replace('/', '_'), new_volume)
-
-    return store
-
-
-def register_arguments(parser, exec=None, volumes=[]):
-    # Unpack exec parameter into the command and everything else
-    (exec_cmd, *exec_args) = exec
-
-    # Development options
-    development = parser.add_argument_group(
-        "development options",
-        "These should generally be unnecessary unless you're developing build images.")
-
-    development.add_argument(
+    Register arguments specific to this runner on the given parser (or
+    argument group).
+    """
+    parser.add_argument(
         "--image",
         help    = "Container image in which to run the pathogen build",
         metavar = "<name>",
         default = DEFAULT_IMAGE)
 
-    development.add_argument(
-        "--exec",
-        help    = "Program to exec inside the build container",
-        metavar = "<prog>",
-        default = exec_cmd)
-
-    development.set_defaults(volumes = [])
-
     for name in volumes:
-        development.add_argument(
+        parser.add_argument(
             "--" + name,
             help    = "Replace the image's copy of %s with a local copy" % name,
             metavar = "<dir>",
             action  = store_volume(name))
 
-    development.add_argument(
+    parser.add_argument(
         "--docker-arg",
         help    = "Additional arguments to pass to `docker run`",
         metavar = "...",
         dest    = "docker_args",
         action  = "append")
 
-    # Optional exec arguments
-    parser.set_defaults(exec_args = exec_args)
-    parser.set_defaults(extra_exec_args = [])
-
-    if ... in exec_args:
-        parser.add_argument(
-            "extra_exec_args",
-            help    = "Additional arguments to pass to the executed build program",
-            metavar = "...",
-            nargs   = argparse.REMAINDER)
-
-
-def run(opts):
+    parser.add_argument(
+        "--sync-volume",
+        help    = "Copy the build directory into a Docker volume and run there "
+                  "instead of bind-mounting it, then copy changed files back "
+                  "afterwards.  Only files which differ by size or modification "
+                  "time are copied.  Useful when the build directory is on a slow "
+                  "or networked filesystem.",
+        action  = "store_true")
+
+    parser.add_argument(
+        "--scratch",
+        help    = "Mount an in-memory (tmpfs) scratch space of the given size (e.g. 2g) "
+                  "at %s for intermediate files.  TMPDIR and NEXTSTRAIN_SCRATCH are "
+                  "set to its path." % SCRATCH,
+        metavar = "<size>")
+
+    parser.add_argument(
+        "--keep-scratch",
+        help    = "Copy files in the scratch space matching the given glob pattern "
+                  "(e.g. 'results/**/*.json') to the build directory if the build "
+                  "succeeds.  May be given multiple times.",
+        metavar = "<pattern>",
+        dest    = "keep_scratch",
+        action  = "append",
+        default = [])
+
+
+def run(opts, working_volume = None, extra_env = {}, log = None):
     # Ensure all volume source paths exist.  Docker will auto-create missing
     # directories in the path, which, while desirable under some circumstances,
     # doesn't match up well with our use case.  We're aiming to not surprise or
@@ -114,20 +124,80 @@ def run(opts):
     if opts.docker_args is None:
         opts.docker_args = []
 
+    if opts.keep_scratch and not (opts.scratch and working_volume):
+        warn("Error: --keep-scratch requires --scratch and a build directory")
+        return 1
+
+    # Run with a copy of the working volume in a Docker volume instead of
+    # bind-mounting it directly, if requested.
+    if opts.sync_volume and working_volume:
+        synced_volume = sync_volume_name(working_volume)
+
+        status = sync_in(opts.image, working_volume, synced_volume)
+
+        if status != 0:
+            return status
+    else:
+        synced_volume = None
+
     argv = [
         "docker", "run",
         "--rm",             # Remove the ephemeral container after exiting
-        "--tty",            # Colors, etc.
         "--interactive",    # Pass through control signals (^C, etc.)
 
+        # Colors, etc., but only when we have a terminal; Docker refuses to
+        # allocate one otherwise, e.g. when run from cron.
+        *(["--tty"] if sys.stdin.isatty() else []),
+
+        *container_args(opts, working_volume, extra_env, synced_volume),
+        opts.image,
+
+        # Wrap the program so chosen files are kept from the scratch space
+        # before the container and its tmpfs goes away.
+        *([
+            "bash", "-c", KEEP_SCRATCH, "keep-scratch",
+                "/nextstrain/%s" % working_volume.name,
+                str(len(opts.keep_scratch)),
+                *opts.keep_scratch,
+        ] if opts.keep_scratch else []),
+
+        opts.exec,
+        *replace_ellipsis(opts.exec_args, opts.extra_exec_args)
+    ]
+
+    with trace.span("docker run", image = opts.image, exec = opts.exec):
+        if log:
+            status = logs.run(argv, log)
+        else:
+            status = subprocess.run(argv).returncode
+
+    # The log reports failures itself, without the full command.
+    if status != 0 and not log:
+        warn("Error running %s, exited %d" % (argv, status))
+
+    # Copy back changes even if the program failed, since partial output (e.g.
+    # logs) is useful for figuring out what went wrong.
+    if synced_volume:
+        status = sync_out(opts.image, synced_volume, working_volume) or status
+
+    return status
+
+
+def container_args(opts, working_volume = None, extra_env = {}, synced_volume = None) -> List[str]:
+    """
+    Returns the `docker run` options for the user, volumes, environment, and
+    scratch space requested by *opts*, shared by every container of a run.
+    """
+    return [
         # On Unix (POSIX) systems, run the process in the container with the same
         # UID/GID so that file ownership is correct in the bind mount directories.
         # The getuid()/getgid() functions are documented to be only available on
         # Unix systems, not, for example, Windows.
         *(["--user=%d:%d" % (os.getuid(), os.getgid())] if os.name == "posix" else []),
 
-        # Map directories to bind mount into the container.
-      *["--volume=%s:/nextstrain/%s" % (v.src.resolve(), v.name)
+        # Map directories to bind mount into the container, or the synced
+        # Docker volume in place of the working volume.
+      *["--volume=%s:/nextstrain/%s" % (synced_volume if synced_volume and v == working_volume else v.src.resolve(), v.name)
             for v in opts.volumes
              if v.src is not None],
 
@@ -135,39 +205,115 @@ def run(opts):
         "--env=RETHINK_HOST",
         "--env=RETHINK_AUTH_KEY",
 
-        *opts.docker_args,
-        opts.image,
-        opts.exec,
-        *replace_ellipsis(opts.exec_args, opts.extra_exec_args)
+        # Plus any extra environment requested by the command
+        *["--env=%s=%s" % (name, value) for name, value in extra_env.items()],
+
+        # Mount scratch space for intermediate files, if requested.  It's
+        # world-writable (with the sticky bit) since we run as the local user.
+        *([
+            "--tmpfs=%s:rw,exec,mode=1777,size=%s" % (SCRATCH, opts.scratch),
+            "--env=TMPDIR=%s" % SCRATCH,
+            "--env=NEXTSTRAIN_SCRATCH=%s" % SCRATCH,
+        ] if opts.scratch else []),
+
+        *(opts.docker_args or []),
     ]
 
+
+def sync_volume_name(volume) -> str:
+    """
+    Returns the name of the Docker volume used to hold a synced copy of the
+    given named volume.
+
+    The name is stable for a given local directory, so subsequent runs only
+    need to copy what's changed since the last run.
+    """
+    path = str(volume.src.resolve())
+
+    return "nextstrain-sync-%s-%s" % (
+        volume.name.replace("/", "-"),
+        hashlib.sha1(path.encode("utf-8")).hexdigest()[:12])
+
+
+def sync_in(image, volume, docker_volume) -> int:
+    """
+    Update the given Docker volume to mirror the local directory of the given
+    named volume, creating the Docker volume if necessary.
+    """
+    print(colored("bold", "Syncing %s into Docker volume %s…" % (volume.src, docker_volume)))
+
     try:
-        subprocess.run(argv, check = True)
-    except subprocess.CalledProcessError as e:
-        warn("Error running %s, exited %d" % (e.cmd, e.returncode))
-        return e.returncode
-    else:
-        return 0
+        existing = capture_output(["docker", "volume", "ls", "--quiet", "--filter=name=^%s$" % docker_volume])
+
+        if not existing:
+            capture_output([
+                "docker", "volume", "create",
+                    "--label=org.nextstrain.sync.path=%s" % volume.src.resolve(),
+                    docker_volume])
+    except subprocess.CalledProcessError as error:
+        warn("Error creating Docker volume %s: " % docker_volume, error)
+        return error.returncode
+
+    # The copy runs as root so it can set ownership on the new files to match
+    # the user the build runs as.
+    return run_sync(
+        image,
+        src   = str(volume.src.resolve()),
+        dst   = docker_volume,
+        args  = ["--delete", *(["--owner=%d:%d" % (os.getuid(), os.getgid())] if os.name == "posix" else [])])
+
 
+def sync_out(image, docker_volume, volume) -> int:
+    """
+    Copy files which changed in the given Docker volume back to the local
+    directory of the given named volume.
 
-def replace_ellipsis(items, elided_items):
+    Files deleted from the Docker volume are not deleted locally.
     """
-    Replaces any Ellipsis items (...) in a list, if any, with the items of a
-    second list.
+    print(colored("bold", "Syncing changes from Docker volume %s back to %s…" % (docker_volume, volume.src)))
+
+    return run_sync(
+        image,
+        src   = docker_volume,
+        dst   = str(volume.src.resolve()),
+        user  = ["--user=%d:%d" % (os.getuid(), os.getgid())] if os.name == "posix" else [])
+
+
+def run_sync(image, src, dst, args = [], user = []) -> int:
     """
-    return [
-        y for x in items
-          for y in (elided_items if x is ... else [x])
+    Run our sync module inside a container from *image* to copy files from
+    *src* to *dst*, each of which may be a local path or Docker volume name.
+    """
+    argv = [
+        "docker", "run", "--rm",
+        *user,
+        "--volume=%s:/nextstrain/sync/src:ro" % src,
+        "--volume=%s:/nextstrain/sync/dst" % dst,
+        image,
+        "python3", "-c", inspect.getsource(sync),
+            "/nextstrain/sync/src",
+            "/nextstrain/sync/dst",
+            *args
     ]
 
+    try:
+        with trace.span("docker volume sync", src = src, dst = dst):
+            subprocess.run(argv, check = True)
+    except subprocess.CalledProcessError as e:
+        warn("Error syncing %s to %s, exited %d" % (src, dst, e.returncode))
+        return e.returncode
+    else:
+        return 0
+
 
 def test_setup():
     def test_run():
         try:
-            status = subprocess.run(
-                ["docker", "run", "--rm", "hello-world"],
-                check = True,
-                stdout = subprocess.DEVNULL)
+            with trace.span("docker run", image = "hello-world"):
+                status = subprocess.run(
+                    ["docker", "run", "--rm", "hello-world"],
+                    check = True,
+                    stdout = subprocess.DEVNULL)
         except:
             return False
         else:
@@ -187,16 +333,208 @@ def update():
 
     # Pull the latest image down
     try:
-        subprocess.run(
-            ["docker", "image", "pull", DEFAULT_IMAGE],
-            check = True)
+        with trace.span("docker image pull", image = DEFAULT_IMAGE), metrics.timer("image_pull_seconds"):
+            subprocess.run(
+                ["docker", "image", "pull", DEFAULT_IMAGE],
+                check = True)
     except subprocess.CalledProcessError:
         return False
 
-    # Prune any old images which are now dangling to avoid leaving lots of
-    # hidden disk use around.  We don't use `docker image prune` because we
-    # want to just remove _our_ dangling images, not all.  We very much don't
-    # want to automatically prune unrelated images.
+    return prune_dangling_images()
+
+
+def update_from_archive(path: Path) -> bool:
+    """
+    Update the Docker image by loading it from an archive made by
+    export_image(), instead of pulling it from the registry.
+
+    Loading is skipped if the local image already has the same id as the
+    archived one.
+    """
+    print(colored("bold", "Updating Docker image %s from %s…" % (DEFAULT_IMAGE, path)))
+    print()
+
+    try:
+        manifest = read_archive_manifest(path)
+    except (OSError, ValueError) as error:
+        warn("Error reading image archive: ", error)
+        return False
+
+    if image_id(manifest["image"]) == manifest["id"]:
+        print("Local image already matches the archive (%s); skipping load." % manifest["id"])
+    else:
+        if not shutil.which("zstd"):
+            warn("Error: zstd is required to load image archives, but it isn't installed.")
+            return False
+
+        # Decompress into docker as a pipeline, so decompression and loading
+        # proceed in parallel without a temporary copy of the image on disk.
+        try:
+            with path.open("rb") as archive, trace.span("docker image load", archive = str(path)):
+                processes = [] # type: List[subprocess.Popen]
+
+                try:
+                    decompress = subprocess.Popen(["zstd", "--decompress", "--quiet", "--stdout"], stdin = archive, stdout = subprocess.PIPE)
+                    processes.append(decompress)
+
+                    load = subprocess.Popen(["docker", "image", "load"], stdin = decompress.stdout)
+                    processes.append(load)
+
+                    # Let zstd see a broken pipe if docker exits early.
+                    decompress.stdout.close() # type: ignore
+                    load.wait()
+                    decompress.wait()
+                finally:
+                    stop_processes(processes)
+        except OSError as error:
+            warn("Error loading image archive: ", error)
+            return False
+
+        if load.returncode != 0 or decompress.returncode != 0:
+            warn("Error loading image archive, exited %d (zstd) and %d (docker)" % (decompress.returncode, load.returncode))
+            return False
+
+        if image_id(manifest["image"]) != manifest["id"]:
+            warn("Error: Loaded image %s does not have the id %s recorded in the archive." % (manifest["image"], manifest["id"]))
+            return False
+
+    return prune_dangling_images()
+
+
+def export_image(path: Path) -> bool:
+    """
+    Save the local Docker image to a zstd-compressed archive at the given
+    path, for loading elsewhere with update_from_archive().
+
+    The archive is the compressed output of `docker image save`, preceded by
+    a JSON manifest of the image's name, id, and layer digests in a zstd
+    "skippable frame", which `zstd --decompress` ignores.  This lets the
+    manifest be read without decompressing the image.
+    """
+    if not shutil.which("zstd"):
+        warn("Error: zstd is required to export images, but it isn't installed.")
+        return False
+
+    try:
+        details = json.loads(capture_output(["docker", "image", "inspect", "--format={{json .}}", DEFAULT_IMAGE])[0])
+    except (OSError, subprocess.CalledProcessError):
+        warn("Error: No local copy of %s to export.  Run `nextstrain update` first." % DEFAULT_IMAGE)
+        return False
+
+    manifest = {
+        "version": ARCHIVE_VERSION,
+        "image":   DEFAULT_IMAGE,
+        "id":      details["Id"],
+        "created": details.get("Created"),
+        "layers":  details.get("RootFS", {}).get("Layers", []),
+    }
+
+    print(colored("bold", "Exporting Docker image %s (%s) to %s…" % (DEFAULT_IMAGE, manifest["id"], path)))
+
+    manifest_data = json.dumps(manifest, indent = 2).encode("utf-8")
+    partial_path  = path.with_name(path.name + ".partial")
+
+    try:
+        with partial_path.open("wb") as archive, trace.span("docker image save", archive = str(path)):
+            archive.write(struct.pack("<II", ARCHIVE_MANIFEST_MAGIC, len(manifest_data)))
+            archive.write(manifest_data)
+            archive.flush()
+
+            # Compress using all cores as docker writes the image out.
+            processes = [] # type: List[subprocess.Popen]
+
+            try:
+                save = subprocess.Popen(["docker", "image", "save", DEFAULT_IMAGE], stdout = subprocess.PIPE)
+                processes.append(save)
+
+                compress = subprocess.Popen(["zstd", "--threads=0", "--quiet", "--stdout"], stdin = save.stdout, stdout = archive)
+                processes.append(compress)
+
+                save.stdout.close() # type: ignore
+                compress.wait()
+                save.wait()
+            finally:
+                stop_processes(processes)
+
+        if save.returncode != 0 or compress.returncode != 0:
+            warn("Error exporting image, exited %d (docker) and %d (zstd)" % (save.returncode, compress.returncode))
+            partial_path.unlink()
+            return False
+
+        os.replace(str(partial_path), str(path))
+
+    except OSError as error:
+        warn("Error exporting image: ", error)
+
+        if partial_path.exists():
+            partial_path.unlink()
+
+        return False
+
+    print()
+    print("Load it on another computer with: nextstrain update --from-archive %s" % path.name)
+
+    return True
+
+
+def stop_processes(processes: List[subprocess.Popen]) -> None:
+    """
+    Kill and wait for any of the given processes which are still running, as
+    when starting or waiting for others in the same pipeline failed or was
+    interrupted.  Processes which already exited are left as-is.
+    """
+    for process in processes:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+
+def read_archive_manifest(path: Path) -> dict:
+    """
+    Returns the manifest of an image archive made by export_image().
+
+    Raises a ValueError if the file isn't such an archive.
+    """
+    with path.open("rb") as archive:
+        header = archive.read(8)
+
+        if len(header) != 8:
+            raise ValueError("%s is not a Nextstrain image archive" % path)
+
+        magic, size = struct.unpack("<II", header)
+
+        if magic != ARCHIVE_MANIFEST_MAGIC:
+            raise ValueError("%s is not a Nextstrain image archive" % path)
+
+        manifest = json.loads(archive.read(size).decode("utf-8"))
+
+    if manifest.get("version") != ARCHIVE_VERSION:
+        raise ValueError("%s has unsupported archive version %s" % (path, manifest.get("version")))
+
+    return manifest
+
+
+def image_id(image: str):
+    """
+    Returns the id of the given local Docker image, or None if there's no
+    local copy.
+    """
+    try:
+        ids = capture_output(["docker", "image", "inspect", "--format={{.Id}}", image])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return ids[0] if ids else None
+
+
+def prune_dangling_images() -> bool:
+    """
+    Prune any old images which are now dangling to avoid leaving lots of
+    hidden disk use around.
+    """
+    # We don't use `docker image prune` because we want to just remove _our_
+    # dangling images, not all.  We very much don't want to automatically
+    # prune unrelated images.
     print()
     print(colored("bold", "Pruning old copies of image…"))
     print()
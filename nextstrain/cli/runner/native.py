@@ -0,0 +1,165 @@
+"""
+Run commands natively on this computer, without a container.
+
+Programs are run from a managed Python virtualenv or conda environment, if
+one exists, or otherwise from your PATH.  The managed environment defaults to
+~/.nextstrain/native-env and may be changed by setting the
+NEXTSTRAIN_NATIVE_ENV environment variable.  You can create it with either:
+
+    python3 -m venv ~/.nextstrain/native-env
+    conda create --prefix ~/.nextstrain/native-env python=3
+
+after which `nextstrain update` will install and upgrade the Nextstrain
+components within it.
+"""
+
+import os
+import shutil
+import subprocess
+from pathlib import Path
+from .. import logs, trace
+from ..paths import NATIVE_ENV as ENV
+from ..util import warn, colored, capture_output, replace_ellipsis
+
+
+PROGRAMS = ["snakemake", "augur", "auspice"]
+PACKAGES = ["snakemake", "nextstrain-augur"]
+
+
+def register_arguments(parser, volumes = []):
+    """
+    Register arguments specific to this runner on the given parser (or
+    argument group).
+
+    There are currently none, as the native runner uses the programs which
+    are installed and can't replace components with local copies.
+    """
+    pass
+
+
+def run(opts, working_volume = None, extra_env = {}, log = None):
+    # Replacing components with local copies (e.g. --augur) only makes sense
+    # for images.  Natively, install the local copy into the environment
+    # instead.
+    component_volumes = [ vol for vol in opts.volumes if vol is not working_volume ]
+
+    if component_volumes:
+        warn("Error: Local copies of components are not supported with --native:")
+        warn()
+        for vol in component_volumes:
+            warn("    • %s: %s" % (vol.name, vol.src))
+        warn()
+        warn("Install the local copies into your environment instead.")
+        return 1
+
+    if working_volume and not working_volume.src.is_dir():
+        warn("Error: The path given for %s does not exist or is not a directory: %s" % (working_volume.name, working_volume.src))
+        return 1
+
+    env = {
+        **os.environ,
+        **extra_env,
+        "PATH": search_path(),
+    }
+
+    program = shutil.which(opts.exec, path = env["PATH"])
+
+    if not program:
+        warn("Error: Unable to find %s in %s or your PATH." % (opts.exec, ENV))
+        return 1
+
+    argv = [
+        program,
+        *replace_ellipsis(opts.exec_args, opts.extra_exec_args)
+    ]
+
+    cwd = str(working_volume.src) if working_volume else None
+
+    with trace.span("native run", exec = opts.exec):
+        if log:
+            status = logs.run(argv, log, cwd = cwd, env = env)
+        else:
+            status = subprocess.run(argv, cwd = cwd, env = env).returncode
+
+    # The log reports failures itself, without the full command.
+    if status != 0 and not log:
+        warn("Error running %s, exited %d" % (argv, status))
+
+    return status
+
+
+def search_path() -> str:
+    """
+    Returns a PATH which searches the managed environment, if any, before the
+    current PATH.
+    """
+    return os.pathsep.join([
+        *([str(env_bin())] if ENV.is_dir() else []),
+        os.environ.get("PATH", os.defpath),
+    ])
+
+
+def env_bin() -> Path:
+    """
+    Returns the directory of executables in the managed environment.
+    """
+    return ENV / ("Scripts" if os.name == "nt" else "bin")
+
+
+def test_setup():
+    path = search_path()
+
+    return [
+        ('%s is installed' % program,
+            shutil.which(program, path = path) is not None)
+                for program in PROGRAMS
+    ]
+
+
+def update():
+    if not ENV.is_dir():
+        print(colored("bold", "No managed native environment at %s; skipping." % ENV))
+        return True
+
+    print(colored("bold", "Updating native environment %s…" % ENV))
+    print()
+
+    # Conda environments are marked by a conda-meta directory.  Anything else
+    # is assumed to be a virtualenv with pip.
+    if (ENV / "conda-meta").is_dir():
+        argv = ["conda", "update", "--yes", "--prefix", str(ENV), "--all"]
+    else:
+        argv = [str(env_bin() / "python"), "-m", "pip", "install", "--upgrade", *PACKAGES]
+
+    try:
+        with trace.span("update native environment", env = str(ENV)):
+            subprocess.run(argv, check = True)
+    except (OSError, subprocess.CalledProcessError) as error:
+        warn("Error updating native environment: ", error)
+        return False
+
+    return True
+
+
+def print_version():
+    print("native environment %s" % (ENV if ENV.is_dir() else "not present, using PATH"))
+
+    path = search_path()
+
+    for program in PROGRAMS:
+        print("  %s %s" % (program, program_version(shutil.which(program, path = path))))
+
+
+def program_version(program) -> str:
+    """
+    Returns the version reported by a program's --version option.
+    """
+    if not program:
+        return "not present"
+
+    try:
+        output = capture_output([program, "--version"])
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    return output[0] if output else "unknown"
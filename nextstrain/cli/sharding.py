@@ -0,0 +1,226 @@
+"""
+Split tree JSON files into chunks which can be loaded progressively.
+
+A large <prefix>_tree.json is split into:
+
+    <prefix>_tree.index.json            describes the chunks below
+    <prefix>_tree.skeleton.json         top of the tree, without attributes
+    <prefix>_tree.skeleton.attr.json    attributes for the skeleton's nodes
+    <prefix>_tree.shard-<id>.json       a subtree, without attributes
+    <prefix>_tree.shard-<id>.attr.json  attributes for the subtree's nodes
+
+The skeleton contains the nodes of the tree which have more than a given
+number of tips below them.  Each of its nodes whose children were split off
+into a shard has a "shard" key, giving the shard's id, in place of
+"children".  A shard file is the list of children for that node.  A shard's
+id is a hash of its content (both files), so it's the same each time the
+tree is sharded unless that subtree changed.
+
+Attributes (the "attr", "node_attrs", and "branch_attrs" keys of each node)
+are removed from the skeleton and shards and stored separately, as a list
+with an object per node in depth-first, pre-order, so that a client can
+render the shape of the tree before fetching them.  A shard's files are
+never rewritten with different content, as a changed subtree gets a new id,
+so shards may be fetched lazily and cached independently.  The index and
+skeleton change whenever any shard does.
+"""
+
+import json
+from hashlib import sha256
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from .util import remove_suffix
+
+
+# Subtrees with at most this many tips are split off into their own shard.
+MAX_TIPS = 5000
+
+# Keys of each node which are moved into the attribute chunks.
+ATTRIBUTE_KEYS = ("attr", "node_attrs", "branch_attrs")
+
+INDEX_VERSION = 1
+
+# Hex digits of the content hash used as each shard's id.
+SHARD_ID_LENGTH = 16
+
+
+def shard(tree_path: Path, output_dir: Optional[Path] = None, max_tips: int = MAX_TIPS) -> List[Path]:
+    """
+    Split the tree JSON file at *tree_path* into chunks written to
+    *output_dir*, which defaults to the tree's own directory.  Shards are
+    written as they're split off.  Shards of a previous split of the tree in
+    *output_dir* which aren't part of this one are removed.
+
+    Returns the paths written, starting with the index.
+    """
+    if output_dir is None:
+        output_dir = tree_path.parent
+
+    base    = remove_suffix(".json", tree_path.name)
+    written = [] # type: List[Path]
+
+    def write(name: str, data: str) -> str:
+        path = output_dir / name
+
+        with path.open("w", encoding = "utf-8") as file:
+            file.write(data)
+
+        written.append(path)
+        return name
+
+    with tree_path.open(encoding = "utf-8") as file:
+        tree = json.load(file)
+
+    if not isinstance(tree, dict):
+        raise ValueError("%s does not contain a tree (a JSON object)" % tree_path)
+
+    previous = previous_shards(output_dir / (base + ".index.json"))
+
+    tips   = tip_counts(tree)
+    shards = {} # type: Dict[str, dict]
+
+    def split_off(node: dict) -> str:
+        children, attributes = map(serialize, strip(node["children"]))
+
+        key  = shard_id(children, attributes)
+        name = "%s.shard-%s" % (base, key)
+
+        # Identical subtrees share a shard.
+        if key not in shards:
+            shards[key] = {
+                "shard":      key,
+                "tips":       tips[id(node)],
+                "tree":       write(name + ".json", children),
+                "attributes": write(name + ".attr.json", attributes),
+            }
+
+        # Release the subtree now that it's written, so memory use doesn't
+        # grow with copies of every shard.
+        del node["children"]
+
+        return key
+
+    def should_split(node: dict) -> bool:
+        return node is not tree and tips[id(node)] <= max_tips
+
+    (skeleton,), attributes = strip([tree], should_split, split_off)
+
+    index = {
+        "version":  INDEX_VERSION,
+        "source":   tree_path.name,
+        "tips":     tips[id(tree)],
+        "skeleton": {
+            "tree":       write(base + ".skeleton.json", serialize(skeleton)),
+            "attributes": write(base + ".skeleton.attr.json", serialize(attributes)),
+        },
+        "shards": list(shards.values()),
+    }
+
+    write(base + ".index.json", serialize(index))
+
+    for name in previous - { path.name for path in written }:
+        try:
+            (output_dir / name).unlink()
+        except FileNotFoundError:
+            pass
+
+    # Index first, as it's the entry point for clients.
+    return [written[-1], *written[:-1]]
+
+
+def previous_shards(index_path: Path) -> Set[str]:
+    """
+    Returns the names of the shard files listed by the index at *index_path*,
+    if it exists and is readable, or an empty set.
+    """
+    try:
+        with index_path.open(encoding = "utf-8") as file:
+            index = json.load(file)
+
+        return {
+            Path(name).name
+                for shard in index["shards"]
+                for name in (shard["tree"], shard["attributes"])
+        }
+    except (OSError, ValueError, KeyError, TypeError):
+        return set()
+
+
+def serialize(data) -> str:
+    """
+    Returns *data* as compact JSON.
+    """
+    return json.dumps(data, separators = (",", ":"))
+
+
+def shard_id(*contents: str) -> str:
+    """
+    Returns a hash of the given serialized contents of a shard's files.
+    """
+    digest = sha256()
+
+    for content in contents:
+        digest.update(content.encode("utf-8"))
+        digest.update(b"\0")
+
+    return digest.hexdigest()[:SHARD_ID_LENGTH]
+
+
+def strip(nodes: List[dict], should_split: Callable[[dict], bool] = lambda node: False, split_off: Optional[Callable[[dict], str]] = None) -> Tuple[List[dict], List[dict]]:
+    """
+    Copy the given list of (sub)trees without their attributes, which are
+    returned separately as a list in pre-order.
+
+    Nodes with children for which *should_split* returns true have their
+    children replaced by a "shard" key holding the result of calling
+    *split_off* with the node.
+
+    Trees may be much deeper than Python's recursion limit, so this walks
+    them with an explicit stack.
+    """
+    copies     = [ {} for node in nodes ] # type: List[dict]
+    attributes = [] # type: List[dict]
+    stack      = list(reversed(list(zip(nodes, copies))))
+
+    while stack:
+        node, copy = stack.pop()
+
+        attributes.append({ key: node[key] for key in ATTRIBUTE_KEYS if key in node })
+
+        for key, value in node.items():
+            if key not in ATTRIBUTE_KEYS and key != "children":
+                copy[key] = value
+
+        children = node.get("children")
+
+        if not children:
+            continue
+
+        if split_off and should_split(node):
+            copy["shard"] = split_off(node)
+        else:
+            copy["children"] = [ {} for child in children ]
+            stack.extend(reversed(list(zip(children, copy["children"]))))
+
+    return copies, attributes
+
+
+def tip_counts(tree: dict) -> Dict[int, int]:
+    """
+    Returns a dict mapping the id() of each node in the tree to the number of
+    tips at or below it.
+    """
+    counts = {} # type: Dict[int, int]
+    stack  = [(tree, False)]
+
+    while stack:
+        node, visited = stack.pop()
+        children = node.get("children") or []
+
+        if visited or not children:
+            counts[id(node)] = sum(counts[id(child)] for child in children) or 1
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in children)
+
+    return counts
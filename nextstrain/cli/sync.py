@@ -0,0 +1,119 @@
+"""
+Delta-only directory sync, comparing files by size and modification time.
+
+This module is intentionally self-contained and uses only the standard library
+so that its source can be run as-is inside a container image by another
+Python (e.g. `python3 -c "…" src dst`), where this package isn't installed.
+It must remain compatible with the oldest Python found in our images.
+"""
+
+import os
+import shutil
+import sys
+from argparse import ArgumentParser
+
+
+def sync(src, dst, delete = False, owner = None):
+    """
+    Make the directory *dst* match the directory *src* by copying only files
+    which are missing from *dst* or differ in size or modification time.
+
+    If *delete* is true, files and directories in *dst* which don't exist in
+    *src* are removed.  If *owner* is a (uid, gid) tuple, files copied into
+    *dst* are given that ownership.
+
+    Returns a (copied, deleted) tuple of counts.
+    """
+    copied  = 0
+    deleted = 0
+
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+        chown(dst, owner)
+
+    src_entries = { entry.name: entry for entry in os.scandir(src) }
+    dst_entries = { entry.name: entry for entry in os.scandir(dst) }
+
+    for name, entry in sorted(src_entries.items()):
+        src_path = os.path.join(src, name)
+        dst_path = os.path.join(dst, name)
+        existing = dst_entries.get(name)
+
+        if entry.is_dir(follow_symlinks = False):
+            if existing and not existing.is_dir(follow_symlinks = False):
+                remove(dst_path)
+
+            subcopied, subdeleted = sync(src_path, dst_path, delete, owner)
+            copied  += subcopied
+            deleted += subdeleted
+            continue
+
+        if existing and same_file(entry, existing):
+            continue
+
+        if existing:
+            remove(dst_path)
+
+        if entry.is_symlink():
+            os.symlink(os.readlink(src_path), dst_path)
+        else:
+            shutil.copy2(src_path, dst_path)
+
+        chown(dst_path, owner)
+        copied += 1
+
+    if delete:
+        for name in sorted(set(dst_entries) - set(src_entries)):
+            remove(os.path.join(dst, name))
+            deleted += 1
+
+    return copied, deleted
+
+
+def same_file(a, b):
+    """
+    Test if two os.DirEntry objects refer to files with the same type, size,
+    and modification time (to the second, since filesystems vary in
+    precision).
+    """
+    if a.is_symlink() or b.is_symlink():
+        return a.is_symlink() and b.is_symlink() and os.readlink(a.path) == os.readlink(b.path)
+
+    a_stat = a.stat(follow_symlinks = False)
+    b_stat = b.stat(follow_symlinks = False)
+
+    return a_stat.st_size == b_stat.st_size \
+       and int(a_stat.st_mtime) == int(b_stat.st_mtime)
+
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def chown(path, owner):
+    if owner is not None:
+        os.chown(path, *owner, follow_symlinks = False)
+
+
+def main(args):
+    parser = ArgumentParser(description = __doc__)
+    parser.add_argument("src")
+    parser.add_argument("dst")
+    parser.add_argument("--delete", action = "store_true")
+    parser.add_argument("--owner", metavar = "<uid>:<gid>")
+
+    opts  = parser.parse_args(args)
+    owner = tuple(int(x) for x in opts.owner.split(":")) if opts.owner else None
+
+    copied, deleted = sync(opts.src, opts.dst, opts.delete, owner)
+    chown(opts.dst, owner)
+
+    print("%d file(s) copied, %d deleted" % (copied, deleted))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,138 @@
+"""
+Lightweight tracing of where time is spent during a command.
+
+Tracing is enabled by the global --trace option (or the NEXTSTRAIN_TRACE
+environment variable).  While enabled, spans are recorded in memory and
+written out on exit as a Chrome trace-event JSON file, which can be loaded
+into Perfetto (https://ui.perfetto.dev) or chrome://tracing.
+
+While disabled, span() hands back a shared no-op context manager, so the cost
+to instrumented code is a function call and a global lookup.
+"""
+
+import json
+import os
+import threading
+from pathlib import Path
+from time import perf_counter
+from typing import Any, Dict, List, Optional
+
+
+# Recorded when this module is first imported, which happens before the rest
+# of the package is imported, so that import time can be attributed too.
+IMPORT_START = perf_counter()
+
+_events = None  # type: Optional[List[Dict[str, Any]]]
+_lock   = threading.Lock()
+
+
+class noop_span:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+NOOP = noop_span()
+
+
+class recorded_span(noop_span):
+    def __init__(self, name: str, args: Dict[str, Any]) -> None:
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+
+        complete(self.name, self.start, perf_counter(), **self.args)
+        return False
+
+    def set(self, **args):
+        """
+        Attach additional arguments to the span, e.g. once a result is known.
+        """
+        self.args.update(args)
+
+
+def enable() -> None:
+    """
+    Start recording spans.
+    """
+    global _events
+
+    if _events is None:
+        _events = []
+
+
+def enabled() -> bool:
+    return _events is not None
+
+
+def span(name: str, **args):
+    """
+    Returns a context manager which records the time spent within it as a
+    span with the given name and arguments.
+
+    Arguments must be JSON-serializable.  Spans may be nested and may be
+    recorded from multiple threads.
+    """
+    if _events is None:
+        return NOOP
+
+    return recorded_span(name, args)
+
+
+def complete(name: str, start: float, end: float, **args) -> None:
+    """
+    Record a span which has already completed, given its start and end times
+    as returned by time.perf_counter().
+    """
+    if _events is None:
+        return
+
+    event = {
+        "name": name,
+        "cat":  "nextstrain",
+        "ph":   "X",
+        "ts":   round(start * 1e6),
+        "dur":  round((end - start) * 1e6),
+        "pid":  os.getpid(),
+        "tid":  threading.get_ident(),
+        "args": args,
+    }
+
+    with _lock:
+        _events.append(event)
+
+
+def write(path: Path) -> None:
+    """
+    Write all recorded spans to the given path in the Chrome trace-event
+    format.
+    """
+    with _lock:
+        events = list(_events or [])
+
+    trace = {
+        "traceEvents": [
+            {
+                "name": "process_name",
+                "ph":   "M",
+                "pid":  os.getpid(),
+                "args": { "name": "nextstrain" },
+            },
+            *events,
+        ],
+        "displayTimeUnit": "ms",
+    }
+
+    with path.open("w") as file:
+        json.dump(trace, file)
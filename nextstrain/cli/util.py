@@ -3,6 +3,7 @@ import requests
 import subprocess
 from pkg_resources import parse_version
 from sys import stderr
+from . import trace
 from .__version__ import __version__
 
 
@@ -40,6 +41,17 @@ def remove_suffix(suffix, string):
     return re.sub(re.escape(suffix) + '$', '', string)
 
 
+def replace_ellipsis(items, elided_items):
+    """
+    Replaces any Ellipsis items (...) in a list, if any, with the items of a
+    second list.
+    """
+    return [
+        y for x in items
+          for y in (elided_items if x is ... else [x])
+    ]
+
+
 def check_for_new_version():
     newer_version = new_version_available()
 
@@ -72,7 +84,8 @@ def fetch_latest_pypi_version(project):
     """
     Return the latest version of the given project from PyPi.
     """
-    return requests.get("https://pypi.python.org/pypi/%s/json" % project).json().get("info", {}).get("version", "")
+    with trace.span("fetch PyPI version", project = project):
+        return requests.get("https://pypi.python.org/pypi/%s/json" % project).json().get("info", {}).get("version", "")
 
 
 def capture_output(argv):
@@ -84,9 +97,10 @@ def capture_output(argv):
     parameter wasn't added until Python 3.7 and we aim for compat with 3.5.
     When we bump our minimum Python version, we can remove this wrapper.
     """
-    result = subprocess.run(
-        argv,
-        stdout = subprocess.PIPE,
-        check  = True)
+    with trace.span("subprocess", argv = argv):
+        result = subprocess.run(
+            argv,
+            stdout = subprocess.PIPE,
+            check  = True)
 
     return result.stdout.decode("utf-8").splitlines()
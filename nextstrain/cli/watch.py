@@ -0,0 +1,171 @@
+"""
+Watches a directory for changes to its files.
+
+Changes are found by comparing snapshots of every file's size and
+modification time.  On Linux, inotify tells us when to take a new snapshot;
+elsewhere, or if inotify isn't usable, we take one every POLL_INTERVAL
+seconds.  Since snapshots are retaken after each change is handled, files
+written while handling it (e.g. a build's outputs) aren't reported as changes.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Set, Tuple
+
+
+# Directories whose contents are never considered, by name.
+IGNORE = {".snakemake", ".git", "__pycache__"}
+
+# Seconds between snapshots when inotify isn't available.
+POLL_INTERVAL = 1.0
+
+# Seconds to wait for a burst of changes to settle before reporting them.
+DEBOUNCE = 0.5
+
+# inotify event mask bits, from <sys/inotify.h>.
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+IN_CHANGES = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+Snapshot = Dict[str, Tuple[float, int]]
+
+
+def changes(directory: Path) -> Iterator[List[str]]:
+    """
+    Yields the paths, relative to *directory*, of files which were added,
+    changed, or removed, each time a burst of changes settles.
+
+    Changes are relative to the state of the directory when the generator is
+    resumed, not when the previous changes were yielded.
+    """
+    try:
+        watcher = inotify() # type: poller
+    except OSError:
+        watcher = poller()
+
+    while True:
+        before, directories = snapshot(directory)
+        watcher.watch(directories)
+        watcher.drain()
+
+        while True:
+            watcher.wait()
+
+            current, directories = snapshot(directory)
+            watcher.watch(directories)
+
+            if current == before:
+                continue
+
+            # Wait for things to settle, e.g. an editor's save or a copy of
+            # many files.
+            while True:
+                time.sleep(DEBOUNCE)
+                settled, directories = snapshot(directory)
+
+                if settled == current:
+                    break
+
+                current = settled
+
+            yield sorted(
+                path for path in set(before) | set(current)
+                      if before.get(path) != current.get(path))
+            break
+
+
+def snapshot(directory: Path) -> Tuple[Snapshot, List[str]]:
+    """
+    Returns the size and modification time of every file under *directory*
+    by relative path, and a list of the directories scanned.
+    """
+    files       = {} # type: Snapshot
+    directories = []
+
+    for dirpath, dirnames, filenames in os.walk(str(directory)):
+        dirnames[:] = [ name for name in dirnames if name not in IGNORE ]
+        directories.append(dirpath)
+
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed since it was listed.
+                continue
+
+            files[os.path.relpath(path, str(directory))] = (stat.st_mtime, stat.st_size)
+
+    return files, directories
+
+
+class poller:
+    """
+    Wakes up periodically, for when there's no way to be told of changes.
+    """
+    def watch(self, directories: List[str]):
+        pass
+
+    def drain(self):
+        pass
+
+    def wait(self):
+        time.sleep(POLL_INTERVAL)
+
+
+class inotify(poller):
+    """
+    Wakes up when Linux's inotify reports activity in any of the watched
+    directories.
+
+    Raises an OSError if inotify isn't available.
+    """
+    def __init__(self) -> None:
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+            self.fd   = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as error:
+            raise OSError("inotify unavailable: %s" % error)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.watched  = set() # type: Set[str]
+        self.complete = True
+
+    def watch(self, directories: List[str]):
+        # Watches on removed directories go away by themselves.
+        self.watched &= set(directories)
+
+        for directory in directories:
+            if directory not in self.watched:
+                if self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CHANGES) >= 0:
+                    self.watched.add(directory)
+
+        # If some directories couldn't be watched (e.g. we ran out of
+        # watches), poll as well so changes in them are still noticed.
+        self.complete = len(self.watched) == len(directories)
+
+    def drain(self):
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+
+    def wait(self):
+        select.select([self.fd], [], [], None if self.complete else POLL_INTERVAL)
+        self.drain()